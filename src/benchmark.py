@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+from .imports import *
+import tracemalloc
+from .features.build_features import *
+# import the models through predict_model, which finishes loading train_model before it imports load_model1
+from .models.predict_model import *
+from .models.train_model import *
+from .models.train_model import _cv_score
+
+"""Benchmark functions for comparing the optimized feature engineering and model functions with
+the previous implementations.
+
+"""
+
+
+def _timeit(fun, *args, repeat: int = 3, **kwargs):
+    # return the best wall time in seconds and the result of the last call
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fun(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return np.min(times), result
+
+
+def bench_pacf(poll_series, nlags: int = 40, repeat: int = 3):
+    """Compare cal_pacf with statsmodels pacf used by find_num_lag before.
+
+    Args:
+        poll_series: hourly pollution series
+        nlags(optional): maximum lag [default:40]
+        repeat(optional): number of repeats. Report the best time [default:3]
+
+    Returns: dict
+        wall time in seconds of both functions, speed up and the maximum absolute difference
+
+    """
+    x = poll_series.dropna().values
+    sm_time, sm_pac = _timeit(pacf, x, nlags=nlags, repeat=repeat)
+    fft_time, fft_pac = _timeit(cal_pacf, x, nlags=nlags, repeat=repeat)
+
+    return {'statsmodels_time': sm_time,
+            'cal_pacf_time': fft_time,
+            'speed_up': sm_time / fft_time,
+            'max_abs_diff': np.max(np.abs(sm_pac - fft_pac))}
+
+
+def _feature_no_fire_frames(poll_df, wea, pollutant, holiday_file, rolling_win=24):
+    # the previous DataFrame based Dataset.feature_no_fire pipeline
+    cols = [pollutant, 'Temperature(C)', 'Humidity(%)', 'Wind', 'Wind Speed(kmph)', 'Condition']
+    data = poll_df.merge(wea, left_index=True, right_index=True, how='inner')
+    data = data[cols]
+    data[pollutant] = data[pollutant].rolling(rolling_win, min_periods=0).mean().round(1)
+    data = data.dropna()
+    dummies = wind_to_dummies(data['Wind'])
+    data.drop('Wind', axis=1, inplace=True)
+    data = pd.concat([data, dummies], axis=1)
+    data = add_is_rain(data)
+    data = add_calendar_info(data, holiday_file=holiday_file)
+    data = data.astype(float)
+    data.sort_index(inplace=True)
+    return data.loc[~data.index.duplicated(keep='first')]
+
+
+def _peak_memory(fun, *args, **kwargs):
+    # return the wall time, peak traced memory in MB and the result
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fun(*args, **kwargs)
+    wall_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return wall_time, peak / 1E6, result
+
+
+def bench_feature_no_fire(dataset, pollutant: str = 'PM2.5', rolling_win: int = 24):
+    """Compare peak memory and wall time of build_feature_no_fire with the previous DataFrame pipeline.
+
+    Args:
+        dataset: dataset object with poll_df and wea attributes. Call dataset.load_() first
+        pollutant(optional): name of the pollutant [default:'PM2.5']
+        rolling_win(optional): rolling windows size [default:24]
+
+    Returns: dict
+        wall time, peak memory(MB) of both pipelines and the maximum absolute difference 
+
+    """
+    holiday_file = dataset.data_folder + 'holiday.csv'
+    wea = dataset.wea
+    if 'datetime' in wea.columns:
+        wea = wea.set_index('datetime')
+
+    frame_time, frame_peak, old = _peak_memory(
+        _feature_no_fire_frames, dataset.poll_df, wea, pollutant, holiday_file, rolling_win)
+    fused_time, fused_peak, new = _peak_memory(
+        build_feature_no_fire, dataset.poll_df, wea, pollutant, holiday_file, rolling_win)
+
+    return {'frames_time': frame_time,
+            'frames_peak_mb': frame_peak,
+            'fused_time': fused_time,
+            'fused_peak_mb': fused_peak,
+            'max_abs_diff': np.max(np.abs(old[new.columns].values - new.values))}
+
+
+def _fire_feature_frames(fire, zone_list, fire_col='power', damp_surface='sphere', shift=0, roll=48, w_speed=8):
+    # the previous pandas get_fire_feature: resample, rolling and shift each zone, then concat
+    new_fire = pd.DataFrame()
+    for start, stop in zip(zone_list, zone_list[1:]):
+        fire_s = fire[(fire['distance'] < stop) & (fire['distance'] >= start)][[fire_col, 'distance']].copy()
+        fire_s['damp_' + fire_col] = cal_power_damp(fire_s[fire_col], fire_s['distance'], surface=damp_surface)
+        arrival_time = fire_s.index + pd.to_timedelta(fire_s['distance'] / w_speed, 'h')
+        fire_s['arrival_time'] = arrival_time.dt.round('h')
+        fire_s = fire_s.set_index('arrival_time').resample('h').sum()['damp_' + fire_col]
+        fire_s = fire_s.rolling(roll).sum().shift(shift)
+        fire_s.name = f'fire_{start}_{stop}'
+        new_fire = pd.concat([new_fire, fire_s], axis=1, ignore_index=False)
+
+    return new_fire.fillna(0)
+
+
+def bench_fire_feature(dataset, fire_dict=None, repeat: int = 3):
+    """Compare get_fire_feature with the previous pandas implementation.
+
+    Args:
+        dataset: dataset object with fire attribute. Call dataset.load_() first
+        fire_dict(optional): fire dictionary. If None, use dataset.fire_dict [default:None]
+        repeat(optional): number of repeats. Report the best time [default:3]
+
+    Returns: dict
+        wall time in seconds of both functions, speed up and the maximum absolute difference
+
+    """
+    if fire_dict is None:
+        fire_dict = dataset.fire_dict
+    kwargs = {'zone_list': dataset.get_zone_list(),
+              'shift': fire_dict['shift'],
+              'roll': fire_dict['roll'],
+              'w_speed': fire_dict['w_speed']}
+
+    frame_time, old = _timeit(_fire_feature_frames, dataset.fire, repeat=repeat, **kwargs)
+    bin_time, (new, _) = _timeit(get_fire_feature, dataset.fire, repeat=repeat, **kwargs)
+
+    return {'frames_time': frame_time,
+            'bincount_time': bin_time,
+            'speed_up': frame_time / bin_time,
+            'max_abs_diff': np.max(np.abs(old.loc[new.index, new.columns].values - new.values))}
+
+
+def bench_rf_search(x_trn, y_trn, n_iter: int = 100, cv_split: str = 'other', n_splits: int = 5,
+                    resource: str = 'n_samples', n_jobs=-2):
+    """Compare the successive halving search with the random search of do_rf_search.
+
+    Args:
+        x_trn: 2D array of x data
+        y_trn: array of y data
+        n_iter(optional): number of candidates [default:100]
+        cv_split(optional): see do_rf_search [default:'other']
+        n_splits(optional): number of cross validation split [default:5]
+        resource(optional): resource of the halving search [default:'n_samples']
+        n_jobs(optional): number of CPU use [default:-2]
+
+    Returns: dict
+        wall time, number of fits and the cross validation score of the best parameters of both searches
+
+    """
+    m = RandomForestRegressor(random_state=42)
+    cv = TimeSeriesSplit(n_splits=n_splits) if cv_split == 'time' else n_splits
+    candidates = list(ParameterSampler(get_rf_param_dict(x_trn), n_iter, random_state=40))
+
+    start = time.perf_counter()
+    search = RandomizedSearchCV(m, param_distributions=get_rf_param_dict(x_trn), n_iter=n_iter, n_jobs=n_jobs,
+                                cv=cv, random_state=40).fit(x_trn, y_trn)
+    random_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    best_params, _, halving_fits, _ = halving_search(m, candidates, x_trn, y_trn, cv=cv, resource=resource, n_jobs=n_jobs)
+    clone(m).set_params(**best_params).fit(x_trn, y_trn)
+    halving_time = time.perf_counter() - start
+
+    return {'random_time': random_time,
+            'random_fits': n_iter * n_splits + 1,
+            'random_score': search.best_score_,
+            'halving_time': halving_time,
+            'halving_fits': halving_fits + 1,
+            # score the halving winner on the full data the same way as the random search
+            'halving_score': _cv_score(m, best_params, x_trn, y_trn, cv)}
+
+
+def bench_model_artifact(model, folder: str, x, repeat: int = 3):
+    """Compare the pickle of the forest model with the compact forest artifact.
+
+    Args:
+        model: fitted forest model
+        folder: folder to save the pickle and the compact forest
+        x: 2D array of x data to predict
+        repeat(optional): number of repeats. Report the best time [default:3]
+
+    Returns: dict
+        size in MB, load time and predict time of both artifacts and the maximum absolute difference
+
+    """
+    pickle_file = os.path.join(folder, 'bench_model.pkl')
+    forest_folder = os.path.join(folder, 'bench_model')
+    pickle.dump(model, open(pickle_file, 'wb'))
+    save_forest(model, forest_folder)
+    forest = load_forest(forest_folder)
+    forest_size = np.sum([os.path.getsize(os.path.join(forest_folder, f))
+                          for f in list(forest.manifest['arrays'].values()) + ['manifest.json']])
+
+    pickle_load, pickle_model = _timeit(lambda: pickle.load(open(pickle_file, 'rb')), repeat=repeat)
+    forest_load, forest = _timeit(load_forest, forest_folder, repeat=repeat)
+    pickle_time, old = _timeit(pickle_model.predict, x, repeat=repeat)
+    forest_time, new = _timeit(forest.predict, x, repeat=repeat)
+
+    return {'pickle_mb': os.path.getsize(pickle_file) / 1E6,
+            'forest_mb': forest_size / 1E6,
+            'pickle_load_time': pickle_load,
+            'forest_load_time': forest_load,
+            'pickle_predict_time': pickle_time,
+            'forest_predict_time': forest_time,
+            'max_abs_diff': np.max(np.abs(old - new))}
+
+
+def _senario_frames(model, data_samples, features, per_cut):
+    # the previous make_senario: copy the samples, scale the columns and predict
+    cols_to_cut = get_cut_cols(data_samples, features)
+    data_senario = data_samples.copy()
+    data_senario[cols_to_cut] = data_samples[cols_to_cut] * (1 - per_cut)
+    return pd.Series(model.predict(data_senario.values), index=data_samples.index)
+
+
+def bench_senario(model, data_samples, features, red_list=[0.90, 0.75, 0.5, 0.25, 0.10, 0], repeat: int = 1):
+    """Compare make_senarios with one make_senario call per reduction.
+
+    Args:
+        model: model for prediction
+        data_samples: data samples. See get_data_samples
+        features: a list of features to reduce
+        red_list(optional): a list of reduction fraction [default:[0.90, 0.75, 0.5, 0.25, 0.10, 0]]
+        repeat(optional): number of repeats. Report the best time [default:1]
+
+    Returns: dict
+        wall time in seconds of both methods, speed up and the maximum absolute difference
+
+    """
+    loop_time, old = _timeit(lambda: [_senario_frames(model, data_samples, features, per_cut) for per_cut in red_list],
+                             repeat=repeat)
+    batch_time, new = _timeit(make_senarios, model, data_samples, [(features, per_cut) for per_cut in red_list],
+                              repeat=repeat)
+
+    return {'loop_time': loop_time,
+            'batch_time': batch_time,
+            'speed_up': loop_time / batch_time,
+            'max_abs_diff': np.max([np.max(np.abs(old[i].values - new[i].values)) for i in range(len(red_list))])}
+
+
+def _band_frames(ypred_df, q_list):
+    # the previous make_band: one groupby quantile per quantile
+    band_df = []
+    for q in q_list:
+        band = ypred_df.groupby(level=0).quantile(q=q)
+        band_df.append(pd.DataFrame(band.values, index=band.index, columns=['q' + str(q)]))
+    return pd.concat(band_df, axis=1)
+
+
+def bench_band(ypred_df, q_list=[0.01, 0.25, 0.5, 0.75, 0.99], repeat: int = 3):
+    """Compare make_band and its P2Band estimate with one groupby quantile per quantile.
+
+    Args:
+        ypred_df: prediction series indexed by the timestamp. See make_senario
+        q_list(optional): a list of quantile to calculate [default:[0.01, 0.25, 0.5, 0.75, 0.99]]
+        repeat(optional): number of repeats. Report the best time [default:3]
+
+    Returns: dict
+        wall time in seconds of the three methods, speed up and the maximum absolute difference to the groupby
+
+    """
+    frame_time, old = _timeit(_band_frames, ypred_df, q_list, repeat=repeat)
+    dense_time, new = _timeit(make_band, ypred_df, q_list=q_list, repeat=repeat)
+    p2_time, p2 = _timeit(make_band, ypred_df, q_list=q_list, method='p2', repeat=repeat)
+
+    return {'groupby_time': frame_time,
+            'dense_time': dense_time,
+            'p2_time': p2_time,
+            'speed_up': frame_time / dense_time,
+            'max_abs_diff': np.max(np.abs(old.values - new.values)),
+            'p2_max_abs_diff': np.max(np.abs(old.values - p2.values))}
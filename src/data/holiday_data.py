@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+from ..imports import *
+
+"""Build holiday tables from the bundled calendar files in data/holidays/, and optionally refresh
+them by scraping https://www.timeanddate.com/holidays/.
+
+Each calendar file is a versioned json file with
+    - fixed: holidays on the same month and day every year
+    - relative: holidays defined by an offset in days from an anchor date ('easter' or a dated anchor)
+    - anchors: dated anchors such as lunar_new_year, keyed by year. A year with two dates has a list of dates
+
+"""
+
+calendar_folder = os.path.join(os.path.dirname(__file__), 'holidays')
+
+
+def load_calendar(country: str):
+    """Load the bundled calendar of a country.
+
+    Args:
+        country: lower case country name such as 'thailand', 'vietnam' or 'indonesia'
+
+    Returns: dict
+        calendar dictionary
+
+    Raises:
+        AssertionError: if there is no bundled calendar for the country
+
+    """
+    filename = os.path.join(calendar_folder, country + '.json')
+    if not os.path.exists(filename):
+        raise AssertionError(f'no bundled holiday calendar for {country}')
+
+    with open(filename, 'r') as f:
+        calendar = json.load(f)
+
+    return calendar
+
+
+def easter_date(year: int):
+    """Calculate the date of Easter Sunday using the anonymous Gregorian algorithm.
+
+    """
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def _in_years(rule, year):
+    # check if the rule apply to the year
+    return (rule.get('start', year) <= year) and (rule.get('end', year) >= year)
+
+
+def build_holiday_table(country: str, years, strict: bool = False):
+    """Build a holiday table from the bundled calendar of a country without network access.
+
+    Relative holidays can only be built for the years in the anchor tables. The missing holidays are
+    reported, or raise an error if strict is True.
+
+    Args:
+        country: lower case country name
+        years: a list of years to build
+        strict(optional): if True, raise an error if an anchor date is missing [default:False]
+
+    Returns: pd.DataFrame
+        holiday table with the same columns as the scraped holiday data
+
+    Raises:
+        AssertionError: if strict is True and a year has no anchor date for a relative holiday
+
+    """
+    calendar = load_calendar(country)
+
+    rows = []
+    missing = []
+    for year in years:
+        year = int(year)
+        for rule in calendar['fixed']:
+            if _in_years(rule, year):
+                rows.append((date(year, rule['month'], rule['day']),
+                             rule['name'], rule['type']))
+
+        for rule in calendar['relative']:
+            if not _in_years(rule, year):
+                continue
+            if rule['anchor'] == 'easter':
+                anchors = [easter_date(year)]
+            elif str(year) in calendar['anchors'][rule['anchor']]:
+                anchors = calendar['anchors'][rule['anchor']][str(year)]
+                anchors = anchors if isinstance(anchors, list) else [anchors]
+                anchors = [datetime.strptime(anchor, '%Y-%m-%d').date() for anchor in anchors]
+            else:
+                missing.append(f"{rule['name']} {year}")
+                continue
+            for anchor in anchors:
+                rows.append((anchor + timedelta(days=rule['offset']),
+                             rule['name'], rule['type']))
+
+    if len(missing) > 0:
+        message = f'no anchor date in the {country} calendar for ' + ', '.join(dict.fromkeys(missing))
+        if strict:
+            raise AssertionError(message)
+        print('Warning:', message)
+
+    holiday = pd.DataFrame(rows, columns=['date', 'name', 'type'])
+    holiday['date'] = pd.to_datetime(holiday['date'])
+    holiday['Date'] = holiday['date'].dt.strftime('%b %d')
+    holiday['day_of_week'] = holiday['date'].dt.strftime('%A')
+    holiday['year'] = holiday['date'].dt.year
+    holiday = holiday.sort_values('date').reset_index(drop=True)
+    holiday['version'] = calendar['version']
+
+    return holiday[['Date', 'day_of_week', 'name', 'type', 'year', 'date', 'version']]
+
+
+def scrape_holiday(country: str, years):
+    """Scrape holiday data from https://www.timeanddate.com/holidays/ for each year in years.
+
+    Use to refresh the bundled calendar. Require network access.
+
+    Args:
+        country: lower case country name
+        years: a list of years to scrape
+
+    Returns: pd.DataFrame
+        holiday table
+
+    """
+    head_url = f'https://www.timeanddate.com/holidays/{country}/'
+
+    holiday = pd.DataFrame()
+
+    for year in years:
+        url = head_url + str(year)
+        df = pd.read_html(url)[0]
+        df['year'] = year
+        holiday = pd.concat([holiday, df], ignore_index=True)
+
+    holiday.columns = ['Date', 'day_of_week', 'name', 'type', 'year']
+    holiday = holiday[~holiday['Date'].isna()]
+
+    holiday['date'] = holiday['Date'] + ', ' + holiday['year'].astype(str)
+    holiday['date'] = pd.to_datetime(holiday['date'])
+    holiday['version'] = 'scraped'
+
+    return holiday
@@ -270,9 +270,14 @@ def update_weather(
             df.to_csv(current_filename, index=False)
 
 
-def proc_open_weather(wea_df):
+def proc_open_weather(wea_df, wind_to_str=True):
     """Process weather file from OpenWeahterMap.org
 
+    Args:
+        wea_df: weather dataframe from OpenWeatherMap.org
+        wind_to_str(optional): if True, convert wind direction in degree to compass direction string.
+            If False, keep the degree, which wind_to_dummies can encode directly[default:True]
+
     """
     if 'dt_iso' in wea_df.columns:
         wea_df['datetime'] = pd.to_datetime(
@@ -329,9 +334,10 @@ def proc_open_weather(wea_df):
     wea_df['Precip.(in)'] *= 0.0393701
     wea_df['Precip.(in)'] = wea_df['Precip.(in)'].fillna(0)
 
-    wea_df['Wind'] = (
-        wea_df['Wind'] /
-        22.5 +
-        1).astype(int).replace(degree_to_direction)
+    if wind_to_str:
+        wea_df['Wind'] = (
+            wea_df['Wind'] /
+            22.5 +
+            1).astype(int).replace(degree_to_direction)
 
     return wea_df
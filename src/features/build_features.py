@@ -2,40 +2,84 @@
 from ..imports import *
 
 
-def add_is_holiday(
-        df,
-        holiday_file='C:/Users/Benny/Documents/Fern/aqi_thailand2/data/th_holiday.csv'):
-    """ add is_holiday columns. df must have 'datetime' columns
+# holiday days cache. Map the absolute holiday filename to (mtime, days)
+_holiday_cache = {}
+
+
+def to_epoch_days(index):
+    """Convert a datetime index or array to an int64 array of days since 1970-01-01.
 
     """
-    # prepare datetime columns
+    return np.asarray(index, dtype='datetime64[ns]').astype(
+        'datetime64[D]').astype(np.int64)
 
-    try:
 
-        df['datetime'] = pd.to_datetime(df['datetime'])
+def load_holiday_days(
+        holiday_file,
+        holiday_types=(
+            'National holiday',
+            'Joint Holiday',
+            'Public Holiday')):
+    """Load national holidays from the holiday file as a sorted int64 array of epoch days.
 
-    except BaseException:
-        df.index.name = 'datetime'
-        df = df.reset_index()
-        df['datetime'] = pd.to_datetime(df['datetime'])
+    The array is cached per file and reloaded only when the file modification time changes.
 
-    # load holiday files
-    if os.path.exists(holiday_file):
-        holiday = pd.read_csv(holiday_file)
-        holiday['date'] = pd.to_datetime(holiday['date'])
-        # keep only national holiday
-        holiday = holiday[holiday['type'].isin(
-            ['National holiday', 'Joint Holiday', 'Public Holiday'])]
+    Args:
+        holiday_file: holiday csv filename created by Dataset.build_holiday
+        holiday_types(optional): a tuple of holiday type to keep
 
-    else:
+    Returns: np.array
+        sorted unique holiday days since 1970-01-01
+
+    Raises:
+        AssertionError: if the holiday file does not exist
+
+    """
+    if not os.path.exists(holiday_file):
         raise AssertionError('the holiday file does not exist')
 
-    df['date'] = pd.to_datetime(df['datetime'].dt.date)
-    holiday['date'] = pd.to_datetime(holiday['date'])
-    df = df.merge(holiday[['date', 'name']], on='date', how='left')
-    df = df.drop('date', axis=1)
-    df['is_holiday'] = ~df['name'].isna() * 1
-    return df.drop('name', axis=1).set_index('datetime')
+    key = os.path.abspath(holiday_file)
+    mtime = os.path.getmtime(holiday_file)
+    if (key in _holiday_cache) and (_holiday_cache[key][0] == mtime):
+        return _holiday_cache[key][1]
+
+    holiday = pd.read_csv(holiday_file, usecols=['date', 'type'])
+    # keep only national holiday
+    holiday = holiday[holiday['type'].isin(holiday_types)]
+    days = np.unique(to_epoch_days(pd.to_datetime(holiday['date'])))
+    _holiday_cache[key] = (mtime, days)
+
+    return days
+
+
+def is_in_sorted(values, sorted_array):
+    """Check if each value is in a sorted array using binary search. Same as np.isin without sorting the values.
+
+    """
+    if len(sorted_array) == 0:
+        return np.zeros(len(values), dtype=bool)
+    pos = np.searchsorted(sorted_array, values)
+    pos[pos == len(sorted_array)] = 0
+    return sorted_array[pos] == values
+
+
+def _to_datetime_index(df):
+    # return a new df with datetime index named 'datetime'. The caller's df and index are not modified
+    if 'datetime' in df.columns:
+        return df.set_index(pd.to_datetime(df['datetime']).rename('datetime')).drop('datetime', axis=1)
+    return df.set_axis(pd.to_datetime(df.index).rename('datetime'), axis=0).copy()
+
+
+def add_is_holiday(
+        df,
+        holiday_file='C:/Users/Benny/Documents/Fern/aqi_thailand2/data/th_holiday.csv'):
+    """ add is_holiday columns. df must have 'datetime' columns or datetime index
+
+    """
+    df = _to_datetime_index(df)
+    holidays = load_holiday_days(holiday_file)
+    df['is_holiday'] = is_in_sorted(to_epoch_days(df.index), holidays) * 1
+    return df
 
 
 def add_calendar_info(
@@ -43,24 +87,64 @@ def add_calendar_info(
         holiday_file='C:/Users/Benny/Documents/Fern/aqi_thailand2/data/th_holiday.csv'):
     """ Add information related to calendar such as holiday, is_weekend, day of week and time of day.
 
+    All columns are computed from the epoch day and epoch hour of the index.
+
     Args:
         df: data frame with datetime index,
     """
-    # add datetime information
-    df = add_is_holiday(df, holiday_file)
-    # add weekend information
-    df['is_weekend'] = df.index.dayofweek.isin([5, 6]) * 1
-    # add day of week
-    df['day_of_week'] = df.index.dayofweek
-    df['time_of_day'] = df.index.hour
+    df = _to_datetime_index(df)
+    hours = np.asarray(df.index.values, dtype='datetime64[h]').astype(np.int64)
+    for col, values in cal_calendar_info(hours, holiday_file).items():
+        df[col] = values
 
     return df
 
 
+def cal_calendar_info(hours, holiday_file):
+    """Calculate calendar columns from epoch hours.
+
+    Args:
+        hours: int64 array of hours since 1970-01-01 00:00
+        holiday_file: holiday csv filename
+
+    Returns: dict
+        map is_holiday, is_weekend, day_of_week and time_of_day to arrays
+
+    """
+    days = hours // 24
+    # 1970-01-01 is a Thursday. Monday is 0
+    day_of_week = (days + 3) % 7
+
+    return {'is_holiday': is_in_sorted(days, load_holiday_days(holiday_file)) * 1,
+            'is_weekend': (day_of_week >= 5) * 1,
+            'day_of_week': day_of_week,
+            'time_of_day': hours % 24}
+
+
+# 16 point compass directions ordered by 22.5 degree bins starting from north
+compass_points = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+                  'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+wind_labels = compass_points + ['CALM', 'VAR']
+wind_major_cols = ['CALM', 'E', 'N', 'S', 'W']
+# weight matrix mapping each wind label to the major wind directions.
+# A compound direction count once toward each of its letters, and 'VAR' count toward all four directions.
+# The extra last row is for unknown label (code -1)
+wind_weights = np.zeros((len(wind_labels) + 1, len(wind_major_cols)), dtype=np.uint8)
+for i, label in enumerate(wind_labels):
+    for j, direction in enumerate(wind_major_cols):
+        wind_weights[i, j] = (label == direction) or (
+            len(direction) == 1) and ((direction in label) or (label == 'VAR'))
+
+
 def wind_to_dummies(series):
     """One hot encode wind direction columns and group major wind direction
+
+    Use a single lookup into the wind_weights matrix. Always return the 
+    wind_CALM, wind_E, wind_N, wind_S and wind_W columns.
+
     Args:
-        series: wind data series from weather['Wind']
+        series: wind data series from weather['Wind']. Either compass direction string 
+            or wind direction in degree, such as the output of proc_open_weather(wind_to_str=False)
     
     Raises:
         AssertionError: if passed an empty series
@@ -68,66 +152,347 @@ def wind_to_dummies(series):
     if len(series)==0:
         raise AssertionError('empty series')
 
-    series = series.astype('category')
-    dummies = pd.get_dummies(series)
-    
-    # group the wind direction into major wind direction
-    direction_to_collpse = dummies.columns.to_list()
-    # remove 'CALM'
-    if 'CALM' in direction_to_collpse:
-        direction_to_collpse.remove('CALM')
-
-    if 'VAR' in direction_to_collpse:
-        direction_to_collpse.remove('VAR')
-
-    for direction in direction_to_collpse:
-        if len(direction) > 1:
-            for char in set(direction):
-                dummies[char] = dummies[char] + dummies[direction]
-            dummies.drop(direction, axis=1, inplace=True)
-
-    # group the 'var' direction
-    major_direction = ['E', 'N', 'S', 'W']
-    for direction in major_direction:
-        try:
-            dummies[direction] = dummies[direction] + dummies['VAR']
-        except:
-            pass
-    dummies.drop('VAR', axis=1, inplace=True)
-    dummies.columns = ['wind_' + s for s in dummies.columns]
-    return dummies
+    return pd.DataFrame(wind_weights[wind_codes(series)], index=series.index,
+                        columns=['wind_' + s for s in wind_major_cols])
+
+
+def wind_codes(series):
+    """Convert wind direction to the row index of wind_weights. Unknown or missing direction is -1.
+
+    Args:
+        series: wind direction series. Either compass direction string or degree
+
+    """
+    if pd.api.types.is_numeric_dtype(series):
+        # convert degree to compass point using the same bins as proc_open_weather
+        degree = np.asarray(series, dtype=float)
+        codes = np.full(len(degree), -1, dtype=np.int64)
+        valid = ~np.isnan(degree)
+        codes[valid] = (degree[valid] / 22.5).astype(int) % 16
+    else:
+        codes = pd.Categorical(series, categories=wind_labels).codes
+
+    return codes
+
+
+# optional weather condition flags. Map flag column name to keywords in the 'Condition' string
+condition_dict = {'is_fog': ['Fog', 'Mist'],
+                  'is_haze': ['Haze', 'Smoke', 'Dust', 'Sand'],
+                  'is_thunder': ['Thunder', 'T-Storm', 'Strom', 'Storm']}
+
+
+def condition_flag(values, keywords):
+    """Return a boolean array of the condition values that contain any keyword. Missing value is False.
+
+    Only the unique conditions are matched against the keywords.
+
+    Args:
+        values: condition array 
+        keywords: a list of keywords
+
+    """
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object).astype(str)
+    # the extra False at the end is for missing value (code -1)
+    unique_flags = np.append(uniques.str.contains('|'.join(keywords)).values, False)
+    return unique_flags[codes]
+
+
+def classify_condition(series, flag_dict):
+    """Classify weather condition strings into flag columns.
+
+    Only the unique conditions are matched against the keywords. The flags are mapped 
+    back to every row using the factorized codes. Missing condition has all flags nan. 
+
+    Args:
+        series: condition series from weather['Condition']
+        flag_dict: dictionary mapping flag column name to a list of keywords 
+
+    Returns: pd.DataFrame
+        dataframe with one column per flag 
+
+    """
+    codes, uniques = pd.factorize(series)
+
+    flags = {}
+    for flag, keywords in flag_dict.items():
+        flags[flag] = condition_flag(uniques, keywords)[codes] * 1
+
+    # missing condition has code -1
+    return pd.DataFrame(flags, index=series.index).where(series.notna(), axis=0)
+
+
+# keywords in the 'Condition' string for rain
+rain_keywords = ['Rain', 'Shower', 'Thunder', 'Strom', 'Drizzle']
 
 
 def add_is_rain(
     df,
-    rain_list=[
-        'Rain',
-        'Shower',
-        'Thunder',
-        'Strom',
-        'Drizzle']):
-    df['is_rain'] = df['Condition'].str.contains('|'.join(rain_list)) * 1
+    rain_list=rain_keywords,
+        flag_dict=None):
+    """Add is_rain column from the 'Condition' column and drop the 'Condition' column.
+
+    Args:
+        df: dataframe with 'Condition' column
+        rain_list(optional): a list of keywords for rain 
+        flag_dict(optional): additional flag columns such as condition_dict[default:None]
+
+    """
+    all_flags = {'is_rain': rain_list}
+    if flag_dict:
+        all_flags.update(flag_dict)
+
+    flags = classify_condition(df['Condition'], all_flags)
+    for col in flags.columns:
+        df[col] = flags[col]
     df = df.drop('Condition', axis=1)
     return df
 
 
-def find_num_lag(poll_series, thres=0.5):
+def _sorted_time(index):
+    # return sorted int64 timestamps of a datetime index and the sorting order (None if already sorted)
+    time_idx = np.asarray(index.values, dtype='datetime64[ns]').astype(np.int64)
+    if index.is_monotonic_increasing:
+        return time_idx, None
+    order = np.argsort(time_idx, kind='mergesort')
+    return time_idx[order], order
+
+
+def align_time(left_index, right_index):
+    """Find the common timestamps of two datetime indexes, same as an inner join that keep the first duplicate. 
+
+    Use binary search on the sorted timestamps instead of merging the dataframes.
+
+    Args:
+        left_index: datetime index
+        right_index: datetime index
+
+    Returns:
+        time_idx: sorted int64 common timestamps in nanosecond
+        left_i: positions of the common timestamps in left_index
+        right_i: positions of the common timestamps in right_index
+
+    """
+    left_time, left_order = _sorted_time(left_index)
+    right_time, right_order = _sorted_time(right_index)
+    if (len(left_time) == 0) or (len(right_time) == 0):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+
+    # keep the first duplicate in the left index
+    keep = np.ones(len(left_time), dtype=bool)
+    keep[1:] = left_time[1:] != left_time[:-1]
+    left_i = np.flatnonzero(keep)
+
+    # the left most position is the first duplicate in the right index
+    right_i = np.searchsorted(right_time, left_time[left_i])
+    right_i[right_i == len(right_time)] = 0
+    match = right_time[right_i] == left_time[left_i]
+    left_i = left_i[match]
+    right_i = right_i[match]
+    time_idx = left_time[left_i]
+
+    if left_order is not None:
+        left_i = left_order[left_i]
+    if right_order is not None:
+        right_i = right_order[right_i]
+
+    return time_idx, left_i, right_i
+
+
+def rolling_nanmean(values, win):
+    """Calculate the rolling average of the previous win rows (including the current row) ignoring nan. 
+
+    Same as rolling(win, min_periods=0).mean(). All nan windows are nan.
+
+    """
+    values = np.asarray(values, dtype=np.float64)
+    isnan = np.isnan(values)
+    csum = np.zeros(len(values) + 1)
+    np.cumsum(np.where(isnan, 0, values), out=csum[1:])
+    count = np.zeros(len(values) + 1)
+    np.cumsum(~isnan, out=count[1:])
+    start = np.maximum(np.arange(1, len(values) + 1) - win, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (csum[1:] - csum[start]) / (count[1:] - count[start])
+
+
+# numerical weather columns of the data no fire
+wea_num_cols = ['Temperature(C)', 'Humidity(%)', 'Wind Speed(kmph)']
+
+
+def no_fire_cols(pollutant):
+    """Return the columns of the data no fire in order.
+
+    """
+    return [pollutant] + wea_num_cols + ['wind_' + s for s in wind_major_cols] + \
+        ['is_rain', 'is_holiday', 'is_weekend', 'day_of_week', 'time_of_day']
+
+
+def build_feature_no_fire(
+        poll_df,
+        wea,
+        pollutant,
+        holiday_file,
+        rolling_win=24,
+        start_date=None):
+    """Assemble pollution data, weather data and calendar information into one float32 feature matrix. 
+
+    Align pollution and weather data on a shared time axis and write each feature column directly 
+    into a preallocated matrix. Give the same result as merging the data, rolling the pollutant, 
+    dropping nan, and calling wind_to_dummies, add_is_rain and add_calendar_info.
+
+    Args:
+        poll_df: pollution data with datetime index
+        wea: weather data with datetime index
+        pollutant: name of the pollutant
+        holiday_file: holiday csv filename
+        rolling_win(optional): rolling windows size of the pollutant [defaul:24]
+        start_date(optional): if not None, keep only the data from the start_date 
+
+    Returns: pd.DataFrame
+        data no fire 
+
+    """
+    cols = no_fire_cols(pollutant)
+
+    # align the timestamp of the pollution data and the weather data (inner join, first duplicate)
+    time_idx, poll_i, wea_i = align_time(poll_df.index, wea.index)
+    n_rows = len(time_idx)
+
+    # rolling average of the pollutant over the aligned rows
+    poll = rolling_nanmean(poll_df[pollutant].values[poll_i], rolling_win).round(1)
+
+    # keep the rows without missing value
+    valid = ~np.isnan(poll) & wea['Wind'].notna().values[wea_i] & wea['Condition'].notna().values[wea_i]
+    for col in wea_num_cols:
+        valid &= wea[col].notna().values[wea_i]
+    if start_date is not None:
+        valid &= time_idx >= pd.Timestamp(start_date).value
+
+    poll_i = poll_i[valid]
+    wea_i = wea_i[valid]
+    time_idx = time_idx[valid]
+    hours = time_idx // (3600 * 10**9)
+
+    data = np.empty((len(time_idx), len(cols)), dtype=np.float32)
+    data[:, 0] = poll[valid]
+    try:
+        for i, col in enumerate(wea_num_cols):
+            data[:, i + 1] = wea[col].values[wea_i]
+    except (ValueError, TypeError):
+        raise AssertionError('some data cannot be convert to float')
+    i = len(wea_num_cols) + 1
+    data[:, i:i + len(wind_major_cols)] = wind_weights[wind_codes(wea['Wind'].values[wea_i])]
+    i += len(wind_major_cols)
+    data[:, i] = condition_flag(wea['Condition'].values[wea_i], rain_keywords)
+    i += 1
+    for col, values in cal_calendar_info(hours, holiday_file).items():
+        data[:, i] = values
+        i += 1
+
+    index = pd.DatetimeIndex(time_idx.view('datetime64[ns]'), name='datetime')
+    return pd.DataFrame(data, index=index, columns=cols, copy=False)
+
+
+# cache of the lags from find_num_lag. Map (city_name, pollutant, max_lag, thres, data hash) to the lags
+_num_lag_cache = {}
+
+
+def cal_acf(x, nlags: int = 40, adjusted: bool = True):
+    """Calculate the autocorrelation function up to nlags using FFT.
+
+    Args:
+        x: 1D array 
+        nlags(optional): maximum lag [default:40]
+        adjusted(optional): if True, divide the autocovariance by n-k instead of n [default:True]
+
+    Returns: np.array
+        autocorrelation of lag 0 to nlags
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    x = x - x.mean()
+    n = len(x)
+    # zero pad to avoid the circular correlation
+    nfft = 2 ** int(np.ceil(np.log2(2 * n - 1)))
+    fx = np.fft.rfft(x, nfft)
+    acov = np.fft.irfft(fx * np.conj(fx), nfft)[:nlags + 1]
+    if adjusted:
+        acov = acov / (n - np.arange(nlags + 1))
+    else:
+        acov = acov / n
+    return acov / acov[0]
+
+
+def cal_pacf(x, nlags: int = 40):
+    """Calculate the partial autocorrelation function up to nlags using Durbin-Levinson recursion 
+    on the FFT autocorrelation. 
+
+    Same as statsmodels pacf(x, nlags, method='ywunbiased'), the default in find_num_lag before. 
+
+    Args:
+        x: 1D array 
+        nlags(optional): maximum lag [default:40]
+
+    Returns: np.array
+        partial autocorrelation of lag 0 to nlags
+
+    """
+    r = cal_acf(x, nlags=nlags, adjusted=True)
+    pac = np.zeros(nlags + 1)
+    pac[0] = 1
+    # AR coefficients of the previous order
+    phi = np.zeros(0)
+    for k in range(1, nlags + 1):
+        phi_kk = (r[k] - phi @ r[k - 1:0:-1]) / (1 - phi @ r[1:k])
+        phi = np.append(phi - phi_kk * phi[::-1], phi_kk)
+        pac[k] = phi_kk
+
+    return pac
+
+
+def find_num_lag(poll_series, thres=0.5, max_lag: int = 40, city_name: str = None):
     """ Calculate the numbers of partial autocorrelation lag to add as feature to a time series.
 
+    The result is cached by city_name, pollutant name (series name) and a hash of the data.
+
+    Args:
+        poll_series: pollution series 
+        thres(optional): minimum partial autocorrelation to keep the lag [default:0.5]
+        max_lag(optional): maximum lag to consider [default:40]
+        city_name(optional): city name for the cache key [default:None]
+
+    Returns: np.array
+        lags with partial autocorrelation above thres 
+
     """
-    pac = pacf(poll_series)
-    # find the number of lag
-    idxs = np.where(pac >= 0.5)[0]
-    return idxs[1:]
+    poll_series = poll_series.dropna()
+    key = (city_name, poll_series.name, max_lag, thres,
+           pd.util.hash_pandas_object(poll_series).sum())
+    if key not in _num_lag_cache:
+        pac = cal_pacf(poll_series.values, nlags=max_lag)
+        # find the number of lag
+        idxs = np.where(pac >= thres)[0]
+        _num_lag_cache[key] = idxs[1:]
 
+    return _num_lag_cache[key]
 
-def add_lags(data, pollutant, num_lags=None):
+
+def add_lags(data, pollutant, num_lags=None, max_lag=40, city_name=None):
     """Add lags columns to x_data.
 
+    Args:
+        data: dataframe with pollutant column 
+        pollutant: name of the pollutant 
+        num_lags(optional): a list of lags to add. If None, use find_num_lag [default:None]
+        max_lag(optional): maximum lag for find_num_lag [default:40]
+        city_name(optional): city name for find_num_lag cache [default:None]
+
     """
     # calculate num lags
-    if num_lags==None:
-        num_lags = find_num_lag(data[pollutant])
+    if num_lags is None:
+        num_lags = find_num_lag(data[pollutant], max_lag=max_lag, city_name=city_name)
     
     for idx in num_lags:
         lag_name = f'{pollutant}_lag_{idx}'
@@ -138,6 +503,179 @@ def add_lags(data, pollutant, num_lags=None):
     data = data.dropna()
     return data
 
+class LagBuilder():
+    """LagBuilder object precomputes the prefix sums of the base columns once and calculates 
+    lag columns on demand. Only the requested lags and rows are materialized.
+
+    The mean of the previous n rows is the difference of two prefix sums, so each lag cost 
+    one subtraction instead of a rolling window. 
+
+    Args:
+        values: 2D array of the base columns with shape (n_rows, n_cols)
+        cols(optional): a list of base column names 
+
+    Attributes:
+        values: float64 array of the base columns
+        cols: a list of base column names
+        csum: prefix sums of the base columns with a leading row of zeros 
+        nan_count: prefix counts of nan value with a leading row of zeros 
+
+    """
+
+    def __init__(self, values, cols=None):
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            values = values.reshape(-1, 1)
+        self.values = values
+        self.n_rows, self.n_cols = values.shape
+        if cols is None:
+            cols = np.arange(self.n_cols)
+        self.cols = list(cols)
+
+        isnan = np.isnan(values)
+        self.csum = np.zeros((self.n_rows + 1, self.n_cols))
+        np.cumsum(np.where(isnan, 0, values), axis=0, out=self.csum[1:])
+        self.nan_count = np.zeros((self.n_rows + 1, self.n_cols), dtype=np.int64)
+        np.cumsum(isnan, axis=0, out=self.nan_count[1:])
+
+    def get_lag(self, lag_range, roll=True, rows=None):
+        """Calculate lag values of all base columns for every lag in lag_range.
+
+        Rows without enough previous data (or with nan in the window) are nan.
+
+        Args:
+            lag_range: list of lag value. Can be from np.arange(1,5) or [1,3, 10]
+            roll(optional): if True, calculate the rolling average of the previous n rows (rolling(n).mean().shift(1)).
+                If False, shift the data by n rows
+            rows(optional): row positions to calculate. If None, calculate all rows
+
+        Returns: np.array
+            float32 array of shape (len(rows), len(lag_range)*n_cols). Columns are grouped by lag. 
+
+        """
+        if rows is None:
+            rows = np.arange(self.n_rows)
+        rows = np.asarray(rows, dtype=np.int64)
+
+        lag_matrix = np.full((len(rows), len(lag_range) * self.n_cols), np.nan, dtype=np.float32)
+
+        for i, n in enumerate(lag_range):
+            n = int(n)
+            valid = rows >= n
+            end = rows[valid]
+            start = end - n
+            if roll:
+                # mean of the rows t-n, ..., t-1
+                lag_values = (self.csum[end] - self.csum[start]) / n
+                lag_values[(self.nan_count[end] - self.nan_count[start]) > 0] = np.nan
+            else:
+                lag_values = self.values[start]
+
+            lag_matrix[valid, i * self.n_cols:(i + 1) * self.n_cols] = lag_values
+
+        return lag_matrix
+
+    def valid_rows(self, lag_range, roll=True):
+        """Return a boolean array of the rows which has no nan in any lag columns. 
+
+        """
+        row_nan = np.zeros(self.n_rows + 1, dtype=np.int64)
+        np.cumsum(np.isnan(self.values).any(axis=1), out=row_nan[1:])
+        rows = np.arange(self.n_rows)
+        valid = np.ones(self.n_rows, dtype=bool)
+        # for rolling average, the largest window contains all the others
+        lag_list = [np.max(lag_range)] if (roll and len(lag_range) > 0) else lag_range
+        for n in lag_list:
+            n = int(n)
+            start = np.maximum(rows - n, 0)
+            if roll:
+                valid &= (rows >= n) & (row_nan[rows] - row_nan[start] == 0)
+            else:
+                valid &= (rows >= n) & (row_nan[start + 1] - row_nan[start] == 0)
+
+        return valid
+
+    def col_names(self, lag_range):
+        """Return lag column names in the same order as the columns of get_lag.
+
+        """
+        return lag_col_names(self.cols, lag_range)
+
+    def split_data_matrix(self, y, lag_range, split_ratio, roll=True, valid=None):
+        """Split the base and lag columns into x, y matrices for each set. Only gather the rows
+        without nan in the lag columns and the rows in valid.
+
+        Args:
+            y: target array with n_rows values
+            lag_range: list of lag value
+            split_ratio: porportion of data in each set. Must add up to less than or equal to one.
+            roll(optional): see get_lag [default:True]
+            valid(optional): boolean array of the rows to keep. If None, keep all rows [default:None]
+
+        Returns: list
+            a list of (x, y) matrices for each set
+
+        """
+        if valid is None:
+            valid = np.ones(self.n_rows, dtype=bool)
+        rows = np.flatnonzero(valid & self.valid_rows(lag_range, roll=roll))
+
+        split_ratio = (np.array(split_ratio) * len(rows)).astype(int)
+        split_ratio = split_ratio.cumsum()
+
+        xy_list = []
+        for split_rows in np.split(rows, split_ratio[:-1]):
+            x = np.hstack([self.values[split_rows], self.get_lag(lag_range, roll=roll, rows=split_rows)])
+            xy_list.append((x, y[split_rows]))
+
+        return xy_list
+
+
+def cal_lag_matrix(values, lag_range, roll=True):
+    """Calculate lag values of all columns for every lag in lag_range into one float32 matrix.
+
+    Args:
+        values: 2D array of data with shape (n_rows, n_cols) 
+        lag_range: list of lag value. Can be from np.arange(1,5) or [1,3, 10]
+        roll(optional): if True, calculate the rolling average of the previous n rows (rolling(n).mean().shift(1)).
+            If False, shift the data by n rows
+
+    Returns: np.array
+        float32 array of shape (n_rows, len(lag_range)*n_cols). Columns are grouped by lag. 
+
+    """
+    return LagBuilder(values).get_lag(lag_range, roll=roll)
+
+
+def lag_col_names(cols, lag_range):
+    """Return lag column names in the same order as the columns of cal_lag_matrix.
+
+    """
+    return [s + f'_lag_{n}' for n in lag_range for s in cols]
+
+
+def build_lag_data(data_org, x_cols_org, lag_range, roll=True, lag_builder=None):
+    """Add the lag columns of x_cols_org to data_org and drop the rows with nan. Same as Dataset.build_lag.
+
+    Args:
+        data_org: dataframe of the target and x_cols_org
+        x_cols_org: a list of columns to build the lag columns
+        lag_range: list of lag value
+        roll(optional): see LagBuilder.get_lag [default:True]
+        lag_builder(optional): LagBuilder object of data_org[x_cols_org]. If None, build a new one [default:None]
+
+    Returns: pd.DataFrame
+
+    """
+    if lag_builder is None:
+        lag_builder = LagBuilder(data_org[x_cols_org].values, cols=x_cols_org)
+    lag_data = pd.DataFrame(lag_builder.get_lag(lag_range, roll=roll), index=data_org.index,
+                            columns=lag_builder.col_names(lag_range))
+
+    data = pd.concat([data_org, lag_data], axis=1, ignore_index=False)
+    return data.dropna()
+
+
 # function for feature eng fire
 
 
@@ -192,6 +730,240 @@ def cal_arrival_time(
     return arrival_time.dt.round('H')
 
 
+ns_per_hour = 3600 * 10**9
+
+
+def to_epoch_hours(index):
+    """Convert a datetime index or array to an int64 array of hours since 1970-01-01 00:00.
+
+    """
+    return np.asarray(index, dtype='datetime64[ns]').astype(
+        'datetime64[h]').astype(np.int64)
+
+
+def epoch_hours_to_index(hours):
+    """Convert an array of hours since 1970-01-01 00:00 to a datetime index named 'datetime'.
+
+    """
+    return pd.DatetimeIndex(np.asarray(hours, dtype=np.int64).astype(
+        'datetime64[h]').astype('datetime64[ns]'), name='datetime')
+
+
+def hour_position(sorted_hours, hours):
+    """Return the position of the last sorted hour at or before each hour, or 0 for the hours before the first.
+
+    """
+    return np.maximum(np.searchsorted(sorted_hours, hours, side='right') - 1, 0)
+
+
+def lookup_hourly(series, hours):
+    """Look up the values of an hourly series at each hour using binary search. Use the last value
+    at or before the hour, or the first value for the hours before the series.
+
+    Args:
+        series: series with datetime index
+        hours: int64 array of hours since 1970-01-01
+
+    Returns: np.array
+        values of the series
+
+    """
+    series_hours = to_epoch_hours(series.index)
+    values = series.values
+    if np.any(np.diff(series_hours) < 0):
+        order = np.argsort(series_hours, kind='stable')
+        series_hours = series_hours[order]
+        values = values[order]
+    return values[hour_position(series_hours, hours)]
+
+
+def build_wind_table(wea):
+    """Build an hourly wind table from the weather data for the observed wind fire feature.
+
+    Args:
+        wea: weather dataframe with datetime index or 'datetime' column, 'Wind Speed(kmph)' and 'Wind' columns.
+            'Wind' is a compass direction string or degree, the direction the wind blows from
+
+    Returns: dict
+        'hours': sorted int64 hours since 1970-01-01,
+        'speed': wind speed in km/hour,
+        'direction': wind direction in degree clockwise from north. nan for CALM, VAR or missing
+
+    """
+    if 'datetime' in wea.columns:
+        wea = wea.set_index('datetime')
+    hours = to_epoch_hours(wea.index)
+    order = np.argsort(hours, kind='stable')
+
+    codes = wind_codes(wea['Wind'])[order]
+    direction = np.where((codes >= 0) & (codes < len(compass_points)), codes * 22.5, np.nan)
+
+    return {'hours': hours[order],
+            'speed': wea['Wind Speed(kmph)'].values.astype(float)[order],
+            'direction': direction}
+
+
+def cal_hotspot_bearing(fire, lat_km, long_km):
+    """Calculate the bearing of the hotspots from the city in degree clockwise from north.
+
+    Args:
+        fire: fire dataframe with 'lat_km' and 'long_km' columns in mercator km
+        lat_km: latitude of the city in mercator km
+        long_km: longitude of the city in mercator km
+
+    Returns: np.array
+
+    """
+    return np.degrees(np.arctan2(fire['long_km'].values - long_km,
+                                 fire['lat_km'].values - lat_km)) % 360
+
+
+def cal_hotspot_wind(detection_time, bearing, wind_table):
+    """Look up the observed wind of the detection hour and project it on the direction from the hotspot to the city.
+
+    The alignment is the cosine between the hotspot bearing and the direction the wind blows from.
+    1 when the wind blows from the hotspot toward the city, -1 when it blows away and 0 for a cross,
+    calm or variable wind.
+
+    Args:
+        detection_time: datetime index or array of the hotspots
+        bearing: hotspot bearing from cal_hotspot_bearing
+        wind_table: wind table from build_wind_table
+
+    Returns: (np.array, np.array)
+        observed wind speed and alignment of each hotspot
+
+    """
+    pos = hour_position(wind_table['hours'], to_epoch_hours(detection_time))
+    speed = wind_table['speed'][pos]
+    alignment = np.cos(np.radians(bearing - wind_table['direction'][pos]))
+    alignment[np.isnan(alignment)] = 0
+    return speed, alignment
+
+
+def cal_arrival_hour(detection_time, distance, wind_speed=2):
+    """ Calculate the arrival hour of the pollution at the city as hours since 1970-01-01.
+
+    Same as cal_arrival_time using integer hours instead of pandas. Round half up: floor(t + distance/wind_speed + 0.5).
+
+    Args:
+        detection_time: datetime index or array
+        distance: distance array in km
+        wind_speed(optional): approximate wind speed in km/hour. Either a number, an array with the same
+            length as distance or an hourly series with datetime index, which is looked up at the detection hour [default:2]
+
+    Returns: np.array
+        float array of the arrival hour. nan if the wind speed is zero or missing
+
+    """
+    ns = np.asarray(detection_time, dtype='datetime64[ns]').astype(np.int64)
+    hours, remain = np.divmod(ns, ns_per_hour)
+    if isinstance(wind_speed, pd.Series):
+        wind_speed = lookup_hourly(wind_speed, hours)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        travel = np.asarray(distance, dtype=float) / np.asarray(wind_speed, dtype=float)
+    travel[~np.isfinite(travel)] = np.nan
+    return hours + np.floor(remain / ns_per_hour + travel + 0.5)
+
+
+def fire_zone(distance, zone_list):
+    """Return the zone number of each hotspot, where zone i is zone_list[i] <= distance < zone_list[i+1].
+    -1 if outside all zones.
+
+    """
+    zone = np.searchsorted(zone_list, distance, side='right') - 1
+    zone[(zone >= len(zone_list) - 1) | np.isnan(distance)] = -1
+    return zone
+
+
+def cal_fire_bins(
+        fire,
+        zone_list=[0, 100, 200, 400, 800, 1000],
+        fire_col: str = 'power',
+        damp_surface: str = 'sphere',
+        w_speed=8,
+        weight=None):
+    """ Bin the damped fire power of the hotspots by arrival hour and fire zone on a dense hourly axis.
+
+    Args:
+        fire: fire dataframe with datetime index, 'distance' and fire_col columns
+        zone_list(optional): a list of distance separating the zones
+        fire_col(optional): fire power column [default:'power']
+        damp_surface(optional): either 'circle' or 'sphere' [default:'sphere']
+        w_speed(optional): wind speed in km/hour. See cal_arrival_hour [default:8]
+        weight(optional): an extra damping factor of each hotspot [default:None]
+
+    Returns: (int, np.array, np.array)
+        first arrival hour of the axis, binned power and number of hotspots with shape (hours, zones)
+
+    """
+    n_zone = len(zone_list) - 1
+    distance = fire['distance'].values.astype(float)
+    zone = fire_zone(distance, zone_list)
+    arrival = cal_arrival_hour(fire.index, distance, wind_speed=w_speed)
+    keep = (zone >= 0) & ~np.isnan(arrival)
+    if not keep.any():
+        return 0, np.zeros((0, n_zone)), np.zeros((0, n_zone), dtype=np.int64)
+
+    arrival = arrival[keep].astype(np.int64)
+    zone = zone[keep]
+    damp = cal_power_damp(fire[fire_col].values[keep], distance[keep], surface=damp_surface)
+    if weight is not None:
+        damp = damp * weight[keep]
+
+    start = arrival.min()
+    n_hours = arrival.max() - start + 1
+    codes = (arrival - start) * n_zone + zone
+    bins = np.bincount(codes, weights=damp, minlength=n_hours * n_zone).reshape(n_hours, n_zone)
+    counts = np.bincount(codes, minlength=n_hours * n_zone).reshape(n_hours, n_zone)
+    return start, bins, counts
+
+
+def _zone_axis(counts):
+    # first and last hour with hotspots of each zone. first is the number of hours for empty zones
+    has_fire = counts > 0
+    n_hours = len(counts)
+    if n_hours == 0:
+        return np.zeros(counts.shape[1], dtype=np.int64), np.full(counts.shape[1], -1)
+    first = np.where(has_fire.any(axis=0), has_fire.argmax(axis=0), n_hours)
+    last = n_hours - 1 - has_fire[::-1].argmax(axis=0)
+    return first, last
+
+
+def roll_fire_bins(bins, counts, roll: int = 48, shift: int = 0):
+    """ Rolling sum and shift the binned fire power of each zone. Same as resample('h'), rolling(roll).sum()
+    and shift(shift) of each zone separately.
+
+    Each zone has its own hourly axis from its first to its last arrival hour. The values outside
+    that axis, the first roll-1 hours and the hours shifted in are nan.
+
+    Args:
+        bins: binned power with shape (hours, zones) from cal_fire_bins
+        counts: number of hotspots with the same shape
+        roll(optional): rolling window size [default:48]
+        shift(optional): number of hours to shift [default:0]
+
+    Returns: np.array
+        fire feature with the same shape as bins
+
+    """
+    n_hours, n_zone = bins.shape
+    hour_idx = np.arange(n_hours)[:, None]
+    first, last = _zone_axis(counts)
+
+    # rolling sum from the prefix sums. Windows without hotspots are exactly zero
+    csum = np.vstack([np.zeros((1, n_zone)), np.cumsum(bins, axis=0)])
+    ccount = np.vstack([np.zeros((1, n_zone), dtype=np.int64), np.cumsum(counts, axis=0)])
+    lower = np.maximum(hour_idx + 1 - roll, 0)
+    rolled = csum[hour_idx + 1, np.arange(n_zone)] - csum[lower, np.arange(n_zone)]
+    rolled[(ccount[hour_idx + 1, np.arange(n_zone)] - ccount[lower, np.arange(n_zone)]) == 0] = 0
+
+    source = hour_idx - shift
+    valid = (hour_idx >= first) & (hour_idx <= last) & (source >= first + roll - 1) & (source <= last)
+    return np.where(valid, rolled[np.clip(source, 0, max(n_hours - 1, 0)), np.arange(n_zone)], np.nan)
+
+
 def shift_fire(
     fire_df: pd.core.frame.DataFrame,
     fire_col: str = 'power',
@@ -204,32 +976,28 @@ def shift_fire(
     """ Feature engineer fire data. Account of the distance from the source and time lag using wind speed.
 
     Args:
-        fire_df:
-        fire_col
-        damp_surface
-        shift
-        roll
+        fire_df: fire dataframe with datetime index, 'distance' and fire_col columns
+        fire_col: fire power column
+        damp_surface: either 'circle' or 'sphere'
+        shift: number of hours to shift
+        roll: rolling window size
+        w_speed: wind speed in km/hour. Either a number, an array with the same length as fire_df
+            or an hourly series with datetime index
+
+    Returns: pd.Series
+        hourly fire feature indexed by the arrival time
 
     """
     require_cols = ['distance', fire_col]
-    if fire_df.columns.isin(require_cols).sum() > len(require_cols):
+    if fire_df.columns.isin(require_cols).sum() < len(require_cols):
         raise AssertionError(
             'missing required columns for feature engineering fire data')
 
-    # calculate the damping factors
-    fire_df['damp_' + fire_col] = cal_power_damp(
-        fire_df[fire_col], fire_df['distance'], surface=damp_surface)
-    # calculate particle arrival time
-    fire_df['arrival_time'] = cal_arrival_time(
-        detection_time=fire_df.index,
-        distance=fire_df['distance'],
-        wind_speed=w_speed)
-    fire_df = fire_df.set_index('arrival_time')
-    fire_df = fire_df.resample('h').sum()['damp_' + fire_col]
-    fire_df = fire_df.rolling(roll).sum()
-    fire_df = fire_df.shift(shift)
-    fire_df.index.name = 'datetime'
-    return fire_df
+    start, bins, counts = cal_fire_bins(fire_df, zone_list=[-np.inf, np.inf], fire_col=fire_col,
+                                        damp_surface=damp_surface, w_speed=w_speed)
+    fire_s = roll_fire_bins(bins, counts, roll=roll, shift=shift)[:, 0]
+    return pd.Series(fire_s, index=epoch_hours_to_index(start + np.arange(len(fire_s))),
+                     name='damp_' + fire_col)
 
 
 def get_fire_feature(
@@ -247,58 +1015,200 @@ def get_fire_feature(
         roll: int = 48,
         w_speed: (
             float,
-        int) = 8):
+        int) = 8,
+        hotspot_wind=None):
     """ Separate fire from different distance
 
+    Bin all zones on one hourly axis with cal_fire_bins, then roll and shift each zone with roll_fire_bins.
+    The missing values are filled with zero.
+
+    With the observed wind, the hotspot moves toward the city at the observed wind speed projected on
+    the hotspot direction, but no slower than w_speed. The power is also damped by (1 + alignment)/2, so
+    the hotspots downwind of the city contribute less.
+
+    Args:
+        hotspot_wind(optional): (speed, alignment) of each hotspot from cal_hotspot_wind. If None, use the
+            constant w_speed [default:None]
+
     """
-    fire_col_list = []
-    new_fire = pd.DataFrame()
-    for start, stop in zip(zone_list, zone_list[1:]):
-        col_name = f'fire_{start}_{stop}'
-
-        fire_col_list.append(col_name)
-        # select sub-data baseline the distance
-        fire_s = fire[(fire['distance'] < stop) & (
-            fire['distance'] >= start)][[fire_col, 'distance']].copy()
-        fire_s = shift_fire(
-            fire_s,
-            fire_col=fire_col,
-            damp_surface=damp_surface,
-            shift=shift,
-            roll=roll,
-            w_speed=w_speed)
-        fire_s.name = col_name
-        new_fire = pd.concat([new_fire, fire_s], axis=1, ignore_index=False)
-
-    new_fire = new_fire.fillna(0)
-    new_fire.index.name = 'datetime'
+    fire_col_list = [f'fire_{start}_{stop}' for start, stop in zip(zone_list, zone_list[1:])]
+
+    weight = None
+    if hotspot_wind is not None:
+        speed, alignment = hotspot_wind
+        # fmax replaces the missing wind speed with w_speed
+        w_speed = np.fmax(speed * alignment, w_speed)
+        weight = (1 + alignment) / 2
+
+    start, bins, counts = cal_fire_bins(fire, zone_list=zone_list, fire_col=fire_col,
+                                        damp_surface=damp_surface, w_speed=w_speed, weight=weight)
+    new_fire = roll_fire_bins(bins, counts, roll=roll, shift=shift)
+    new_fire = pd.DataFrame(np.nan_to_num(new_fire, nan=0), columns=fire_col_list,
+                            index=epoch_hours_to_index(start + np.arange(len(new_fire))))
+    # keep the hours inside the axis of any zone
+    first, last = _zone_axis(counts)
+    hour_idx = np.arange(len(new_fire))[:, None]
+    new_fire = new_fire[((hour_idx >= first) & (hour_idx <= last)).any(axis=1)]
+
     return new_fire, fire_col_list
 
 
-def sep_fire_zone(fire, fire_col, zone_list=[0, 100, 200, 400, 800, 1000]):
+def merge_fire_feature(data_no_fire, fire, fire_dict, zone_list=[0, 100, 200, 400, 800, 1000],
+                       damp_surface='sphere', hotspot_wind=None):
+    """ Calculate the fire feature using the parameters in fire_dict and merge with the data without fire.
+    Same as Dataset.merge_fire without changing the dataset.
+
+    Args:
+        data_no_fire: processed pollution and weather data
+        fire: fire dataframe
+        fire_dict: fire dictionary with 'w_speed', 'shift' and 'roll' keys
+        zone_list(optional): a list of distance separating the zones
+        damp_surface(optional): either 'circle' or 'sphere' [default:'sphere']
+        hotspot_wind(optional): see get_fire_feature [default:None]
+
+    Returns: (pd.DataFrame, list)
+        merged data without nan and a list of fire columns
+
+    """
+    fire_proc, fire_cols = get_fire_feature(fire, zone_list=zone_list,
+                                            fire_col='power', damp_surface=damp_surface,
+                                            shift=fire_dict['shift'], roll=fire_dict['roll'],
+                                            w_speed=fire_dict['w_speed'], hotspot_wind=hotspot_wind)
+
+    data = data_no_fire.merge(fire_proc, left_index=True, right_index=True, how='inner')
+    data = data.dropna()
+    data = data.loc[~data.index.duplicated(keep='first')]
+    return data, fire_cols
+
+
+# resolution of the fire aggregate pyramid. Map level to (hours per period, first hour of period 0)
+# weeks start on Monday 1969-12-29, 72 hours before 1970-01-01
+fire_levels = {'hourly': (1, 0),
+               'daily': (24, 0),
+               'weekly': (168, -72)}
+
+
+def cal_fire_pyramid(fire, zone_list=[0, 100, 200, 400, 800, 1000], fire_cols=['power', 'count'], levels=None):
+    """ Aggregate the hotspots by detection time and fire zone at the resolutions in fire_levels.
+
+    The hourly level is binned from the hotspots with np.bincount. The other levels are summed from the hourly level.
+    The last zone column holds the hotspots outside zone_list, so the sum over all columns is the total.
+
+    Args:
+        fire: fire dataframe with datetime index, 'distance' and fire_cols columns
+        zone_list(optional): a list of distance separating the zones
+        fire_cols(optional): a list of columns to aggregate [default:['power', 'count']]
+        levels(optional): a list of levels to calculate. If None, calculate all levels in fire_levels [default:None]
+
+    Returns: dict
+        'zone_list', and for each level
+            '{level}_start': the first hour of the first period since 1970-01-01,
+            '{level}_{col}': sums of each fire col with shape (periods, zones + 1),
+            '{level}_n': number of hotspots with the same shape
+
+    """
+    if levels is None:
+        levels = list(fire_levels.keys())
+    n_zone = len(zone_list)
+    zone = fire_zone(fire['distance'].values.astype(float), zone_list)
+    zone[zone < 0] = n_zone - 1
+    hours = to_epoch_hours(fire.index)
+
+    pyramid = {'zone_list': np.array(zone_list)}
+    if len(hours) == 0:
+        for level in levels:
+            pyramid[level + '_start'] = 0
+            for col in fire_cols + ['n']:
+                pyramid[f'{level}_{col}'] = np.zeros((0, n_zone))
+        return pyramid
+
+    start = hours.min()
+    n_hours = hours.max() - start + 1
+    codes = (hours - start) * n_zone + zone
+    hourly = {'n': np.bincount(codes, minlength=n_hours * n_zone).reshape(n_hours, n_zone)}
+    for col in fire_cols:
+        hourly[col] = np.bincount(codes, weights=np.nan_to_num(fire[col].values.astype(float)),
+                                  minlength=n_hours * n_zone).reshape(n_hours, n_zone)
+
+    for level in levels:
+        step, offset = fire_levels[level]
+        if step == 1:
+            pyramid[level + '_start'] = start
+            pyramid.update({f'{level}_{col}': values for col, values in hourly.items()})
+            continue
+        # period of each hour on the dense hourly axis. The axis has no gap, so the periods are contiguous
+        period = (start + np.arange(n_hours) - offset) // step
+        first_row = np.flatnonzero(np.r_[True, np.diff(period) > 0])
+        pyramid[level + '_start'] = period[0] * step + offset
+        for col, values in hourly.items():
+            pyramid[f'{level}_{col}'] = np.add.reduceat(values, first_row, axis=0)
+
+    return pyramid
+
+
+def get_pyramid_level(pyramid, fire_col='power', level='hourly', total=False):
+    """ Return one level of the fire aggregate pyramid as a dataframe.
+
+    Args:
+        pyramid: fire aggregate pyramid from cal_fire_pyramid
+        fire_col(optional): aggregated fire column or 'n' for the number of hotspots [default:'power']
+        level(optional): 'hourly', 'daily' or 'weekly' [default:'hourly']
+        total(optional): if True, return the sum of all hotspots including the ones outside the zones [default:False]
+
+    Returns: (pd.DataFrame, list)
+        fire data with each column a zone and a list of column names
+
+    Raises:
+        AssertionError: if the level is not in fire_levels
+
+    """
+    if level not in fire_levels:
+        raise AssertionError(f'level must be one of {list(fire_levels.keys())}')
+
+    step, _ = fire_levels[level]
+    values = pyramid[f'{level}_{fire_col}']
+    index = epoch_hours_to_index(pyramid[level + '_start'] + step * np.arange(len(values)))
+
+    if total:
+        col_list = [fire_col]
+        values = values.sum(axis=1, keepdims=True)
+    else:
+        zone_list = pyramid['zone_list']
+        col_list = [f'fire_{start}_{stop}' for start, stop in zip(zone_list, zone_list[1:])]
+        values = values[:, :-1]
+
+    return pd.DataFrame(values, index=index, columns=col_list), col_list
+
+
+def sep_fire_zone(fire, fire_col, zone_list=[0, 100, 200, 400, 800, 1000], pyramid=None):
     """ Separate fire data into zone mark by a distance in the zone_list without perform feature enginering.
     Use for data visualization
 
+    Read the hourly level of the fire aggregate pyramid. If pyramid is None, bin the hotspots with cal_fire_pyramid.
+    Dataset.sep_fire_zone uses the saved pyramid of the dataset.
+
     Args:
-        fire: fire dataframe
+        fire: fire dataframe. Not used if pyramid is given
         fire_col: 'power' or 'count'
         zone_list:
+        pyramid(optional): fire aggregate pyramid with the hourly level and the same zone_list [default:None]
 
     Return:
         new_fire: a dataframe with each column, a fire data in that zone
         fire_col_list: a list of column name
 
     """
-    fire_col_list = []
-    new_fire = pd.DataFrame()
-    for start, stop in zip(zone_list, zone_list[1:]):
-        col_name = f'fire_{start}_{stop}'
-        fire_col_list.append(col_name)
-        # select sub-data baseline the distance
-        fire_s = fire[(fire['distance'] < stop) & (
-            fire['distance'] >= start)][[fire_col]].copy()
-        fire_s.columns = [col_name]
-        fire_s = fire_s.resample('h').sum()
-        new_fire = pd.concat([new_fire, fire_s], axis=1, ignore_index=False)
+    if pyramid is None:
+        pyramid = cal_fire_pyramid(fire, zone_list=zone_list, fire_cols=[fire_col], levels=['hourly'])
+    elif not np.array_equal(pyramid['zone_list'], zone_list):
+        raise AssertionError('the pyramid has a different zone_list')
+    new_fire, fire_col_list = get_pyramid_level(pyramid, fire_col=fire_col, level='hourly')
 
-    return new_fire, fire_col_list
+    # each zone has the hourly axis from its first to its last hotspot. The other hours are nan
+    counts = pyramid['hourly_n'][:, :-1]
+    first, last = _zone_axis(counts)
+    hour_idx = np.arange(len(new_fire))[:, None]
+    in_axis = (hour_idx >= first) & (hour_idx <= last)
+    new_fire = new_fire.where(in_axis)
+
+    return new_fire[in_axis.any(axis=1)], fire_col_list
@@ -4,6 +4,7 @@ from ..gen_functions import *
 from ..data.read_data import *
 from ..data.fire_data import *
 from ..data.weather_data import *
+from ..data.holiday_data import *
 from .build_features import *
 
 """Pollution Dataset Object of a particular city. This object is contains the raw dataset 
@@ -52,6 +53,11 @@ class Dataset():
     city_wea_dict = {'Chiang Mai': 'Mueang Chiang Mai',
                      'Bangkok': 'Bangkok',
                      'Hanoi': 'Soc Son'}
+    # mapping city name to the country of the holiday calendar
+    city_country_dict = {'Chiang Mai': 'thailand',
+                         'Bangkok': 'thailand',
+                         'Hanoi': 'vietnam',
+                         'Jakarta': 'indonesia'}
 
     transition_dict = { 'PM2.5': [0, 35.5, 55.4, 150.4, 1e3],
     'PM10': [0, 155, 254, 354, 1e3],
@@ -378,6 +384,7 @@ class Dataset():
 
         # save fire data
         fire.to_csv(filename)
+        self.fire_file = filename
 
     def build_weather(self, wea_data_folder: str = 'weather_cities/'):
         """Load weather data and fill the missing value. Add as wea attibute.
@@ -397,36 +404,29 @@ class Dataset():
 
         self.wea = wea
 
-    def build_holiday(self):
-        """Scrape holiday data from https://www.timeanddate.com/holidays/ since 2000 until current.
+    def build_holiday(self, refresh: bool = False):
+        """Build holiday data since 2000 until next year from the bundled holiday calendar. 
 
-        Save the data as data_folder/holiday.csv
-
-        """
-        if self.city_name == 'Chiang Mai' or self.city_name == 'Bangkok':
-            head_url = 'https://www.timeanddate.com/holidays/thailand/'
+        The bundled calendar does not require network access. If refresh is True, also scrape holiday data 
+        from https://www.timeanddate.com/holidays/ and add to the bundled holidays.
 
-        elif self.city_name == 'Jakarta':
-            head_url = 'https://www.timeanddate.com/holidays/indonesia/'
-
-        elif self.city_name == 'Hanoi':
-            head_url = 'https://www.timeanddate.com/holidays/vietnam/'
+        Save the data as data_folder/holiday.csv
 
-        years = np.arange(2000, datetime.now().year + 1)
+        Args:
+            refresh(optional): if True, also scrape the holiday data[default:False]
 
-        holiday = pd.DataFrame()
+        """
+        country = self.city_country_dict[self.city_name]
+        years = np.arange(2000, datetime.now().year + 2)
 
-        for year in years:
-            url = head_url + str(year)
-            df = pd.read_html(url)[0]
-            df['year'] = year
-            holiday = pd.concat([holiday, df], ignore_index=True)
+        holiday = build_holiday_table(country, years)
 
-        holiday.columns = ['Date', 'day_of_week', 'name', 'type', 'year']
-        holiday = holiday[~holiday['Date'].isna()]
+        if refresh:
+            scraped = scrape_holiday(country, years[:-1])
+            holiday = pd.concat([holiday, scraped], ignore_index=True)
+            holiday = holiday.drop_duplicates(['date', 'type'], keep='last')
+            holiday = holiday.sort_values('date')
 
-        holiday['date'] = holiday['Date'] + ', ' + holiday['year'].astype(str)
-        holiday['date'] = pd.to_datetime(holiday['date'])
         holiday.to_csv(self.data_folder + 'holiday.csv', index=False)
 
     def build_all_data(
@@ -439,7 +439,7 @@ class Dataset():
 
         Args: 
             build_fire(optional): if True, also build the fire data[default:False]
-            build_holiday(optional): if True, also build the holiday data[default:False]
+            build_holiday(optional): if True, also refresh the holiday data by scraping[default:False]
 
         """
         self.build_pollution()
@@ -450,7 +450,7 @@ class Dataset():
             self.build_fire()
 
         if build_holiday:
-            self.build_holiday()
+            self.build_holiday(refresh=True)
 
         self.save_()
 
@@ -458,7 +458,7 @@ class Dataset():
         """Assemble pollution data, datetime and weather data. Omit the fire data for later step.
 
         #. Call self.load_() to load processed data 
-        #. Build holiday data if not already exist 
+        #. Build holiday data from the bundled calendar if not already exist 
         #. Add pollutant as pollutant attribute 
 
         Args:
@@ -484,54 +484,141 @@ class Dataset():
         if pollutant not in self.poll_df.columns:
             raise AssertionError(f'No {pollutant} data')
         self.pollutant = pollutant
-        cols = [
-            pollutant,
-            'Temperature(C)',
-            'Humidity(%)',
-            'Wind',
-            'Wind Speed(kmph)',
-            'Condition']
-        # merge pollution and wind data
 
         if 'datetime' in self.wea.columns:
             self.wea.set_index('datetime',inplace=True)
 
-        data = self.poll_df.merge(
-            self.wea,
-            left_index=True,
-            right_index=True,
-            how='inner')
-
-        # select data and drop null value
-        data = data[cols]
-        data[pollutant] = data[pollutant].rolling(rolling_win, min_periods=0).mean().round(1)
-        data = data.dropna()
-
         if (pollutant == 'PM2.5') and self.city_name == 'Chiang Mai':
-            data = data.loc['2010':]
-        # add lag information
-        # data = add_lags(data, pollutant)
-        # one hot encode wind data
-        dummies = wind_to_dummies(data['Wind'])
-        data.drop('Wind', axis=1, inplace=True)
-        data = pd.concat([data, dummies], axis=1)
-        data = add_is_rain(data)
-        data = add_calendar_info(
-            data, holiday_file=self.data_folder + 'holiday.csv')
-        try:
-            data = data.astype(float)
-        except BaseException:
-            raise AssertionError('some data cannot be convert to float')
+            start_date = '2010'
+        else:
+            start_date = None
 
-        # find duplicate index and drop them
-        data.sort_index(inplace=True)
-        data = data.loc[~data.index.duplicated(keep='first')]
+        # merge pollution and weather data, and add wind, rain and calendar information into one float32 matrix
+        data = build_feature_no_fire(self.poll_df, self.wea, pollutant, holiday_file=self.data_folder + 'holiday.csv',
+                                     rolling_win=rolling_win, start_date=start_date)
 
         print('data no fire has shape', data.shape)
         self.data_no_fire = data
 
+    def get_zone_list(self):
+        """Return a list of the distance in km separating the fire zones for this city.
+
+        """
+        if self.city_name == 'Chiang Mai':
+            return [0, 100, 200, 400, 700, 1000]
+        else:
+            return [0, 100, 200, 400, 800, 1000]
+
+    def get_hotspot_wind(self):
+        """Return the observed wind speed and the alignment of the wind with the hotspot direction for each hotspot.
+
+        See cal_hotspot_wind. The result is computed once and reused until self.fire or self.wea change.
+
+        Returns: (np.array, np.array)
+            observed wind speed and alignment of each hotspot in self.fire
+
+        """
+        if (not hasattr(self, 'hotspot_wind')) or (self._hotspot_wind_source[0] is not self.fire) or (
+                self._hotspot_wind_source[1] is not self.wea):
+            bearing = cal_hotspot_bearing(self.fire, self.city_info['lat_km'], self.city_info['long_km'])
+            self.hotspot_wind = cal_hotspot_wind(self.fire.index, bearing, build_wind_table(self.wea))
+            self._hotspot_wind_source = (self.fire, self.wea)
+
+        return self.hotspot_wind
+
+    def load_fire_pyramid(self, zone_list=None):
+        """Load the fire aggregate pyramid of the fire file. See cal_fire_pyramid.
+
+        The pyramid is saved next to the fire file as a compressed npz file and rebuilt when the modification time
+        or size of the fire file, or the zone list change. Add as fire_pyramid attribute.
+
+        Args:
+            zone_list(optional): a list of distance separating the zones. If None, use self.get_zone_list() [default:None]
+
+        Returns: dict
+            fire aggregate pyramid
+
+        """
+        if zone_list is None:
+            zone_list = self.get_zone_list()
+
+        if not hasattr(self, 'fire_file'):
+            # no fire file, for example the fire data is set by hand. Build in memory once for this self.fire
+            pyramid = getattr(self, 'fire_pyramid', None)
+            if (pyramid is None) or (self._fire_pyramid_source is not self.fire) or (
+                    not np.array_equal(pyramid['zone_list'], zone_list)):
+                self.fire_pyramid = cal_fire_pyramid(self.fire, zone_list=zone_list)
+                self._fire_pyramid_source = self.fire
+            return self.fire_pyramid
+
+        stat = os.stat(self.fire_file)
+        source = np.array([stat.st_mtime_ns, stat.st_size])
+
+        def is_valid(pyramid):
+            return (pyramid is not None) and np.array_equal(pyramid['source'], source) and np.array_equal(
+                pyramid['zone_list'], zone_list)
+
+        pyramid = getattr(self, 'fire_pyramid', None)
+        if is_valid(pyramid):
+            return pyramid
+
+        pyramid_file = self.fire_file.replace('.csv', '_pyramid.npz')
+        if os.path.exists(pyramid_file):
+            with np.load(pyramid_file) as f:
+                pyramid = dict(f)
+
+        if not is_valid(pyramid):
+            pyramid = cal_fire_pyramid(self.fire, zone_list=zone_list)
+            pyramid['source'] = source
+            np.savez_compressed(pyramid_file, **pyramid)
+
+        self.fire_pyramid = pyramid
+        return pyramid
+
+    def get_fire_agg(self, fire_col='power', level='daily', zone_list=None, total=False):
+        """Return the fire data of each zone aggregated at the level from the fire aggregate pyramid.
+
+        Same as sep_fire_zone or resampling self.fire, without reading the hotspots.
+
+        Args:
+            fire_col(optional): 'power', 'count' or 'n' for the number of hotspots [default:'power']
+            level(optional): 'hourly', 'daily' or 'weekly' [default:'daily']
+            zone_list(optional): a list of distance separating the zones. If None, use self.get_zone_list() [default:None]
+            total(optional): if True, return the sum of all hotspots [default:False]
+
+        Returns: (pd.DataFrame, list)
+            fire data with each column a zone and a list of column names
+
+        Examples:
+            fire_day, _ = dataset.get_fire_agg('count', level='daily', total=True)
+
+        """
+        pyramid = self.load_fire_pyramid(zone_list=zone_list)
+        return get_pyramid_level(pyramid, fire_col=fire_col, level=level, total=total)
+
+    def sep_fire_zone(self, fire_col='power', zone_list=None):
+        """Separate the fire data into zones using the saved fire aggregate pyramid. See sep_fire_zone.
+
+        Args:
+            fire_col(optional): 'power' or 'count' [default:'power']
+            zone_list(optional): a list of distance separating the zones. If None, use self.get_zone_list() [default:None]
+
+        Returns: (pd.DataFrame, list)
+            hourly fire data with each column a zone and a list of column names
+
+        """
+        if zone_list is None:
+            zone_list = self.get_zone_list()
+        pyramid = self.load_fire_pyramid(zone_list=zone_list)
+        return sep_fire_zone(self.fire, fire_col, zone_list=zone_list, pyramid=pyramid)
+
     def merge_fire(self, fire_dict=None, damp_surface='sphere'):
         """Process raw hotspot data into fire feature and merge with the rest of the data
+
+        If fire_dict['wind'] is 'observed', use the observed hourly wind speed and direction in self.wea
+        for the arrival time and damping of each hotspot, and use fire_dict['w_speed'] as the minimum speed.
+        See get_fire_feature.
+
         Args:
             fire_dict(optional): fire dictionary [default:None]
 
@@ -543,25 +630,15 @@ class Dataset():
             fire_dict = {'w_speed': 7, 'shift': -5, 'roll': 44}
             self.fire_dict = fire_dict
 
-        if self.city_name == 'Chiang Mai':
-            zone_list = [0, 100, 200, 400, 700, 1000]
-        else:
-            zone_list = [0, 100, 200, 400, 800, 1000]
+        zone_list = self.get_zone_list()
 
-         
-        fire_proc, fire_cols = get_fire_feature(self.fire, zone_list=zone_list,
-                                        fire_col='power', damp_surface=damp_surface,
-                                        shift=fire_dict['shift'], roll=fire_dict['roll'], w_speed=fire_dict['w_speed'])
+        hotspot_wind = None
+        if fire_dict.get('wind', 'constant') == 'observed':
+            hotspot_wind = self.get_hotspot_wind()
 
         # merge with fire data
-        data = self.data_no_fire.merge(
-            fire_proc,
-            left_index=True,
-            right_index=True,
-            how='inner')
-        data = data.dropna()
-        data = data.loc[~data.index.duplicated(keep='first')]
-        self.data = data
+        self.data, fire_cols = merge_fire_feature(self.data_no_fire, self.fire, fire_dict, zone_list=zone_list,
+                                                  damp_surface=damp_surface, hotspot_wind=hotspot_wind)
         return fire_cols, zone_list
 
     def make_diff_col(self):
@@ -650,22 +727,56 @@ class Dataset():
             roll(optional): if True, use the calculate the rolling average of previous values and shift 1
 
         """
-        
-        lag_list = [self.data_org]
-        for n in lag_range:
-            lag_df = self.data_org[self.x_cols_org].copy()
-            lag_df.columns = [ s+ f'_lag_{n}' for s in lag_df.columns] 
-            if roll:
-                # calculate the rolling average
-                lag_df = lag_df.rolling(n,min_periods=None).mean()
-                lag_df = lag_df.shift(1)
-            else:
-                lag_df = lag_df.shift(n)
 
-            lag_list.append(lag_df)
-        
-        self.data = pd.concat(lag_list, axis=1, ignore_index=False)
-        self.data = self.data.dropna()
+        self.data = build_lag_data(self.data_org, self.x_cols_org, lag_range, roll=roll,
+                                   lag_builder=self.get_lag_builder())
+
+    def get_lag_builder(self):
+        """Return the LagBuilder object of self.data_org[self.x_cols_org]. 
+
+        The prefix sums are computed once and reused until data_org or x_cols_org change. 
+
+        """
+        if (not hasattr(self, 'lag_builder')) or (self._lag_source is not self.data_org) or (
+                self.lag_builder.cols != list(self.x_cols_org)):
+            self.lag_builder = LagBuilder(self.data_org[self.x_cols_org].values, cols=self.x_cols_org)
+            self._lag_source = self.data_org
+
+        return self.lag_builder
+
+    def get_lag_valid(self):
+        """Return a boolean array of the rows of self.data_org without nan.
+
+        """
+        return ~np.isnan(self.data_org.values.astype(float)).any(axis=1)
+
+    def get_lag_data_matrix(self, lag_range:list, split_ratio:list, roll=True):
+        """Split the data with lag columns into x, y matrices without building self.data.
+
+        Give the same matrices as calling self.build_lag, self.split_data and self.get_data_matrix
+        using all columns, but only gather the rows and lag columns needed. Use for searching lag parameters.
+
+        Args:
+            lag_range: list of lag value to add. Can be from np.arange(1,5) or [1,3, 10]
+            split_ratio: porportion of data in each set. Must add up to less than or equal to one.
+            roll(optional): if True, use the calculate the rolling average of previous values and shift 1
+
+        Returns:
+            xy_list: a list of (x, y) matrices for each set 
+            x_cols: data columns
+
+        """
+        if np.sum(split_ratio) > 1:
+            raise AssertionError(
+                'The sum of the splitting ratios must not exceed 1')
+
+        lag_builder = self.get_lag_builder()
+        # keep the rows without nan, same as self.data.dropna()
+        xy_list = lag_builder.split_data_matrix(self.data_org[self.monitor].values, lag_range, split_ratio, roll=roll,
+                                                valid=self.get_lag_valid())
+
+        x_cols = list(self.x_cols_org) + lag_builder.col_names(lag_range)
+        return xy_list, x_cols
 
 
     def save_(self):
@@ -762,6 +873,7 @@ class Dataset():
             self.fire = pd.read_csv(filename)
             self.fire['datetime'] = pd.to_datetime(self.fire['datetime'])
             self.fire.set_index('datetime', inplace=True)
+            self.fire_file = filename
         else:
             print('no fire data. Call self.build_fire first')
 
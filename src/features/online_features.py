@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+from ..imports import *
+from .build_features import *
+from collections import deque
+
+"""Online feature state for near real-time prediction. Update the features one hour at a time
+instead of rebuilding the data from the full history.
+
+"""
+
+
+class OnlineFeatures():
+    """OnlineFeatures object keeps the minimal rolling buffers to build the model features of a new hour
+    in constant time. The features are the same as the batch pipeline: Dataset.feature_no_fire,
+    Dataset.merge_fire and Dataset.build_lag.
+
+    The buffers are
+        - the last rolling_win pollution values for the pollutant rolling average
+        - the damped fire power binned by arrival hour for the fire zones, long enough for the roll window
+        - the prefix sums of the last n_max rows of data for the lag columns, rebased on the oldest row
+          every n_max rows so that the sums do not grow with the length of the stream
+
+    When fire_dict['shift'] is negative, the fire feature of an hour depends on hotspots detected up to -shift hours later,
+    so the features of an hour are returned -shift hours after its data is added.
+
+    Args:
+        dataset: dataset object with pollutant, fire_dict, lag_dict, x_cols_org and x_cols attributes.
+            For example, the dataset from load_model1
+        rolling_win(optional): rolling windows size of the pollutant. If None, use dataset.roll_dict [default:None]
+        damp_surface(optional): damping surface of the fire power [default:'sphere']
+        fire_col(optional): fire power column [default:'power']
+
+    Attributes:
+        dataset: dataset object
+        cols: data no fire columns
+        fire_cols: fire columns
+        lag_range: a list of lag
+        delay: number of hours between adding the data and returning the features of that hour
+        last_hour: the last hour added
+
+    Raises:
+        AssertionError: if dataset.fire_dict use the observed wind
+
+    """
+
+    def __init__(self, dataset, rolling_win: int = None, damp_surface: str = 'sphere', fire_col: str = 'power'):
+
+        self.dataset = dataset
+        self.pollutant = dataset.pollutant
+        if rolling_win is None:
+            rolling_win = dataset.roll_dict[self.pollutant]
+        self.rolling_win = rolling_win
+        self.holiday_file = dataset.data_folder + 'holiday.csv'
+        self.damp_surface = damp_surface
+        self.fire_col = fire_col
+
+        self.cols = no_fire_cols(self.pollutant)
+        self.zone_list = dataset.get_zone_list()
+        self.fire_cols = [f'fire_{start}_{stop}' for start, stop in zip(self.zone_list, self.zone_list[1:])]
+
+        fire_dict = dataset.fire_dict
+        if fire_dict.get('wind', 'constant') != 'constant':
+            raise AssertionError('OnlineFeatures only support the constant wind speed fire feature')
+        self.w_speed = fire_dict['w_speed']
+        self.shift = int(fire_dict['shift'])
+        self.roll = int(fire_dict['roll'])
+        self.delay = max(0, -self.shift)
+
+        self.lag_range = np.arange(1, dataset.lag_dict['n_max'], dataset.lag_dict['step'])
+        self.lag_roll = dataset.lag_dict['roll']
+        self.x_cols_org = list(dataset.x_cols_org)
+        self.x_cols = list(dataset.x_cols)
+        self.lag_cols = lag_col_names(self.x_cols_org, self.lag_range)
+        max_lag = int(np.max(self.lag_range)) if len(self.lag_range) > 0 else 0
+
+        # pollution values of the last rolling_win hours with both pollution and weather data
+        self.poll_buffer = deque(maxlen=self.rolling_win)
+        # data no fire rows waiting for the fire feature. Map hour to row
+        self.pending = {}
+
+        # damped fire power binned by the arrival hour. The ring must cover the roll window and the hotspots
+        # which have not arrived yet
+        horizon = int(np.ceil(self.zone_list[-1] / self.w_speed)) + 1
+        self.ring_len = horizon + self.roll + abs(self.shift) + self.delay + 2
+        self.fire_ring = np.zeros((self.ring_len, len(self.fire_cols)))
+        self.ring_hour = np.full(self.ring_len, np.iinfo(np.int64).min, dtype=np.int64)
+
+        # prefix sums (or rows for shifted lag) of the last max_lag rows of x_cols_org
+        self.lag_csum = deque([np.zeros(len(self.x_cols_org))], maxlen=max_lag + 1)
+        self.lag_rows = deque(maxlen=max(max_lag, 1))
+        self.n_since_rebase = 0
+
+        self.last_hour = None
+
+    def history_hours(self):
+        """Return the number of hours of history needed to fill all buffers.
+
+        Use twice the lag and rolling windows to allow for missing hours.
+
+        """
+        max_lag = self.lag_csum.maxlen - 1
+        return self.ring_len + 2 * (max_lag + self.rolling_win) + self.delay
+
+    def warm_up(self, end_time=None):
+        """Fill the buffers by replaying the history of dataset.poll_df, dataset.wea and dataset.fire up to end_time.
+
+        Args:
+            end_time(optional): last hour to replay. If None, use the last hour of the pollution data [default:None]
+
+        Returns: pd.DataFrame
+            features of the replayed hours. The first rows are built from a partial history and may differ
+            from the batch pipeline
+
+        """
+        dataset = self.dataset
+        wea = dataset.wea
+        if 'datetime' in wea.columns:
+            wea = wea.set_index('datetime')
+
+        if end_time is None:
+            end_time = dataset.poll_df.index.max()
+        end_time = pd.Timestamp(end_time).floor('h')
+        start_time = end_time - pd.Timedelta(hours=self.history_hours())
+
+        poll = dataset.poll_df.loc[start_time:end_time, self.pollutant]
+        poll = poll.loc[~poll.index.duplicated(keep='first')]
+        wea = wea.loc[start_time:end_time]
+        wea = wea.loc[~wea.index.duplicated(keep='first')]
+        fire = dataset.fire.sort_index().loc[start_time:end_time + pd.Timedelta(hours=1)]
+        fire_hour = fire.index.floor('h')
+
+        features = []
+        for hour in pd.date_range(start_time, end_time, freq='h'):
+            start, stop = fire_hour.searchsorted(hour), fire_hour.searchsorted(hour, side='right')
+            row = self.update(hour,
+                              poll_value=poll.get(hour, None),
+                              wea_row=wea.loc[hour] if hour in wea.index else None,
+                              fire_df=fire.iloc[start:stop])
+            if row is not None:
+                features.append(row)
+
+        if len(features) == 0:
+            return pd.DataFrame(columns=self.x_cols)
+        return pd.DataFrame(features)
+
+    def _add_fire(self, fire_df):
+        # add damped fire power of the hotspots to the arrival hour bins
+        if (fire_df is None) or (len(fire_df) == 0):
+            return
+        distance = fire_df['distance'].values.astype(float)
+        zone = fire_zone(distance, self.zone_list)
+        arrival = cal_arrival_hour(fire_df.index, distance, wind_speed=self.w_speed)
+        keep = (zone >= 0) & ~np.isnan(arrival)
+        zone = zone[keep]
+        arrival = arrival[keep].astype(np.int64)
+        damp = cal_power_damp(fire_df[self.fire_col].values[keep], distance[keep], surface=self.damp_surface)
+
+        for hour, z, power in zip(arrival, zone, damp):
+            slot = hour % self.ring_len
+            if self.ring_hour[slot] != hour:
+                # reuse an expired slot
+                self.fire_ring[slot] = 0
+                self.ring_hour[slot] = hour
+            self.fire_ring[slot, z] += power
+
+    def _fire_feature(self, hour):
+        # sum of the damped fire power arriving in the roll window ending at hour - shift
+        end = hour - self.shift
+        hours = np.arange(end - self.roll + 1, end + 1)
+        slots = hours % self.ring_len
+        current = self.ring_hour[slots] == hours
+        return self.fire_ring[slots[current]].sum(axis=0)
+
+    def _no_fire_row(self, hour, poll_value, wea_row):
+        # calculate the data no fire row. Return None if the batch pipeline would drop the hour
+        if (poll_value is None) or (wea_row is None):
+            # the hour is not in the merged pollution and weather data
+            return None
+
+        self.poll_buffer.append(poll_value)
+        poll = np.array(self.poll_buffer, dtype=float)
+        if np.isnan(poll).all():
+            return None
+        poll = np.round(np.nanmean(poll), 1)
+
+        wea_values = np.array([wea_row[col] for col in wea_num_cols], dtype=float)
+        if np.isnan(wea_values).any() or pd.isna(wea_row['Wind']) or pd.isna(wea_row['Condition']):
+            return None
+
+        wind = wind_weights[wind_codes(pd.Series([wea_row['Wind']]))][0]
+        is_rain = condition_flag(np.array([wea_row['Condition']], dtype=object), rain_keywords)
+        calendar = cal_calendar_info(np.array([hour]), self.holiday_file)
+
+        row = np.hstack([[poll], wea_values, wind, is_rain, [calendar[col][0] for col in calendar]])
+        # same precision as the float32 data no fire
+        return row.astype(np.float32).astype(float)
+
+    def _rebase_lag_csum(self):
+        # subtract the oldest prefix sum once every maxlen rows. The differences used by the lag means do not
+        # change, but the sums stay the size of a window sum and keep their precision on a long stream
+        self.n_since_rebase += 1
+        if self.n_since_rebase < self.lag_csum.maxlen:
+            return
+        base = self.lag_csum[0]
+        self.lag_csum = deque([csum - base for csum in self.lag_csum], maxlen=self.lag_csum.maxlen)
+        self.n_since_rebase = 0
+
+    def update(self, hour, poll_value=None, wea_row=None, fire_df=None):
+        """Add the data of a new hour and return the features of the hour hour - delay.
+
+        Args:
+            hour: timestamp of the new hour
+            poll_value(optional): pollutant value of the hour. None if there is no pollution record.
+                nan if the record exists without this pollutant
+            wea_row(optional): weather data of the hour as a dictionary or a series with
+                'Temperature(C)', 'Humidity(%)', 'Wind Speed(kmph)', 'Wind' and 'Condition'. None if missing
+            fire_df(optional): hotspots detected in this hour with datetime index, 'distance' and fire_col columns
+
+        Returns: pd.Series
+            features of the hour hour - delay in the order of dataset.x_cols. None if the batch pipeline has no data
+            for that hour
+
+        Raises:
+            AssertionError: if the hours are not added in order
+
+        """
+        hour = pd.Timestamp(hour).floor('h')
+        if (self.last_hour is not None) and (hour != self.last_hour + pd.Timedelta(hours=1)):
+            raise AssertionError('hours must be added one at a time in order')
+        self.last_hour = hour
+        hour_int = np.datetime64(hour, 'h').astype(np.int64)
+
+        self._add_fire(fire_df)
+        row = self._no_fire_row(hour_int, poll_value, wea_row)
+        if row is not None:
+            self.pending[hour_int] = row
+
+        # the fire feature of this hour is complete
+        out_hour = hour_int - self.delay
+        row = self.pending.pop(out_hour, None)
+        if row is None:
+            return None
+
+        data_row = pd.Series(np.hstack([row, self._fire_feature(out_hour)]), index=self.cols + self.fire_cols)
+        x_org = data_row[self.x_cols_org].values.astype(float)
+
+        # lag columns from the previous rows
+        lags = []
+        for n in self.lag_range:
+            if self.lag_roll:
+                if len(self.lag_csum) > n:
+                    lags.append((self.lag_csum[-1] - self.lag_csum[-1 - n]) / n)
+                else:
+                    lags.append(np.full(len(x_org), np.nan))
+            elif len(self.lag_rows) >= n:
+                lags.append(self.lag_rows[-n])
+            else:
+                lags.append(np.full(len(x_org), np.nan))
+
+        self.lag_csum.append(self.lag_csum[-1] + x_org)
+        self.lag_rows.append(x_org)
+        self._rebase_lag_csum()
+
+        if len(lags) > 0:
+            lags = np.hstack(lags).astype(np.float32).astype(float)
+            if np.isnan(lags).any():
+                return None
+            data_row = pd.concat([data_row, pd.Series(lags, index=self.lag_cols)])
+
+        data_row.name = epoch_hours_to_index([out_hour])[0]
+        return data_row[self.x_cols]
@@ -172,6 +172,36 @@ def smooth(x,window_len=11,window='hanning'):
     return y[int(window_len/2-1):-int(window_len/2)-1] 
 
 
+# month-day label of each day of year. Row 0 for common years and row 1 for leap years
+month_day_labels = np.array([pd.date_range(f'{year}-01-01', f'{year}-12-31', freq='d').strftime('%m-%d').to_list() + [''] * (year == 2019)
+                             for year in [2019, 2020]])
+
+
+def cal_winter_day(days, offset=182):
+    """Calculate the winter day of daily timestamps from the datetime64 day numbers.
+
+    The winter day is the day of year minus offset. The days before offset continue after the largest winter day in days.
+
+    Args:
+        days: array of daily timestamps
+        offset: date of year offset
+
+    Returns: np.array, np.array, np.array
+        day of year, winter day and month-day label of each day
+
+    """
+    days = np.asarray(days).astype('datetime64[D]')
+    years = days.astype('datetime64[Y]')
+    dayofyear = (days - years.astype('datetime64[D]')).astype(int) + 1
+    year = years.astype(int) + 1970
+    is_leap = ((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0)
+
+    winter_day = dayofyear - offset
+    winter_day = np.where(winter_day < 0, winter_day + offset + winter_day.max(), winter_day)
+
+    return dayofyear, winter_day, month_day_labels[is_leap.astype(int), dayofyear - 1]
+
+
 def season_avg(df, cols=[], roll=True, agg='max', offset=182):
     """Calculate thea seasonal average.
     
@@ -198,24 +228,65 @@ def season_avg(df, cols=[], roll=True, agg='max', offset=182):
 
     # resample data
     df = df.resample('d').agg(agg).copy()
-    df['dayofyear'] = df.index.dayofyear
-    df['year'] = df.index.year
-
     # add winter day by substratcing the first day of july
-    winterday = df['dayofyear'] - offset
-    # get rid of the negative number
-    winter_day_max = winterday.max()
-    winterday[winterday < 0] = winterday[winterday < 0] + offset + winter_day_max  
+    dayofyear, winterday, month_day = cal_winter_day(df.index.values, offset=offset)
+    df['dayofyear'] = dayofyear
+    df['year'] = df.index.year
     df['winter_day'] = winterday
 
     # add month-day 
-    df['month_day'] = df.index.strftime('%m-%d')
-    temp = df[['winter_day', 'month_day']].set_index('winter_day')
-    temp.index = temp.index.astype(str)
-    winter_day_dict = temp.to_dict()['month_day']
+    df['month_day'] = month_day
+    winter_day_dict = dict(zip(winterday.astype(str), month_day))
 
     return df, winter_day_dict
 
+
+def _group_mean(values, groups, n_groups):
+    # mean of each column of values by group ignoring nan. One bincount for all columns. Return (columns, groups)
+    n_cols = values.shape[1]
+    valid = ~np.isnan(values)
+    bins = (groups[:, None] + n_groups * np.arange(n_cols)).ravel()
+    sums = np.bincount(bins, weights=np.where(valid, values, 0).ravel(), minlength=n_groups * n_cols)
+    counts = np.bincount(bins, weights=valid.ravel(), minlength=n_groups * n_cols)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).reshape(n_cols, n_groups)
+
+
+def season_mean(df, cols=[], roll=True, offset=182):
+    """Calculate the mean seasonal pattern by winter day. 
+
+    Same as season_avg with agg='mean' followed by groupby('winter_day').mean(), but accumulate the daily
+    and the winter day means of all columns using bincount.
+
+    Args:
+        df: hourly dataframe to calculate the average of
+        cols: columns to use for the means
+        roll: if True, calculate the 24 hour rolling average first
+        offset: date of year offset 
+
+    Returns: pd.DataFrame
+        mean of the columns indexed by winter day 
+
+    """
+    if len(cols) == 0:
+        cols = df.columns
+
+    df = df[cols]
+    if roll:
+        df = df.rolling(24, min_periods=0).mean().dropna()
+
+    days = df.index.values.astype('datetime64[D]').astype(np.int64)
+    first_day = days.min()
+    n_days = days.max() - first_day + 1
+    daily = _group_mean(df.values.astype(float), days - first_day, n_days)
+
+    # winter day of every day between the first and the last day as in resample('d')
+    _, winter_day, _ = cal_winter_day(np.arange(first_day, first_day + n_days).astype('datetime64[D]'), offset=offset)
+    winter_days, winter_idx = np.unique(winter_day, return_inverse=True)
+    sea_mean = _group_mean(daily.T, winter_idx, len(winter_days))
+
+    return pd.DataFrame(sea_mean.T, index=pd.Index(winter_days, name='winter_day'), columns=cols)
+
 def to_aqi(value, pollutant):
     """Convert pollution value to AQI 
     
@@ -3,6 +3,7 @@ import sys
 from pathlib import Path
 import re
 import os
+import shutil
 from tqdm import tqdm, tqdm_notebook
 import json
 import numpy as np
@@ -63,7 +64,8 @@ from bokeh.tile_providers import get_provider, Vendors
 
 from sklearn.preprocessing import OneHotEncoder, StandardScaler
 from sklearn.metrics import mean_squared_error, r2_score, mean_absolute_error
-from sklearn.model_selection import GridSearchCV, RandomizedSearchCV, train_test_split, KFold, TimeSeriesSplit
+from sklearn.model_selection import GridSearchCV, RandomizedSearchCV, train_test_split, KFold, TimeSeriesSplit, ParameterSampler, cross_val_score, check_cv
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor, GradientBoostingRegressor
 from sklearn.linear_model import ElasticNet, Ridge, Lasso, LinearRegression
 from sklearn.neighbors import KNeighborsRegressor
@@ -91,12 +93,13 @@ from tpot import TPOTRegressor
 
 # optimization 
 from skopt.plots import plot_objective
-from skopt import gp_minimize
+from skopt import gp_minimize, Optimizer
 from skopt.utils import use_named_args
 from skopt.space import Real, Categorical, Integer
 import joblib
 from joblib import Parallel, delayed
 import pickle
+import hashlib
 from dask.distributed import Client
 
 from statsmodels.graphics.tsaplots import plot_acf, plot_pacf
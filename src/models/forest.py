@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+from ..imports import *
+
+"""Compact artifact for the random forest model. The node arrays of all trees are saved as NumPy files with
+a json manifest, and are memory mapped when loaded, so the scoring processes share the same pages.
+
+"""
+
+# node arrays of the forest and their data type
+forest_arrays = {'left': np.int32,
+                 'right': np.int32,
+                 'feature': np.int32,
+                 'threshold': np.float64,
+                 'value': np.float64,
+                 'roots': np.int64,
+                 'importances': np.float64}
+
+
+def _json_params(params: dict):
+    # model parameters which can be written to json
+    return {k: (v if isinstance(v, (int, float, str, bool, type(None))) else str(v)) for k, v in params.items()}
+
+
+def forest_to_arrays(model):
+    """Concatenate the node arrays of the trees of a fitted forest regressor.
+
+    The children of each tree are shifted to the position of the tree in the concatenated arrays.
+    Leaves have left and right -1.
+
+    Args:
+        model: fitted RandomForestRegressor or ExtraTreesRegressor with a single output
+
+    Returns: dict
+        node arrays with the keys in forest_arrays
+
+    Raises:
+        AssertionError: if the model is not a fitted single output forest
+
+    """
+    if not hasattr(model, 'estimators_') or (getattr(model, 'n_outputs_', 1) != 1):
+        raise AssertionError('model must be a fitted single output forest regressor')
+
+    trees = [estimator.tree_ for estimator in model.estimators_]
+    roots = np.cumsum([0] + [tree.node_count for tree in trees[:-1]])
+    arrays = {'left': [], 'right': [], 'feature': [], 'threshold': [], 'value': []}
+    for root, tree in zip(roots, trees):
+        is_leaf = tree.children_left < 0
+        arrays['left'].append(np.where(is_leaf, -1, tree.children_left + root))
+        arrays['right'].append(np.where(is_leaf, -1, tree.children_right + root))
+        arrays['feature'].append(tree.feature)
+        arrays['threshold'].append(tree.threshold)
+        arrays['value'].append(tree.value[:, 0, 0])
+
+    arrays = {k: np.concatenate(v) for k, v in arrays.items()}
+    arrays['roots'] = roots
+    arrays['importances'] = model.feature_importances_
+    return {k: np.ascontiguousarray(v, dtype=forest_arrays[k]) for k, v in arrays.items()}
+
+
+class CompactForest():
+    """CompactForest object predicts from the concatenated node arrays of a forest regressor. Use save_forest
+    and load_forest to store the arrays, or compact_forest for a fitted model.
+
+    When loaded from a folder, each array is memory mapped on first use.
+
+    Args:
+        manifest: manifest dictionary. See save_forest
+        arrays(optional): dictionary of node arrays. See forest_to_arrays [default:None]
+        folder(optional): folder of the saved arrays [default:None]
+        chunk_size(optional): number of tree and row pairs traversed at once [default:4,000,000]
+
+    Attributes:
+        n_estimators: number of trees
+        n_features_in_: number of features
+
+    """
+
+    def __init__(self, manifest: dict, arrays: dict = None, folder: str = None, chunk_size: int = 4000000):
+
+        self.manifest = manifest
+        self.folder = folder
+        self.n_estimators = manifest['n_estimators']
+        self.n_features_in_ = manifest['n_features_in_']
+        self.chunk_size = chunk_size
+        self._arrays = {} if arrays is None else dict(arrays)
+
+    def __getattr__(self, name):
+        # memory map the node arrays on first use
+        if name in forest_arrays:
+            if name not in self._arrays:
+                self._arrays[name] = np.load(os.path.join(self.folder, self.manifest['arrays'][name]), mmap_mode='r')
+            return self._arrays[name]
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        # the worker processes map the saved files again instead of receiving a copy
+        state = self.__dict__.copy()
+        if self.folder is not None:
+            state['_arrays'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def feature_importances_(self):
+        return np.asarray(self.importances)
+
+    def get_params(self, deep=True):
+        """Return the parameters of the original model.
+
+        """
+        return dict(self.manifest['params'])
+
+    def leaf_nodes(self, x: np.array):
+        """Return the leaf node of each tree for each row of x.
+
+        Follow the same rule as the sklearn trees, which compare the float32 x with the threshold.
+
+        Args:
+            x: 2D array of x data
+
+        Returns: np.array
+            leaf node positions with shape (n_estimators, len(x))
+
+        """
+        x = np.asarray(x, dtype=np.float32)
+        left, right, feature, threshold = self.left, self.right, self.feature, self.threshold
+
+        n_rows = len(x)
+        node = np.repeat(np.asarray(self.roots), n_rows)
+        row = np.tile(np.arange(n_rows), self.n_estimators)
+        pos = np.arange(len(node))
+        leaf = np.empty(len(node), dtype=np.int64)
+        while len(pos) > 0:
+            # remove the pairs which reached a leaf
+            next_left = left[node]
+            done = next_left < 0
+            leaf[pos[done]] = node[done]
+            if done.any():
+                keep = ~done
+                pos, node, row, next_left = pos[keep], node[keep], row[keep], next_left[keep]
+
+            go_left = x[row, feature[node]] <= threshold[node]
+            node = np.where(go_left, next_left, right[node]).astype(np.int64)
+
+        return leaf.reshape(self.n_estimators, n_rows)
+
+    def predict(self, x: np.array):
+        """Predict x. Same as the predict of the original model.
+
+        Args:
+            x: 2D array of x data
+
+        Returns: np.array
+
+        """
+        x = np.asarray(x)
+        value = self.value
+        step = max(1, self.chunk_size // self.n_estimators)
+        y = np.empty(len(x))
+        for start in range(0, len(x), step):
+            y[start:start + step] = value[self.leaf_nodes(x[start:start + step])].mean(axis=0)
+
+        return y
+
+    def _scale_pieces(self, x, is_cut, scale_range):
+        # traverse the trees with an interval (lo, hi] of the scale t of the cut columns. At a split on a cut
+        # column, the interval is divided at the breakpoint where x * t crosses the threshold. Return the sum of
+        # the leaf values at the lowest scale and the (row, breakpoint, jump) of the other leaf pieces
+        left, right, feature, threshold, value = self.left, self.right, self.feature, self.threshold, self.value
+        n_rows = len(x)
+        x32 = x.astype(np.float32)
+        start_lo, t_max = np.nextafter(scale_range[0], -np.inf), scale_range[1]
+
+        node = np.repeat(np.asarray(self.roots), n_rows)
+        row = np.tile(np.arange(n_rows), self.n_estimators)
+        lo = np.full(len(node), start_lo)
+        hi = np.full(len(node), float(t_max))
+        base = np.zeros(n_rows)
+        events = []
+        while len(node) > 0:
+            next_left = left[node]
+            done = next_left < 0
+            if done.any():
+                v, r, l, h = value[node[done]], row[done], lo[done], hi[done]
+                first = l == start_lo
+                base += np.bincount(r[first], weights=v[first], minlength=n_rows)
+                # the leaf value starts after lo and ends after hi
+                events.append((r[~first], l[~first], v[~first]))
+                end = h < t_max
+                events.append((r[end], h[end], -v[end]))
+                keep = ~done
+                node, row, lo, hi, next_left = node[keep], row[keep], lo[keep], hi[keep], next_left[keep]
+
+            f = feature[node]
+            thr = threshold[node]
+            next_right = right[node]
+            node = np.where(x32[row, f] <= thr, next_left, next_right).astype(np.int64)
+
+            cut = np.flatnonzero(is_cut[f] & (x[row, f] != 0))
+            if len(cut) > 0:
+                # float32(x * t) <= thr if x * t is below the rounding boundary above the largest float32 <= thr
+                thr32 = thr[cut].astype(np.float32)
+                thr32 = np.where(thr32 > thr[cut], np.nextafter(thr32, np.float32(-np.inf)), thr32)
+                boundary = (thr32.astype(np.float64) + np.nextafter(thr32, np.float32(np.inf)).astype(np.float64)) / 2
+                xc = x[row[cut], f[cut]]
+                brk = boundary / xc
+                # below the breakpoint, positive x goes left and negative x goes right
+                low_node = np.where(xc > 0, next_left[cut], next_right[cut])
+                high_node = np.where(xc > 0, next_right[cut], next_left[cut])
+                low_hi = np.minimum(hi[cut], brk)
+                high_lo = np.maximum(lo[cut], brk)
+                has_low = low_hi > lo[cut]
+                has_high = hi[cut] > high_lo
+
+                # the pair keeps the low piece if it has one, otherwise the high piece. A new pair is added
+                # for the high piece if the interval is divided
+                both = has_low & has_high
+                high_hi = hi[cut]
+                node[cut] = np.where(has_low, low_node, high_node)
+                lo[cut] = np.where(has_low, lo[cut], high_lo)
+                hi[cut] = np.where(has_low, low_hi, high_hi)
+                node = np.hstack([node, high_node[both]])
+                row = np.hstack([row, row[cut[both]]])
+                lo = np.hstack([lo, high_lo[both]])
+                hi = np.hstack([hi, high_hi[both]])
+
+        rows, breaks, jumps = [np.hstack(e) for e in zip(*events)] if len(events) > 0 else [np.array([])] * 3
+        return base, rows, breaks, jumps
+
+    def _chunk_pieces(self, x: np.array, is_cut: np.array, scale_range):
+        # base, number of breakpoints of each row, and the breakpoints and jumps sorted by row and scale
+        base, rows, breaks, jumps = self._scale_pieces(x, is_cut, scale_range)
+        rows = rows.astype(np.int64)
+        order = np.lexsort((breaks, rows))
+        return base, np.bincount(rows, minlength=len(x)), breaks[order], jumps[order]
+
+    def _row_step(self):
+        # number of rows per chunk. Each pair is divided into several pieces
+        return max(1, self.chunk_size // self.n_estimators // 8)
+
+    def scale_curves(self, x: np.array, cut: list, scale_range=(0, 1), max_mb: float = 2000):
+        """Return the prediction of each row of x as a piecewise constant function of the scale of the cut columns.
+
+        One traversal records, for each row, the breakpoints where scaling the cut columns changes the leaf of
+        a tree, so the prediction for any scale in scale_range can be read without predicting again.
+        The breakpoints follow the float32 comparison of the sklearn trees, so the curves agree with
+        predict except for a scale within a float64 rounding error of a breakpoint.
+
+        The curves keep 16 bytes per breakpoint, and predicting uses 8 more. A row has up to a few thousand
+        breakpoints for a large forest and scale_range (0, 1), which is tens of kB per row. The rows are
+        processed in chunks, and the build stops as soon as the size estimated from the rows done exceeds
+        max_mb. Use predict_scales for a fixed list of scales over many rows.
+
+        Args:
+            x: 2D array of x data
+            cut: positions of the cut columns
+            scale_range(optional): range of the scale [default:(0, 1)]
+            max_mb(optional): maximum estimated size of the curves in MB. If None, no limit [default:2000]
+
+        Returns: ScaleCurves
+
+        Raises:
+            AssertionError: if the estimated size of the curves exceeds max_mb
+
+        """
+        x = np.asarray(x, dtype=np.float64)
+        is_cut = np.zeros(x.shape[1], dtype=bool)
+        is_cut[cut] = True
+        step = self._row_step()
+
+        base, counts, breaks, jumps = [], [], [], []
+        n_bytes = 0
+        for start in range(0, len(x), step):
+            b, c, p, j = self._chunk_pieces(x[start:start + step], is_cut, scale_range)
+            base.append(b)
+            counts.append(c)
+            breaks.append(p)
+            jumps.append(j)
+
+            n_bytes += 16 * (len(p) + len(b))
+            total_mb = n_bytes / min(start + step, len(x)) * len(x) / 1E6
+            if (max_mb is not None) and (total_mb > max_mb):
+                raise AssertionError(f'the curves of {len(x)} rows need about {total_mb:.0f} MB. '
+                                     'Use predict_scales, fewer rows or a smaller scale_range')
+
+        offsets = np.hstack([0, np.cumsum(np.hstack(counts))])
+        return ScaleCurves(np.hstack(base) / self.n_estimators, offsets, np.hstack(breaks),
+                           np.hstack(jumps) / self.n_estimators, scale_range)
+
+    def predict_scales(self, x: np.array, cut: list, scale_list):
+        """Return the prediction of x with the cut columns multiplied by each scale in scale_list.
+
+        Same as scale_curves followed by ScaleCurves.predict, but the curves of each chunk of rows are read and
+        dropped, so the memory does not grow with the number of rows. The curves only cover the range of
+        scale_list.
+
+        Args:
+            x: 2D array of x data
+            cut: positions of the cut columns
+            scale_list: a list of scales
+
+        Returns: np.array
+            predictions with shape (len(scale_list), len(x))
+
+        """
+        x = np.asarray(x, dtype=np.float64)
+        is_cut = np.zeros(x.shape[1], dtype=bool)
+        is_cut[cut] = True
+        scales = np.atleast_1d(np.asarray(scale_list, dtype=float))
+        scale_range = (scales.min(), scales.max())
+        step = self._row_step()
+
+        y = np.empty((len(scales), len(x)))
+        for start in range(0, len(x), step):
+            b, c, p, j = self._chunk_pieces(x[start:start + step], is_cut, scale_range)
+            curves = ScaleCurves(b / self.n_estimators, np.hstack([0, np.cumsum(c)]), p, j / self.n_estimators,
+                                 scale_range)
+            y[:, start:start + step] = curves.predict(scales)
+
+        return y
+
+
+class ScaleCurves():
+    """ScaleCurves object holds the prediction of a forest for each row as a piecewise constant function of the
+    scale of the cut columns. See CompactForest.scale_curves.
+
+    The prediction of a row at scale t is the base value plus the jumps of the row with a breakpoint below t.
+    The jumps are kept as a cumulative sum, so a scale is answered with one search per row.
+
+    Args:
+        base: prediction at the lowest scale
+        offsets: offsets of the breakpoints of each row with length len(base) + 1
+        breaks: breakpoints sorted by row and scale
+        jumps: change of the prediction after each breakpoint
+        scale_range: range of the scale
+
+    Attributes:
+        base: prediction at the lowest scale
+        offsets: offsets of the breakpoints of each row
+        breaks: breakpoints of row i are breaks[offsets[i]:offsets[i+1]]
+        cum_jumps: cumulative sum of the jumps with a leading 0
+
+    """
+
+    def __init__(self, base, offsets, breaks, jumps, scale_range):
+
+        self.base = base
+        self.offsets = offsets
+        self.breaks = breaks
+        self.cum_jumps = np.hstack([0, np.cumsum(jumps)])
+        self.scale_range = scale_range
+
+    def predict(self, scale_list):
+        """Return the predictions for each scale in scale_list.
+
+        Args:
+            scale_list: a list of scales
+
+        Returns: np.array
+            predictions with shape (len(scale_list), number of rows)
+
+        Raises:
+            AssertionError: if a scale is outside scale_range
+
+        """
+        scales = np.atleast_1d(np.asarray(scale_list, dtype=float))
+        if (scales.min() < self.scale_range[0]) or (scales.max() > self.scale_range[1]):
+            raise AssertionError(f'scale must be in {self.scale_range}')
+
+        # search all rows at once. The breakpoints of row i are moved to i * width + breakpoint
+        n_rows = len(self.base)
+        width = 2 * (self.scale_range[1] - self.scale_range[0]) + 1
+        row_start = np.arange(n_rows) * width - self.scale_range[0]
+        keys = self.breaks + np.repeat(row_start, np.diff(self.offsets))
+        start_cum = self.cum_jumps[self.offsets[:-1]]
+
+        y = np.empty((len(scales), n_rows))
+        for i, t in enumerate(scales):
+            position = np.searchsorted(keys, row_start + t, side='left')
+            y[i] = self.base + self.cum_jumps[position] - start_cum
+
+        return y
+
+
+def compact_forest(model):
+    """Return a CompactForest of a fitted forest model. Return the model if it is already a CompactForest.
+
+    """
+    if isinstance(model, CompactForest):
+        return model
+    arrays = forest_to_arrays(model)
+    manifest = {'n_estimators': len(model.estimators_),
+                'n_features_in_': int(model.n_features_in_),
+                'params': _json_params(model.get_params())}
+    return CompactForest(manifest, arrays=arrays)
+
+
+def _forest_versions(folder: str):
+    # version folders of the saved arrays, oldest first
+    versions = [name for name in os.listdir(folder) if re.fullmatch(r'v\d+', name)]
+    return sorted(versions, key=lambda name: int(name[1:]))
+
+
+def save_forest(model, folder: str):
+    """Save the node arrays of a fitted forest model as .npy files and a manifest.json in folder.
+
+    The arrays are written to a new version folder, and the manifest pointing to it replaces the old manifest with
+    os.replace. A reader sees either the old or the new forest, and the files of a loaded forest are never
+    overwritten. The previous version is kept for the readers which loaded the old manifest but did not map its
+    arrays yet. The older versions are removed.
+
+    Args:
+        model: fitted forest model. See forest_to_arrays
+        folder: folder to save the arrays
+
+    """
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+
+    # version folder of the forest currently in the manifest. '' for the arrays saved directly in folder
+    manifest_file = os.path.join(folder, 'manifest.json')
+    previous = None
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            previous = os.path.dirname(list(json.load(f)['arrays'].values())[0])
+
+    versions = _forest_versions(folder)
+    version = 'v' + str(int(versions[-1][1:]) + 1 if versions else 1)
+    os.mkdir(os.path.join(folder, version))
+
+    arrays = forest_to_arrays(model)
+    manifest = {'format': 'compact_forest',
+                'version': 1,
+                'model': type(model).__name__,
+                'n_estimators': len(model.estimators_),
+                'n_features_in_': int(model.n_features_in_),
+                'n_nodes': len(arrays['value']),
+                'params': _json_params(model.get_params()),
+                'arrays': {}}
+
+    for name, array in arrays.items():
+        manifest['arrays'][name] = version + '/' + name + '.npy'
+        np.save(os.path.join(folder, version, name + '.npy'), array)
+
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+    # remove the versions older than the previous one
+    for old in versions:
+        if old != previous:
+            shutil.rmtree(os.path.join(folder, old), ignore_errors=True)
+    if previous not in (None, ''):
+        for name in forest_arrays:
+            try:
+                os.remove(os.path.join(folder, name + '.npy'))
+            except OSError:
+                # not saved, or still mapped on a system which can not remove the mapped files
+                pass
+
+
+def load_forest(folder: str, chunk_size: int = 4000000):
+    """Load a forest saved by save_forest. The arrays are memory mapped on first use.
+
+    Args:
+        folder: folder of the saved forest
+        chunk_size(optional): see CompactForest [default:4,000,000]
+
+    Returns: CompactForest
+
+    Raises:
+        AssertionError: if the folder has no manifest
+
+    """
+    manifest_file = os.path.join(folder, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        raise AssertionError(f'no compact forest in {folder}')
+
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+
+    return CompactForest(manifest, folder=folder, chunk_size=chunk_size)
@@ -5,6 +5,7 @@ from ..features.dataset import Dataset
 from ..features.build_features import *
 from .train_model import *
 from .train_model import load_model1
+from .forest import *
 from ..visualization.vis_data import *
 from ..visualization.vis_model import *
 
@@ -60,9 +61,7 @@ def cal_season_error(error_df, roll_win=15, agg='mean'):
         seasonal pattern of the error 
 
     """
-    sea_error, _ = season_avg(error_df, cols=['error','rmse'], roll=False, agg='mean', offset=182)
-    sea_error = sea_error.groupby('winter_day').mean()
-    sea_error = sea_error.drop(['dayofyear','year'],axis=1)
+    sea_error = season_mean(error_df, cols=['error','rmse'], roll=False, offset=182)
     return sea_error.rolling(roll_win, min_periods=0, center=True).agg(agg)
 
     
@@ -83,59 +82,100 @@ def get_year_sample(year_list, n_samples=100):
 
     return year_sam
 
-def get_sample(test_datetime, wea, fire, year_list, year_samples, day_err=7, hour_err=2):
-    """Randomsamples weather and fire data from previous years around the same dayofyear
-    
+# number of (day of year, hour) groups per year
+year_groups = 367 * 24
+
+
+def get_analog_groups(index, year_list):
+    """Group the rows of a datetime index by (year, day of year, hour) in CSR style.
+
+    Args:
+        index: datetime index of the training data
+        year_list: a list of years. Rows in other years are left out
+
+    Returns: (np.array, np.array)
+        row positions sorted by group and the offsets of each group. The group of the i-th year,
+        day of year d and hour h is i*year_groups + d*24 + h
+
+    """
+    year_pos = pd.Index(year_list).get_indexer(index.year)
+    rows = np.flatnonzero(year_pos >= 0)
+    group = year_pos[rows] * year_groups + index.dayofyear.values[rows] * 24 + index.hour.values[rows]
+    order = np.argsort(group, kind='stable')
+    counts = np.bincount(group, minlength=len(year_list) * year_groups)
+    return rows[order], np.hstack([0, np.cumsum(counts)])
+
+
+def sample_analog_rows(index, test_times, year_list, year_samples, day_err=7, hour_err=2, seeds=None, n_sets=1):
+    """Random sample rows of the training data around the same day of year and hour of each test time.
+
+    For each test time and year, draw year_samples rows with replacement among the rows of that year within
+    day_err days and hour_err hours of the test time. Years without such rows are skipped. Same distribution
+    as drawing with DataFrame.sample from the matching rows, but all test times are drawn in one gather.
+
+    Each test time is drawn from its own random stream, so the samples of a test time do not depend on the
+    other test times, and splitting the test times among workers gives the same samples.
+
     Args:
-        test_datetime: datetime for sampling from the train data
-        wea: weather dataframe from training data
-        fire: fire data df from training data 
+        index: datetime index of the training data
+        test_times: datetime index of the test times
         year_list: a list of years in training data
-        year_samples: a list of sample from each year 
-        day_error: plus/minus date range to sample from 
-        hour_err: plus/minus hour to sample from 
-        
-    Returns: 
-        data_samples: sample dataframe 
-    
+        year_samples: a list of sample from each year
+        day_err(optional): plus/minus date range to sample from [default:7]
+        hour_err(optional): plus/minus hour to sample from [default:2]
+        seeds(optional): a list of np.random.SeedSequence, one for each test time. If None, use unseeded streams [default:None]
+        n_sets(optional): number of independent sets of rows. The rows of each set are shuffled within each test time,
+            so the sets are paired at random [default:1]
+
+    Returns: (np.array, list)
+        position of the test time of each sample and a list of n_sets arrays of the row positions in index
+
     """
-    
-    #get date range
-    start_date = test_datetime - pd.Timedelta(f'{day_err} days')
-    end_date = test_datetime + pd.Timedelta(f'{day_err} days')
-    date_range = pd.date_range(start=start_date, end=end_date, freq='D')
-    date_range = date_range.dayofyear.to_list()
-     
-    # get hour range 
-    start_date = test_datetime - pd.Timedelta(f'{hour_err} hours')
-    end_date = test_datetime + pd.Timedelta(f'{hour_err} hours')
-    hour_range = pd.date_range(start=start_date, end=end_date, freq='h')
-    hour_range = hour_range.hour
-    
-    # get wether sample 
-    # select the data
-    fire_samples = []
-    wea_samples = []
-    for year, year_sample in zip(year_list, year_samples):
-        # select deata for the year
-        wea_sam = wea[(wea['year']==year) & wea['day_of_year'].isin(date_range) & wea['hour'].isin(hour_range)]
-         
-        if len(wea_sam) > 0:
-             wea_samples.append(wea_sam.sample(year_sample,replace=True))
-            
-        # select deata for the year
-        fire_sam = fire[(fire['year']==year) & fire['day_of_year'].isin(date_range) & fire['hour'].isin(hour_range)]
-     
-        if len(fire_sam) > 0:
-             fire_samples.append(fire_sam.sample(year_sample,replace=True))
+    test_times = pd.DatetimeIndex(test_times)
+    n_test, n_years = len(test_times), len(year_list)
+    if seeds is None:
+        seeds = np.random.SeedSequence().spawn(n_test)
+    sorted_rows, offsets = get_analog_groups(index, year_list)
+    counts = np.diff(offsets)
+
+    # day of year and hour of the sampling window of each test time
+    days = test_times.floor('D').values[:, None] + np.arange(-day_err, day_err + 1) * np.timedelta64(1, 'D')
+    day_of_year = pd.DatetimeIndex(days.ravel()).dayofyear.values.reshape(days.shape)
+    hour_offset = np.arange(-hour_err, hour_err + 1) if 2 * hour_err + 1 < 24 else np.arange(24)
+    hours = (test_times.hour.values[:, None] + hour_offset) % 24
+
+    # groups in the window with shape (test time, year, day and hour)
+    cells = (np.arange(n_years)[None, :, None, None] * year_groups + day_of_year[:, None, :, None] * 24
+             + hours[:, None, None, :]).reshape(n_test, n_years, -1)
+    cell_counts = counts[cells].reshape(n_test * n_years, -1)
+    total = cell_counts.sum(axis=1)
+    n_draws = np.where(total > 0, np.tile(np.asarray(year_samples), n_test), 0)
+    cum_counts = np.cumsum(cell_counts.ravel())
+    start = cum_counts - cell_counts.ravel()
+
+    # samples of each test time are consecutive
+    block = np.repeat(np.arange(n_test * n_years), n_draws)
+    test_start = np.hstack([0, np.cumsum(n_draws.reshape(n_test, n_years).sum(axis=1))])
+    streams = [np.random.default_rng(seed) for seed in seeds]
+
+    row_sets = []
+    for _ in range(n_sets):
+        # draw a position among the rows of each (test time, year) window and a shuffle of each test time
+        draw = np.empty(len(block), dtype=np.int64)
+        shuffle = np.empty(len(block), dtype=np.int64)
+        for i, stream in enumerate(streams):
+            test_block = block[test_start[i]:test_start[i + 1]]
+            draw[test_start[i]:test_start[i + 1]] = stream.integers(total[test_block])
+            shuffle[test_start[i]:test_start[i + 1]] = test_start[i] + stream.permutation(len(test_block))
+
+        # find the group of each position
+        position = start[block * cell_counts.shape[1]] + draw
+        cell = np.searchsorted(cum_counts, position, side='right')
+        rows = sorted_rows[offsets[cells.ravel()[cell]] + position - start[cell]]
+        row_sets.append(rows[shuffle])
+
+    return block // n_years, row_sets
 
-    wea_samples = pd.concat(wea_samples, ignore_index=True).sample(frac=1).reset_index(drop=True)
-    fire_samples = pd.concat(fire_samples, ignore_index=True).sample(frac=1).reset_index(drop=True)
-    wea_samples['datetime'] = test_datetime
-    
-    data_samples = pd.concat([wea_samples, fire_samples], axis=1)
-    
-    return data_samples.drop(['day_of_year','hour','year'],axis=1)
 
 def add_lag(df, lag_dict):
     """Build the lag data using number in lag_range. 
@@ -151,26 +191,22 @@ def add_lag(df, lag_dict):
 
     lag_range = np.arange(1, lag_dict['n_max'], lag_dict['step'])
     roll = lag_dict['roll']
-        
-    lag_list = [df]
-    for n in lag_range:
-        lag_df = df.copy()
-        lag_df.columns = [ s+ f'_lag_{n}' for s in lag_df.columns] 
-        if roll:
-            # calculate the rolling average
-            lag_df = lag_df.rolling(n,min_periods=None).mean()
-            lag_df = lag_df.shift(1)
-        else:
-            lag_df = lag_df.shift(n)
 
-        lag_list.append(lag_df)
-        
-    new_data = pd.concat(lag_list, axis=1, ignore_index=False)
+    lag_data = cal_lag_matrix(df.values, lag_range, roll=roll)
+    lag_data = pd.DataFrame(lag_data, index=df.index, columns=lag_col_names(df.columns, lag_range))
+
+    new_data = pd.concat([df, lag_data], axis=1, ignore_index=False)
     return new_data.dropna()
 
-def get_data_samples(dataset, time_range=[], n_samples=100, step=1,day_err=10,hour_err=2):
+def get_data_samples(dataset, time_range=[], n_samples=100, step=1,day_err=10,hour_err=2, random_state=None, n_jobs=1):
     """Sample the possible test data from train data. The dataset must alredy has the lag columns built
 
+    The weather and fire data of each sample are drawn independently from the training hours of previous years
+    around the same day of year and hour. See sample_analog_rows.
+
+    The random streams of the test hours are spawned from random_state, so the samples are the same for
+    any n_jobs.
+
     Args:
         dataset: load data using load_model1 function 
         time_range: time range for inference 
@@ -178,6 +214,8 @@ def get_data_samples(dataset, time_range=[], n_samples=100, step=1,day_err=10,ho
         step: if not 1, skip some data to make the draw faster 
         day_err
         hour_err
+        random_state(optional): random seed. If None, the samples differ in each call [default:None]
+        n_jobs(optional): number of worker processes [default:1]
     
     Return pd.DataFame
         sample of weather and fire conditon for each hour. Each hour will have n_samples of data
@@ -205,67 +243,351 @@ def get_data_samples(dataset, time_range=[], n_samples=100, step=1,day_err=10,ho
 
     # number of sample per year
     year_list = trn_index.year.unique()
-    year_sam = get_year_sample(year_list=year_list, n_samples=100)
-
-    # extract fire & weather dfs from the train data
-    wea = dataset.data[wea_cols].loc[trn_index]
-    wea['year'] = wea.index.year
-    wea['day_of_year'] = wea.index.dayofyear
-    wea['hour'] = wea.index.hour
-
-    fire = dataset.data[fire_cols].loc[trn_index]
-    fire['year'] = fire.index.year
-    fire['day_of_year'] = fire.index.dayofyear
-    fire['hour'] = fire.index.hour
+    year_sam = get_year_sample(year_list=year_list, n_samples=n_samples)
 
     if len(time_range)==0:
         # time range from the test data 
         time_range = pd.date_range(start=test_data.index.min(), end=test_data.index.max(), freq='h')
 
-    ## sample the data 
-    #data_samples = []
-    #for test_datetime in tqdm_notebook(time_range[::step]):
-    
-    #    samples = get_sample(test_datetime, wea, fire,year_list, year_samples=year_sam,day_err=10,hour_err=2)
-    #    data_samples.append(samples)
-         
-     # use joblib to speed up sampling process
-    data_samples = Parallel(n_jobs=2)(delayed(get_sample)(test_datetime, wea, fire,year_list, year_sam,day_err,hour_err) for test_datetime in time_range[::step])
-    #data_samples = pd.concat(fire, ignore_index=True)
-
+    # sample the weather and the fire rows with one random stream per test hour
+    test_times = pd.DatetimeIndex(time_range[::step])
+    seeds = np.random.SeedSequence(random_state).spawn(len(test_times))
+    chunks = np.array_split(np.arange(len(test_times)), min(joblib.effective_n_jobs(n_jobs), max(len(test_times), 1)))
+    results = Parallel(n_jobs=n_jobs)(delayed(sample_analog_rows)(trn_index, test_times[chunk], year_list, year_sam,
+                                                                  day_err, hour_err, seeds=[seeds[i] for i in chunk], n_sets=2)
+                                      for chunk in chunks)
+    sample_pos = np.hstack([pos + chunk[0] for chunk, (pos, _) in zip(chunks, results) if len(chunk) > 0])
+    wea_rows = np.hstack([rows[0] for _, rows in results])
+    fire_rows = np.hstack([rows[1] for _, rows in results])
+
+    data_samples = pd.DataFrame(np.hstack([trn_data[wea_cols].values[wea_rows], trn_data[fire_cols].values[fire_rows]]),
+                                columns=list(wea_cols) + list(fire_cols), index=test_times[sample_pos])
+    data_samples.index.name = 'datetime'
 
-    data_samples = pd.concat(data_samples, ignore_index=True)
     # create date_data
     date_data = pd.DataFrame(index=time_range)
     date_data = add_calendar_info(date_data, holiday_file=dataset.data_folder + 'holiday.csv')
     date_data = add_lag(date_data, dataset.lag_dict)
 
     # add calenda information by merging with data_data
-    data_samples = data_samples.set_index('datetime')
     data_samples = data_samples.merge(date_data[date_cols], right_index=True, left_index=True, how='left')
 
     return data_samples.dropna()[dataset.x_cols]
 
-def make_band(ypred_df, q_list=[0.01, 0.25, 0.5, 0.75,  0.99]):
+def model_hash(model):
+    """Return the sha1 hash of a fitted model. Use the tree arrays of a forest model, otherwise the pickle.
+
+    """
+    h = hashlib.sha1()
+    try:
+        forest = compact_forest(model)
+    except AssertionError:
+        h.update(pickle.dumps(model))
+    else:
+        for name in ['left', 'right', 'feature', 'threshold', 'value']:
+            h.update(np.ascontiguousarray(getattr(forest, name)).tobytes())
+
+    return h.hexdigest()
+
+
+def dataset_hash(dataset):
+    """Return a fingerprint of the dataset data used by get_data_samples. See trial_context.
+
+    Cover the data, the columns, the train and test index, the lag dictionary and the modification time and size
+    of the holiday file used for the calendar columns.
+
+    """
+    holiday_file = dataset.data_folder + 'holiday.csv'
+    holiday_stat = [os.path.getmtime(holiday_file), os.path.getsize(holiday_file)] if os.path.exists(holiday_file) else None
+    return trial_context(dataset.data, list(dataset.split_list[:2]), list(dataset.x_cols),
+                         getattr(dataset, 'lag_dict', None), holiday_stat)
+
+
+def sample_cache_key(model, dataset, split_list, n_samples, step, day_err, hour_err, random_state):
+    """Return the key of the data samples in the sample cache and its hash.
+
+    The key covers the model, the dataset data (see dataset_hash) and the sampling parameters, so refreshing
+    the processed data makes a new key.
+
+    """
+    key = {'model': model_hash(model),
+           'data': dataset_hash(dataset),
+           'split_list': [float(ratio) for ratio in split_list],
+           'n_samples': int(n_samples),
+           'step': int(step),
+           'day_err': int(day_err),
+           'hour_err': int(hour_err),
+           'random_state': int(random_state)}
+    return key, hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def save_data_samples(data_samples, folder: str, key: dict):
+    """Save the data samples as .npy files of the values and the datetime index with a manifest.json.
+
+    The manifest is written last, so a folder without the manifest is incomplete.
+
+    Args:
+        data_samples: data samples. See get_data_samples
+        folder: folder to save the samples
+        key: cache key. See sample_cache_key
+
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    np.save(os.path.join(folder, 'values.npy'), np.ascontiguousarray(data_samples.values, dtype=float))
+    np.save(os.path.join(folder, 'index.npy'), data_samples.index.values.astype('datetime64[ns]').astype(np.int64))
+    manifest = {'key': key, 'columns': data_samples.columns.to_list(), 'index_name': data_samples.index.name}
+    with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def load_data_samples(folder: str):
+    """Load the data samples saved by save_data_samples. The values are memory mapped.
+
+    Returns: pd.DataFrame
+        data samples. None if the folder has no manifest
+
+    """
+    manifest_file = os.path.join(folder, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return None
+
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+
+    values = np.load(os.path.join(folder, 'values.npy'), mmap_mode='r')
+    index = pd.DatetimeIndex(np.load(os.path.join(folder, 'index.npy')).astype('datetime64[ns]'), name=manifest['index_name'])
+    return pd.DataFrame(values, index=index, columns=manifest['columns'], copy=False)
+
+
+def _hour_matrix(ypred_df):
+    # reshape the predictions into a (hours, samples) array. Return None if the hours have different numbers of samples
+    index = ypred_df.index
+    values = np.asarray(ypred_df.values, dtype=float)
+    if not index.is_monotonic_increasing:
+        order = np.argsort(index.values, kind='stable')
+        index = index[order]
+        values = values[order]
+
+    starts = np.flatnonzero(np.r_[True, index.values[1:] != index.values[:-1]]) if len(index) > 0 else np.array([], dtype=int)
+    n_samples = len(index) // max(len(starts), 1)
+    if (len(starts) == 0) or (len(index) != len(starts) * n_samples) or np.isnan(values).any() or \
+            (not np.array_equal(starts, np.arange(len(starts)) * n_samples)):
+        return None, None
+
+    return index[starts], values.reshape(len(starts), n_samples)
+
+
+class P2Band():
+    """Streaming quantile band using the P-square algorithm (Jain and Chlamtac, 1985).
+
+    Keep five markers per hour and quantile, so the memory does not grow with the number of samples. Add the
+    predictions in blocks of samples using update and read the band using band. The quantiles are estimates,
+    use make_band when the samples fit in memory.
+
+    Args:
+        index: hourly index of the band
+        q_list(optional): a list of quantile to calculate [default:[0.01, 0.25, 0.5, 0.75,  0.99]]
+
+    """
+
+    def __init__(self, index, q_list=[0.01, 0.25, 0.5, 0.75,  0.99]):
+
+        self.index = index
+        self.q_list = list(q_list)
+        p = np.array(self.q_list, dtype=float)[:, None]
+        # increments of the desired marker positions for each quantile
+        self.dn = np.hstack([0 * p, p / 2, p, (1 + p) / 2, 0 * p + 1])
+        self.count = 0
+        self.buffer = []
+        self.heights = None
+
+    def update(self, values):
+        """Add a block of samples.
+
+        Args:
+            values: 2D array of shape (hours, samples) with the rows in the order of index
+
+        """
+        values = np.asarray(values, dtype=float).reshape(len(self.index), -1)
+        start = 0
+        if self.heights is None:
+            # the first five samples initialize the markers
+            start = min(5 - self.count, values.shape[1])
+            self.buffer.append(values[:, :start])
+            if self.count + start == 5:
+                self._init_markers()
+
+        for j in range(start, values.shape[1]):
+            self._add(values[:, j])
+        self.count += values.shape[1]
+
+    def _init_markers(self):
+        init = np.sort(np.hstack(self.buffer), axis=1)
+        n_hours, n_q = len(self.index), len(self.q_list)
+        self.heights = np.repeat(init[:, None, :], n_q, axis=1)
+        self.positions = np.tile(np.arange(1, 6, dtype=float), (n_hours, n_q, 1))
+        self.desired = np.broadcast_to(1 + 4 * self.dn, (n_hours, n_q, 5)).copy()
+        self.buffer = []
+
+    def _add(self, x):
+        # add one sample of each hour and adjust the three middle markers
+        h, n = self.heights, self.positions
+        x = x[:, None]
+        n[:, :, 1:4] += x[:, :, None] < h[:, :, 1:4]
+        n[:, :, 4] += 1
+        h[:, :, 0] = np.minimum(h[:, :, 0], x)
+        h[:, :, 4] = np.maximum(h[:, :, 4], x)
+        self.desired += self.dn
+
+        for i in range(1, 4):
+            d = self.desired[:, :, i] - n[:, :, i]
+            up = (d >= 1) & (n[:, :, i + 1] - n[:, :, i] > 1)
+            down = (d <= -1) & (n[:, :, i - 1] - n[:, :, i] < -1)
+            move = up | down
+            if not move.any():
+                continue
+
+            s = np.where(up, 1., -1.)
+            # parabolic prediction, use linear prediction if it is outside the neighbour markers
+            parabolic = h[:, :, i] + s / (n[:, :, i + 1] - n[:, :, i - 1]) * (
+                (n[:, :, i] - n[:, :, i - 1] + s) * (h[:, :, i + 1] - h[:, :, i]) / (n[:, :, i + 1] - n[:, :, i]) +
+                (n[:, :, i + 1] - n[:, :, i] - s) * (h[:, :, i] - h[:, :, i - 1]) / (n[:, :, i] - n[:, :, i - 1]))
+            h_next = np.where(up, h[:, :, i + 1], h[:, :, i - 1])
+            n_next = np.where(up, n[:, :, i + 1], n[:, :, i - 1])
+            linear = h[:, :, i] + s * (h_next - h[:, :, i]) / (n_next - n[:, :, i])
+            in_range = (h[:, :, i - 1] < parabolic) & (parabolic < h[:, :, i + 1])
+
+            h[:, :, i] = np.where(move, np.where(in_range, parabolic, linear), h[:, :, i])
+            n[:, :, i] += np.where(move, s, 0)
+
+    def band(self):
+        """Return the band dataframe in the same format as make_band.
+
+        """
+        columns = ['q' + str(q) for q in self.q_list]
+        if self.heights is None:
+            # fewer than five samples
+            assert self.count > 0, 'no samples'
+            return pd.DataFrame(np.quantile(np.hstack(self.buffer), self.q_list, axis=1).T, index=self.index, columns=columns)
+
+        return pd.DataFrame(self.heights[:, :, 2], index=self.index, columns=columns)
+
+
+def make_band(ypred_df, q_list=[0.01, 0.25, 0.5, 0.75,  0.99], method='exact'):
     """Convert aggregate prediction for the same timestamp into upper and lower band. 
 
+    get_data_samples draws the same number of samples for each hour, so the predictions are reshaped into
+    a (hours, samples) array and all quantiles are calculated in one np.quantile call. If the hours have
+    different numbers of samples, use one groupby for all quantiles instead.
+
     Args:
-        ypred_df: prediction dataframe
+        ypred_df: prediction series indexed by the timestamp
         q_list: a list of quantile to calculate
+        method(optional): 'exact' or 'p2' to estimate the quantiles in fixed memory using P2Band [default:'exact']
     
     Returns: dataframe
 
+    Raises:
+        AssertionError: if method is 'p2' and the hours have different numbers of samples
+
     """
-    band_df = []
-    for q in q_list:
-    
-        band = ypred_df.groupby(level=0).quantile(q=q)
-        band_index = band.index
-        #band = smooth(band.values,window_len=41)
-    
-        band_df.append(pd.DataFrame(band, index=band_index, columns=['q'+ str(q)]))
-    
-    return pd.concat(band_df, axis=1)
+    band_index, values = _hour_matrix(ypred_df)
+    columns = ['q' + str(q) for q in q_list]
+
+    if method == 'p2':
+        assert values is not None, 'p2 method needs the same number of samples for each hour'
+        band = P2Band(band_index, q_list=q_list)
+        band.update(values)
+        return band.band()
+
+    if values is None:
+        band_df = pd.Series(np.asarray(ypred_df.values, dtype=float), index=ypred_df.index).groupby(level=0).quantile(q=q_list).unstack()
+        band_df = band_df[q_list]
+        band_df.columns = columns
+        return band_df
+
+    return pd.DataFrame(np.quantile(values, q_list, axis=1).T, index=band_index, columns=columns)
+
+def get_cut_cols(data_samples, features):
+    """Return the columns of data_samples which contain any of the feature names.
+
+    """
+    cols_to_cut = []
+    for feature in features:
+        cols_to_cut = cols_to_cut + data_samples.columns[data_samples.columns.str.contains(feature)].to_list()
+    return list(dict.fromkeys(cols_to_cut))
+
+
+def predict_senarios(model, x, scales, chunk_rows=500000):
+    """Predict a stack of senarios of x in batches. Senario s is x with each column multiplied by scales[s].
+
+    The senarios differ only in the scaled columns. A row is predicted once for all senarios with the same
+    scaled values, for example zero fire or no reduction, and the unique rows of all senarios are predicted
+    together in one model.predict call per chunk.
+
+    Args:
+        model: model for prediction
+        x: 2D array of x data
+        scales: 2D array of column scales with shape (number of senarios, number of columns)
+        chunk_rows(optional): maximum number of rows per model.predict call [default:500,000]
+
+    Returns: np.array
+        predictions with shape (number of senarios, len(x))
+
+    """
+    x = np.asarray(x, dtype=float)
+    scales = np.atleast_2d(np.asarray(scales, dtype=float))
+    n_senarios = len(scales)
+    cut = np.flatnonzero((scales != 1).any(axis=0))
+    senario_index = np.arange(n_senarios)[:, None]
+
+    y = np.empty((n_senarios, len(x)))
+    step = max(1, chunk_rows // n_senarios)
+    for start in range(0, len(x), step):
+        xc = x[start:start + step]
+        rows = np.arange(len(xc))
+        # same computation as multiplying the columns of the senario matrix
+        cut_values = xc[None, :, cut] * scales[:, None, cut]
+
+        # first senario with the same values for each row
+        first = np.repeat(senario_index, len(xc), axis=1)
+        for s in range(1, n_senarios):
+            for j in range(s):
+                same = (first[s] == s) & (cut_values[s] == cut_values[j]).all(axis=1)
+                first[s, same] = j
+
+        unique_s, unique_row = np.nonzero(first == senario_index)
+        x_unique = xc[unique_row]
+        x_unique[:, cut] = cut_values[unique_s, unique_row]
+        position = np.empty(first.shape, dtype=int)
+        position[unique_s, unique_row] = np.arange(len(unique_s))
+
+        y[:, start:start + step] = model.predict(x_unique)[position[first, rows]]
+
+    return y
+
+
+def make_senarios(model, data_samples, senario_list):
+    """Make prediction of the data sample for a list of senarios in one batch. See predict_senarios.
+
+    Args:
+        model: model for prediction
+        data_samples: test data sample for different data
+        senario_list: a list of (features, per_cut). The columns containing the features are reduced by per_cut
+
+    Returns: pd.DataFrame
+        predicted values with one column per senario
+
+    """
+    scales = np.ones((len(senario_list), data_samples.shape[1]))
+    for i, (features, per_cut) in enumerate(senario_list):
+        scales[i, data_samples.columns.get_indexer(get_cut_cols(data_samples, features))] = 1 - per_cut
+
+    y = predict_senarios(model, data_samples.values, scales)
+    return pd.DataFrame(y.T, index=data_samples.index)
+
 
 def make_senario(model, data_samples, features, per_cut):
     """Make prediction of the data sample with some feature value reduced. 
@@ -275,78 +597,99 @@ def make_senario(model, data_samples, features, per_cut):
         data_samples: test data sample for different data
         features: columns to cut down
         per_cut: percent reduction must be between 0 - 1
-        x_cols: x_columns to use for the model
 
-    Returns: pd.DataFrame, pd.DataFrame
+    Returns: pd.Series
         ypred_df: predicted value for calculate band
 
     """
-    cols_to_cut = []
-    
+    return make_senarios(model, data_samples, [(features, per_cut)])[0]
 
-    for feature in features:
-        cols_to_cut = cols_to_cut + data_samples.columns[data_samples.columns.str.contains(feature)].to_list()
-    
-    data_senario = data_samples.copy()
-    data_senario[cols_to_cut] = data_samples[cols_to_cut]*(1-per_cut)
-    x = data_senario.values
-    y = model.predict(x)
 
-    return pd.Series(y, index = data_samples.index)
+def make_senario_curves(model, data_samples, features, cut_range=(0, 1), max_mb=2000):
+    """Precompute the prediction of the data sample for any reduction of the features in cut_range.
 
+    One traversal of the forest records the breakpoints of each sample where the reduction changes a leaf.
+    See CompactForest.scale_curves. The precomputation costs many predict calls, and pays off when
+    many reduction levels are needed.
+
+    The curves keep every breakpoint, tens of kB per sample for a large forest, so they only fit for a limited
+    number of samples. Use senarios_from_forest for a fixed red_list over many samples.
 
-def cal_season_band(band_df, sea_error):
-    """Convert daily prediction to seasonal prediction 
-    
     Args:
-        band_df: daily prediction value after rolling average
-        sea_error: seasonal prediction error 
-    
+        model: forest model or CompactForest
+        data_samples: test data sample for different data
+        features: columns to cut down
+        cut_range(optional): range of the reduction fraction [default:(0, 1)]
+        max_mb(optional): maximum estimated size of the curves in MB [default:2000]
+
+    Returns: ScaleCurves
+        curves of the scale 1 - per_cut. Use senarios_from_curves to read the predictions
+
+    Raises:
+        AssertionError: if the estimated size of the curves exceeds max_mb
+
+    """
+    cut = data_samples.columns.get_indexer(get_cut_cols(data_samples, features))
+    return compact_forest(model).scale_curves(data_samples.values, cut, scale_range=(1 - cut_range[1], 1 - cut_range[0]),
+                                              max_mb=max_mb)
+
+
+def senarios_from_curves(curves, data_samples, red_list):
+    """Read the predictions of the reductions in red_list from the curves of make_senario_curves.
+
     Returns: pd.DataFrame
-        seasonal prediction with error corrected 
+        predicted values with one column per reduction. Same as make_senarios
 
     """
-    sea_pred, _ = season_avg(band_df, cols=[], roll=True, agg='mean', offset=182)
-    sea_pred = sea_pred.groupby('winter_day').mean()
-    sea_pred = sea_pred.drop(['dayofyear','year'],axis=1)
+    y = curves.predict(1 - np.array(red_list, dtype=float))
+    return pd.DataFrame(y.T, index=data_samples.index)
 
 
-    # Correct bias 
-    for col in sea_pred.columns:
-        sea_pred[col] += sea_error['error'] 
+def senarios_from_forest(model, data_samples, features, red_list):
+    """Predict the reductions in red_list of the features from the curves of one chunk of samples at a time.
 
-    return sea_pred
+    Same as senarios_from_curves(make_senario_curves(...)), without keeping the curves of all samples.
+    See CompactForest.predict_scales.
 
-def _reduct_effect_q(model, data_samples, features, sea_error, q, per_cut):
-    """Calculate the reduction effect of a single q value.
+    Returns: pd.DataFrame
+        predicted values with one column per reduction. Same as make_senarios
+
+    """
+    cut = data_samples.columns.get_indexer(get_cut_cols(data_samples, features))
+    y = compact_forest(model).predict_scales(data_samples.values, cut, 1 - np.array(red_list, dtype=float))
+    return pd.DataFrame(y.T, index=data_samples.index)
 
-    Convert to seasonal pattern 
 
+def cal_season_band(band_df, sea_error):
+    """Convert daily prediction to seasonal prediction 
+    
     Args:
-        model: model for prediction
-        data_samples: weather and fire data 
-        features: a list of features to reduce
-        sea_error: correction factor by dayofyear
-        q: quantile value to sample from 
+        band_df: daily prediction value after rolling average
+        sea_error: seasonal prediction error 
     
-    Returns: seasonal pattern dataframe 
-        
+    Returns: pd.DataFrame
+        seasonal prediction with error corrected 
+
     """
-    ypred_df = make_senario(model, data_samples, features, per_cut= per_cut)
-    band_df = make_band(ypred_df, q_list=[q])
-    
-    sea_pred = cal_season_band(band_df, sea_error)
-    sea_pred.columns = [int(round(1-per_cut,2)*100)]
+    sea_pred = season_mean(band_df, cols=[], roll=True, offset=182)
 
-    #data_senario = make_band(data_senario, q_list=[0.5])
-    #data_senario = cal_season_band(data_senario, pd.DataFrame(np.zeroes(len(data_senario)), index=data_senario.index))
-    #data_senario.columns = [int(round(1-per_cut,2)*100)]
+    # Correct bias 
+    return sea_pred.add(sea_error['error'].reindex(sea_pred.index), axis=0)
 
-    return sea_pred
+def _season_effect(ypred_all, sea_error, q, red_list):
+    # seasonal pattern of each reduction. The columns of ypred_all are in the order of red_list
+    # aggregate the bands of all reductions at once
+    band_df = pd.concat([make_band(ypred_all[col], q_list=[q]).iloc[:, 0].rename(i) for i, col in enumerate(ypred_all.columns)], axis=1)
+    sea_pred_all = cal_season_band(band_df, sea_error)
+    sea_pred_all.columns = [int(round(1-per_cut,2)*100) for per_cut in red_list]
+    return sea_pred_all
 
-def reduc_effect(model, data_samples, features, sea_error, q, red_list= [0.90, 0.75, 0.5, 0.25, 0.10, 0] ):
+def reduc_effect(model, data_samples, features, sea_error, q, red_list= [0.90, 0.75, 0.5, 0.25, 0.10, 0], curves=None):
     """Calculate effect of reduction for feature. 
 
+    All reductions are predicted in one batch. See make_senarios. If curves is given, read the predictions
+    from the curves instead.
+
     Args:
         model: model for prediction
         data_samples: weather and fire data 
@@ -354,24 +697,18 @@ def reduc_effect(model, data_samples, features, sea_error, q, red_list= [0.90, 0
         sea_error: correction factor by dayofyear
         q: quantile value to sample from 
         red_list: list of reduction fraction 
+        curves(optional): curves of the features from make_senario_curves [default:None]
 
     Return:
         sea_pred_all 
 
     """
-    # sea_pred_all = []
-   
-    # for per_cut in  red_list:    
-    #     ypred_df = make_senario(model, data_samples, features, per_cut= per_cut)
-    #     band_df = make_band(ypred_df, q_list=[q])
-    #     sea_pred = cal_season_band(band_df, sea_error)
-    #     sea_pred.columns = [round(1-per_cut,2)]
-    #     sea_pred_all.append(sea_pred)
-
-    sea_pred_all = Parallel(n_jobs=2)(delayed(_reduct_effect_q)(model, data_samples, features, sea_error, q, per_cut) for per_cut in red_list)
-
+    if curves is None:
+        ypred_all = make_senarios(model, data_samples, [(features, per_cut) for per_cut in red_list])
+    else:
+        ypred_all = senarios_from_curves(curves, data_samples, red_list)
 
-    return  pd.concat(sea_pred_all,axis=1)
+    return _season_effect(ypred_all, sea_error, q, red_list)
 
 
 class Inferer():
@@ -412,6 +749,7 @@ class Inferer():
         else:
             # load model and add as attribute
             self.dataset, self.model, fire_cols, self.zone_list, self.feat_imp, self.rolling_win = load_model1(city=city_name, pollutant=pollutant, split_list=split_list)
+            self.split_list = split_list
             self.cal_error()
             self.report_folder = self.dataset.report_folder
 
@@ -430,9 +768,12 @@ class Inferer():
         self.sea_error = cal_season_error(self.trn_error, roll_win=14, agg='mean')
         print('max error', np.max(self.sea_error.values))
 
-    def _get_data_sample(self, n_samples=100, step=1,day_err=10,hour_err=2):
+    def _get_data_sample(self, n_samples=100, step=1,day_err=10,hour_err=2, random_state=0, n_jobs=1, use_cache=True):
         """Sample the possible test data from train data. Add as data_samples attribute
 
+        The samples are saved in model_folder/data_samples/ under the hash of the model, the dataset data, split_list,
+        the sampling parameters and random_state, and loaded memory mapped by the next call with the same key.
+
         Args:
 
             Args:
@@ -440,10 +781,25 @@ class Inferer():
                 step: if not 1, skip some data to make the draw faster 
                 day_err
                 hour_err
+                random_state(optional): random seed. If None, the samples are not cached [default:0]
+                n_jobs(optional): number of worker processes. Does not change the samples [default:1]
+                use_cache(optional): if True, load the samples from the cache or save them [default:True]
 
         """
-        print('obtaining inference samples. This will take about 20 mins') 
-        self.data_samples = get_data_samples(dataset=self.dataset, n_samples=n_samples,step=step,day_err=day_err,hour_err=day_err)
+        use_cache = use_cache and (random_state is not None)
+        if use_cache:
+            key, key_hash = sample_cache_key(self.model, self.dataset, self.split_list, n_samples, step, day_err, hour_err,
+                                             random_state)
+            cache_folder = self.dataset.model_folder + 'data_samples/' + key_hash
+            self.data_samples = load_data_samples(cache_folder)
+            if self.data_samples is not None:
+                print('load inference samples from', cache_folder)
+                return
+
+        self.data_samples = get_data_samples(dataset=self.dataset, n_samples=n_samples,step=step,day_err=day_err,hour_err=hour_err,
+                                             random_state=random_state, n_jobs=n_jobs)
+        if use_cache:
+            save_data_samples(self.data_samples, cache_folder, key)
 
     def compare_inf_act(self, q_list=[ 0.5, 0.75,  0.95]):
         """Compare inference and actual data. Save the results plot. 
@@ -474,17 +830,18 @@ class Inferer():
         plot_infer_season(self.dataset.poll_df.loc['2015-01-01':], self.dataset.pollutant, sea_pred, self.color_zip, filename=self.report_folder+'test_data_vs_inference_season.png' )
 
     
-    def features_effect_season(self, features:list, q, red_list=[0, 0.1, 0.25, 0.5, 0.75, 0.9], save=False):
+    def features_effect_season(self, features:list, q, red_list=[0, 0.1, 0.25, 0.5, 0.75, 0.9], save=False, curves=None):
         """Show an effect of reducing feature or features on the seasonal patterns 
 
         Args: 
             features: a list of feature to observe
             q: quantile for picking the inference distribution [default:0.75]
             red_list: a list of reducting 
+            curves(optional): curves of the features from make_senario_curves. Use for a long red_list [default:None]
 
         """
 
-        fea_effect = reduc_effect(self.model, self.data_samples, features, self.sea_error, q=q, red_list= red_list)
+        fea_effect = reduc_effect(self.model, self.data_samples, features, self.sea_error, q=q, red_list= red_list, curves=curves)
 
         _, ax = plt.subplots(1, 1, figsize=(10, 4))
 
@@ -521,10 +878,15 @@ class Inferer():
             
         """
 
+        # predict the reductions of all features in one batch
+        senario_list = [(feature, per_cut) for feature in features_list for per_cut in red_list]
+        ypred_all = make_senarios(self.model, self.data_samples, senario_list)
+
         fea_effect_df = []
         columns_list = []
-        for feature in tqdm_notebook(features_list):
-            sea_pred_all = reduc_effect(self.model, self.data_samples, feature, self.sea_error, q=q, red_list= red_list )
+        for i, feature in enumerate(features_list):
+            ypred_df = ypred_all.iloc[:, i * len(red_list):(i + 1) * len(red_list)]
+            sea_pred_all = _season_effect(ypred_df, self.sea_error, q, red_list)
             sea_pred_all_mean = sea_pred_all.loc[time_range[0]:time_range[1]].agg(agg)
             columns_list.append(' & '.join(feature))
             fea_effect_df.append(sea_pred_all_mean)
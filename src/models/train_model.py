@@ -4,6 +4,7 @@ from ..gen_functions import *
 from ..features.dataset import Dataset
 from ..visualization.vis_model import *
 from .predict_model import *
+from .forest import *
 
 
 def load_meta(meta_filename:str):
@@ -38,8 +39,290 @@ def save_meta(meta_filename:str, model_meta):
     with open(meta_filename, 'w') as f:
         json.dump(model_meta, f)
 
-def do_rf_search(x_trn:np.array, y_trn:np.array, cv_split:str='time', n_splits:int=5,param_dict:dict=None, x_tree=False, n_jobs=-2):
+
+def _json_value(value):
+    # convert numpy scalar to python value for json
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def trial_context(*items):
+    """Return a fingerprint of the data, splits, columns and model used to score the trials of a search.
+
+    The prior scores are only reused by a search with the same context. Dataframes, series and indexes are hashed
+    with pd.util.hash_pandas_object, arrays by their bytes and the other items by their json.
+
+    Args:
+        items: data, index, array, list or dictionary such as the model parameters
+
+    Returns: str
+        sha1 hex digest
+
+    """
+    h = hashlib.sha1()
+    for item in items:
+        # the type and shape separate the items, so a different split of the same rows is a different context
+        h.update(f'{type(item).__name__}{getattr(item, "shape", None)};'.encode())
+        if isinstance(item, (list, tuple)) and any(isinstance(i, (pd.DataFrame, pd.Series, pd.Index, np.ndarray)) for i in item):
+            h.update(trial_context(*item).encode())
+        elif isinstance(item, pd.DataFrame):
+            h.update(json.dumps([str(col) for col in item.columns]).encode())
+            h.update(pd.util.hash_pandas_object(item, index=True).values.tobytes())
+        elif isinstance(item, (pd.Series, pd.Index)):
+            h.update(pd.util.hash_pandas_object(item, index=isinstance(item, pd.Series)).values.tobytes())
+        elif isinstance(item, np.ndarray):
+            h.update(str(item.dtype).encode())
+            h.update(np.ascontiguousarray(item).tobytes())
+        else:
+            h.update(json.dumps(item, sort_keys=True, default=str).encode())
+
+    return h.hexdigest()
+
+
+def load_trials(trial_file:str, search:str):
+    """Load the trials of a search from the trial file. 
+
+    The trial file keeps one json record per line with 'search', 'params', 'score' (smaller better), 'context' and
+    'date' keys. See trial_context.
+
+    Args:
+        trial_file: trial filename, for example model_folder + 'PM25_trials.jsonl'
+        search: name of the search such as 'fire', 'lag', 'lag_fire' or 'rf'
+
+    Returns: list
+        a list of (params, score, context) of the search. Empty if the file does not exist
+
+    """
+    trials = []
+    if (trial_file is None) or (not os.path.exists(trial_file)):
+        return trials
+
+    with open(trial_file) as f:
+        for line in f:
+            record = json.loads(line)
+            if (record['search'] == search) and np.isfinite(record['score']):
+                trials.append((record['params'], record['score'], record.get('context')))
+
+    return trials
+
+
+def save_trials(trial_file:str, search:str, param_list:list, score_list:list, context:str=None):
+    """Append the evaluated parameters and scores of a search to the trial file. See load_trials.
+
+    Args:
+        trial_file: trial filename. Do nothing if None
+        search: name of the search
+        param_list: a list of parameter dictionaries
+        score_list: a list of scores (smaller better)
+        context(optional): fingerprint of the data used for the scores. See trial_context [default:None]
+
+    """
+    if trial_file is None:
+        return
+
+    date_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with open(trial_file, 'a') as f:
+        for params, score in zip(param_list, score_list):
+            record = {'search': search,
+                      'params': {k: _json_value(v) for k, v in params.items()},
+                      'score': float(score),
+                      'context': context,
+                      'date': date_str}
+            f.write(json.dumps(record) + '\n')
+
+
+def get_warm_start(trial_file:str, search:str, dimensions:list, n_max:int, context:str=None):
+    """Return the best prior trials of a search inside the search space for the optimizer.
+
+    Only the trials scored with the same context keep their scores. The best trials with another context, for
+    example scored before the data or the splits changed, are returned without scores to be evaluated again.
+    A parameter evaluated more than once keeps the latest score.
+
+    Args:
+        trial_file: trial filename
+        search: name of the search
+        dimensions: a list of named search space dimensions
+        n_max: maximum number of trials to return
+        context(optional): fingerprint of the current data. See trial_context. If None, no score is reused [default:None]
+
+    Returns: (list, list, list)
+        x0 and y0 of the trials with the same context, and x of the other trials to evaluate again
+
+    """
+    names = [dim.name for dim in dimensions]
+    latest = {}
+    stale = {}
+    for params, score, trial_ctx in load_trials(trial_file, search):
+        if not all(name in params for name in names):
+            continue
+        x = tuple(params[name] for name in names)
+        if not all(value in dim for value, dim in zip(x, dimensions)):
+            continue
+        if (context is not None) and (trial_ctx == context):
+            latest[x] = score
+        else:
+            stale[x] = score
+
+    best = sorted(latest.items(), key=lambda item: item[1])[:n_max]
+    x0 = [list(x) for x, _ in best]
+    y0 = [score for _, score in best]
+    stale = sorted([item for item in stale.items() if item[0] not in latest], key=lambda item: item[1])
+    x_stale = [list(x) for x, _ in stale[:n_max - len(x0)]]
+    return x0, y0, x_stale
+
+def get_rf_candidates(trial_file:str, param_dict:dict, n_iter:int=100, context:str=None):
+    """Return the parameter candidates for a warm started random forest search.
+
+    Use the best n_iter/4 prior trials inside param_dict and n_iter/4 new random candidates, so the warm
+    started search fits half of the candidates of a new search. The prior trials with the same context rank
+    before the others. All candidates are scored again.
+
+    Args:
+        trial_file: trial filename
+        param_dict: search parameter dictionary
+        n_iter(optional): number of candidates of a new search [default:100]
+        context(optional): fingerprint of the current data. See trial_context [default:None]
+
+    Returns: list
+        a list of parameter dictionaries. Empty if there is no prior trial
+
+    """
+    latest = {}
+    for params, score, trial_ctx in load_trials(trial_file, 'rf'):
+        if (set(params) == set(param_dict)) and all(v in list(param_dict[k]) for k, v in params.items()):
+            latest[json.dumps(params, sort_keys=True)] = ((context is None) or (trial_ctx != context), score)
+    if len(latest) == 0:
+        return []
+
+    best = sorted(latest.items(), key=lambda item: item[1])[:n_iter // 4]
+    candidates = [json.loads(key) for key, _ in best]
+    for params in ParameterSampler(param_dict, n_iter // 4, random_state=40):
+        params = {k: _json_value(v) for k, v in params.items()}
+        if params not in candidates:
+            candidates.append(params)
+
+    return candidates
+
+
+def get_rf_param_dict(x_trn:np.array, x_tree=False):
+    """Return the default search parameter dictionary of do_rf_search.
+
+    """
+    if x_tree:
+        param_dict = {
+            'n_estimators':range(20,200,20),
+            'min_samples_split' : [2, 5, 10, 20, 50],
+            'criterion': ['mse', 'mae'],
+            'max_depth': [3, None],
+            'max_features' : ['auto','sqrt','log2']}
+    else:
+        param_dict = {'n_estimators':range(20,200,20),
+          'max_depth': [3, None],
+          'min_samples_split' : [2, 5, 10, 20, 50], 
+          'max_features' : ['auto','sqrt','log2'],
+           'bootstrap' : [True, False],
+          'min_samples_leaf': range(1, x_trn.shape[1] )}
+
+    return param_dict
+
+
+def _cv_score(model, params, x, y, cv):
+    # mean cross validation score of the model with params
+    return np.mean(cross_val_score(clone(model).set_params(**params), x, y, cv=cv, error_score=np.nan))
+
+
+def _fewer_trees(params, fraction, min_trees, n_trees):
+    # params with a fraction of the trees, but no less than min_trees
+    n_trees = params.get('n_estimators', n_trees)
+    return dict(params, n_estimators=max(int(n_trees * fraction), min(min_trees, n_trees)))
+
+
+def halving_search(model, candidates:list, x:np.array, y:np.array, cv=5, factor:int=3, resource:str='n_samples',
+                   min_resource:int=None, time_budget:float=None, n_jobs=-2, random_state=40):
+    """Successive halving search over a list of parameter candidates.
+
+    Each rung scores the remaining candidates with cross validation using a fraction of the resource and promotes
+    the best 1/factor to the next rung. The resource is either 'n_samples', a random subsample of the rows kept in
+    time order, or 'n_estimators', a fraction of the trees of each candidate. The last rung uses the full resource.
+    If time_budget is given, stop before a rung once the budget is used and keep the best candidate so far.
+
+    Args:
+        model: model object
+        candidates: a list of parameter dictionaries
+        x: 2D array of x data
+        y: array of y data
+        cv(optional): cross validation object or number of folds [default:5]
+        factor(optional): fraction of the candidates promoted and growth of the resource per rung [default:3]
+        resource(optional): 'n_samples' or 'n_estimators' [default:'n_samples']
+        min_resource(optional): resource of the first rung. If None, use 500 rows or 10 trees [default:None]
+        time_budget(optional): time budget in seconds [default:None]
+        n_jobs(optional): number of CPU use [default:-2]
+        random_state(optional): random seed for the subsample [default:40]
+
+    Returns: (dict, float, int, bool)
+        best parameters, best cross validation score of the last finished rung, the number of fits and whether the
+        last rung with the full resource finished. Otherwise the score is on a fraction of the resource
+
+    Raises:
+        AssertionError: if the resource is not 'n_samples' or 'n_estimators'
+
+    """
+    if resource not in ['n_samples', 'n_estimators']:
+        raise AssertionError('resource must be n_samples or n_estimators')
+
+    start_time = time.time()
+    if resource == 'n_samples':
+        max_resource = len(x)
+        if min_resource is None:
+            min_resource = 500
+    else:
+        max_resource = max(params.get('n_estimators', model.get_params()['n_estimators']) for params in candidates)
+        if min_resource is None:
+            min_resource = 10
+    min_resource = min(min_resource, max_resource)
+
+    # number of rungs is limited by the number of candidates and the resource
+    n_rungs = 1 + int(np.floor(min(np.log(len(candidates)), np.log(max_resource / min_resource)) / np.log(factor)))
+    n_folds = check_cv(cv).get_n_splits(x, y)
+    rng = np.random.default_rng(random_state)
+
+    n_fits = 0
+    completed = False
+    best_params, best_score = candidates[0], -np.inf
+    for rung in range(n_rungs):
+        if (time_budget is not None) and (rung > 0) and (time.time() - start_time > time_budget):
+            print(f'time budget used after {rung} rungs')
+            break
+
+        fraction = factor ** (rung - n_rungs + 1)
+        rung_candidates = candidates
+        xr, yr = x, y
+        if resource == 'n_samples':
+            rows = np.sort(rng.choice(len(x), size=max(int(len(x) * fraction), min_resource), replace=False))
+            xr, yr = x[rows], y[rows]
+        else:
+            rung_candidates = [_fewer_trees(params, fraction, min_resource, max_resource) for params in candidates]
+
+        scores = Parallel(n_jobs=n_jobs)(delayed(_cv_score)(model, params, xr, yr, cv) for params in rung_candidates)
+        n_fits += len(candidates) * n_folds
+
+        # failed fits have nan score
+        scores = np.nan_to_num(scores, nan=-np.inf)
+        order = np.argsort(scores)[::-1]
+        best_params, best_score = candidates[order[0]], scores[order[0]]
+        candidates = [candidates[i] for i in order[:int(np.ceil(len(candidates) / factor))]]
+        completed = rung == n_rungs - 1
+
+    return best_params, best_score, n_fits, completed
+
+
+def do_rf_search(x_trn:np.array, y_trn:np.array, cv_split:str='time', n_splits:int=5,param_dict:dict=None, x_tree=False, n_jobs=-2, trial_file=None, n_iter=100, search_mode='random', time_budget=None, resource='n_samples'):
     """Perform randomize parameter search for randomforest regressor return the best estimator 
+
+    If trial_file has prior trials, search the best prior parameters and fewer random candidates instead.
+    See get_rf_candidates. The cross validation scores are appended to trial_file with the fingerprint of the data,
+    the splits and the model. See trial_context.
+
+    If search_mode is 'halving', use successive halving over the same candidates. See halving_search.
     
     Args: 
         x_trn: 2D array of x data 
@@ -49,9 +332,15 @@ def do_rf_search(x_trn:np.array, y_trn:np.array, cv_split:str='time', n_splits:i
         params_dict(optional): search parameter dictionary [default:None]
         x_tree(optional): if True, use ExtraTreesRegressor instead of RandomForestRegressor
         n_jobs(optional): number of CPU use [default:-1]
+        trial_file(optional): trial filename to warm start and record the search. See load_trials [default:None]
+        n_iter(optional): number of random candidates [default:100]
+        search_mode(optional): 'random' or 'halving' [default:'random']
+        time_budget(optional): time budget in seconds for the halving search [default:None]
+        resource(optional): resource of the halving search. 'n_samples' or 'n_estimators' [default:'n_samples']
 
     Returns: best estimator 
     """
+    start_time = time.time()
     if x_tree:
         m = GradientBoostingRegressor(random_state=42)
     else:
@@ -59,39 +348,68 @@ def do_rf_search(x_trn:np.array, y_trn:np.array, cv_split:str='time', n_splits:i
         m = RandomForestRegressor(random_state=42)
     
     if param_dict==None:
-        if x_tree:
-
-            param_dict = {
-                'n_estimators':range(20,200,20),
-                'min_samples_split' : [2, 5, 10, 20, 50],
-                'criterion': ['mse', 'mae'],
-                'max_depth': [3, None],
-                'max_features' : ['auto','sqrt','log2']}
-        else:
-            param_dict = {'n_estimators':range(20,200,20),
-              'max_depth': [3, None],
-              'min_samples_split' : [2, 5, 10, 20, 50], 
-              'max_features' : ['auto','sqrt','log2'],
-               'bootstrap' : [True, False],
-              'min_samples_leaf': range(1, x_trn.shape[1] )}
+        param_dict = get_rf_param_dict(x_trn, x_tree=x_tree)
     
     if cv_split =='time':
         cv = TimeSeriesSplit(n_splits=n_splits)
         
     else:
         cv = n_splits
+    # the scores depend on the data, the splits and the model
+    context = trial_context(x_trn, y_trn, cv_split, n_splits, type(m).__name__)
     #hyper parameter tuning
-    search = RandomizedSearchCV(m, param_distributions=param_dict,
-                            n_iter=100,n_jobs=n_jobs, cv=cv, random_state=40)
+    candidates = get_rf_candidates(trial_file, param_dict, n_iter=n_iter, context=context)
+    if len(candidates) > 0:
+        print(f'warm start from {len(candidates)} candidates')
+
+    if search_mode == 'halving':
+        if len(candidates) == 0:
+            candidates = [{k: _json_value(v) for k, v in params.items()}
+                          for params in ParameterSampler(param_dict, n_iter, random_state=40)]
+        best_params, best_score, n_fits, completed = halving_search(m, candidates, x_trn, y_trn, cv=cv,
+                                                                    resource=resource, time_budget=time_budget,
+                                                                    n_jobs=n_jobs)
+        # only the score of the last rung, on the full data with all trees, is comparable with the other trials
+        if completed:
+            save_trials(trial_file, 'rf', [best_params], [-best_score], context=context)
+        best_estimator = clone(m).set_params(**best_params).fit(x_trn, y_trn)
+        n_fits += 1
+
+    else:
+        if len(candidates) > 0:
+            search = GridSearchCV(m, param_grid=[{k: [v] for k, v in params.items()} for params in candidates],
+                                  n_jobs=n_jobs, cv=cv)
+        else:
+            search = RandomizedSearchCV(m, param_distributions=param_dict,
+                                n_iter=n_iter,n_jobs=n_jobs, cv=cv, random_state=40)
 
-    search.fit(x_trn,y_trn)
+        search.fit(x_trn,y_trn)
+        # the score of the search is higher better
+        save_trials(trial_file, 'rf', search.cv_results_['params'], -search.cv_results_['mean_test_score'],
+                    context=context)
+        best_params, best_score, best_estimator = search.best_params_, search.best_score_, search.best_estimator_
+        n_fits = len(search.cv_results_['params']) * search.n_splits_ + 1
     
-    print(search.best_params_, search.best_score_)
+    print(best_params, best_score)
+    print(f'{search_mode} search: {n_fits} fits in {time.time() - start_time:.1f} s')
     
-    return search.best_estimator_
+    return best_estimator
+
+def _score_cols(col_idx, xtrn, ytrn, xval, yval, model):
+    # validation r2 score of the model using the columns col_idx of the shared matrices
+    model = clone(model).fit(xtrn[:, col_idx], ytrn)
+    return cal_scores(yval, model.predict(xval[:, col_idx]), header_str='')['r2_score']
+
 
-def reduce_cols(dataset, x_cols:list, to_drop:list, model,trn_i, val_i):
+def reduce_cols(dataset, x_cols:list, to_drop:list, model,trn_i, val_i, n_jobs=-2):
     """Try droping the columns in to_drop. Keep track of the columns which can be remove from the model.
+
+    A column is dropped if the validation score without it is higher than the score of the current columns.
+    The score of the current columns is only recalculated when a column is dropped, and it is the score
+    of the candidate that was dropped. The candidates are evaluated in batches, one per worker, from the
+    training and validation matrices of x_cols built once. When a candidate in a batch is dropped, the
+    candidates after it are evaluated again with the new columns, so the result is the same as trying
+    the columns one at a time.
     
     Args:
         dataset: dataset object
@@ -100,6 +418,7 @@ def reduce_cols(dataset, x_cols:list, to_drop:list, model,trn_i, val_i):
         model: model object to fit and predict
         trn_i: index in dataset.split_list for training data 
         val_i: index in dataset.split_list for validation data
+        n_jobs(optional): number of worker processes [default:-2]
     
     Returns:
         model: fitted model
@@ -109,41 +428,163 @@ def reduce_cols(dataset, x_cols:list, to_drop:list, model,trn_i, val_i):
     print('old cols length', len(x_cols))
     trn_index = dataset.split_list[trn_i]
     val_index = dataset.split_list[val_i]
-    
-    for col in to_drop:
-        
-        xtrn, ytrn, x_cols = dataset.get_data_matrix(use_index=trn_index,x_cols=x_cols)
-        xval, yval, _ = dataset.get_data_matrix(use_index=val_index,x_cols=x_cols)
-        
-        # obtain the baseline data
-        model.fit(xtrn, ytrn)
-        base_score = cal_scores(yval, model.predict(xval), header_str ='')['r2_score']
 
-        new_cols = x_cols.copy()
-        new_cols.remove(col) 
-        xtrn, ytrn, new_x_cols = dataset.get_data_matrix(use_index=trn_index,x_cols=new_cols)
-        xval, yval, _ =  dataset.get_data_matrix(use_index=val_index,x_cols=new_cols)
-     
-        model.fit(xtrn,ytrn)
-        score = cal_scores(yval, model.predict(xval), header_str ='')['r2_score']
-        
-        if score> base_score:
-            x_cols.remove(col)
-            print('drop', col)
-            
-    # obtain the final model 
-    
+    # build the matrices once. Each candidate uses a column mask of the same matrices
     xtrn, ytrn, x_cols = dataset.get_data_matrix(use_index=trn_index,x_cols=x_cols)
     xval, yval, _ = dataset.get_data_matrix(use_index=val_index,x_cols=x_cols)
-    model.fit(xtrn, ytrn)
-    score_dict = cal_scores(yval, model.predict(xval), header_str ='') 
+    keep = np.ones(len(x_cols), dtype=bool)
+    col_pos = np.arange(len(x_cols))
+    matrices = (xtrn, ytrn, xval, yval, model)
+
+    n_workers = joblib.effective_n_jobs(n_jobs)
+    todo = list(to_drop)
+    with Parallel(n_jobs=n_workers) as parallel:
+        # obtain the baseline score
+        base_score = _score_cols(col_pos[keep], *matrices)
+        n_fits = 1
+        while len(todo) > 0:
+            batch = todo[:n_workers]
+            masks = [keep & (col_pos != x_cols.index(col)) for col in batch]
+            scores = parallel(delayed(_score_cols)(col_pos[mask], *matrices) for mask in masks)
+            n_fits += len(batch)
+
+            n_done = len(batch)
+            for i, (col, mask, score) in enumerate(zip(batch, masks, scores)):
+                if score > base_score:
+                    keep = mask
+                    base_score = score
+                    print('drop', col)
+                    # the later candidates of the batch were scored with this column
+                    n_done = i + 1
+                    break
+            todo = todo[n_done:]
+
+    print(f'reduce_cols: {n_fits} fits')
+    # obtain the final model 
+    x_cols = [col for col, use in zip(x_cols, keep) if use]
+    model.fit(xtrn[:, keep], ytrn)
+    score_dict = cal_scores(yval, model.predict(xval[:, keep]), header_str ='') 
     
     print('use columns', x_cols)
     print('score after dropping columns', score_dict)
     return model, x_cols
 
 
-def sk_op_fire(dataset, model, trn_index, val_index, wind_range:list=[2,20],shift_range:list=[-72,72],roll_range:list=[24, 240],vis:bool=False, with_lag=False)-> dict:
+def batch_minimize(func, dimensions, args=(), n_calls: int = 100, n_batch: int = None, n_jobs: int = -2,
+                   random_state: int = 30, trial_file: str = None, search: str = None, context: str = None):
+    """Minimize func with a batched ask/tell Bayesian optimizer.
+
+    Each round the optimizer proposes n_batch candidates at once (constant liar strategy) and evaluates
+    them in a process pool. func must not change its arguments, so the candidates can be evaluated
+    at the same time. Large arrays in args are memory mapped to the workers by joblib instead of copied.
+
+    If trial_file is given, the optimizer is warm started with the best prior trials of the search, up to half of
+    n_calls, and the new trials are appended to the file. Only the prior trials with the same context are told to
+    the optimizer with their scores. The others are evaluated again first. A warm started search evaluates half of
+    n_calls, including the prior trials evaluated again.
+
+    Args:
+        func: module level function func(x, *args) returning the score (smaller better)
+        dimensions: a list of the search space dimensions
+        args(optional): read-only arguments passed to func [default:()]
+        n_calls(optional): number of evaluations of a new search [default:100]
+        n_batch(optional): number of candidates per round. If None, use the number of workers [default:None]
+        n_jobs(optional): number of worker processes [default:-2]
+        random_state(optional): random seed [default:30]
+        trial_file(optional): trial filename for warm start and recording. See load_trials [default:None]
+        search(optional): name of the search in the trial file [default:None]
+        context(optional): fingerprint of the data of func. See trial_context [default:None]
+
+    Returns: OptimizeResult
+        same as the result of gp_minimize
+
+    """
+    n_workers = joblib.effective_n_jobs(n_jobs)
+    if n_batch is None:
+        n_batch = n_workers
+
+    optimizer = Optimizer(dimensions, base_estimator='GP', n_initial_points=10, random_state=random_state)
+    x0, y0, x_stale = get_warm_start(trial_file, search, dimensions, n_max=n_calls // 2, context=context)
+    if len(x0) > 0:
+        print(f'warm start from {len(x0)} prior trials')
+        result = optimizer.tell(x0, y0)
+    if len(x_stale) > 0:
+        print(f'evaluate {len(x_stale)} prior trials scored on other data again')
+
+    n_eval = n_calls
+    if len(x0) + len(x_stale) > 0:
+        # the prior trials replace the first half of the search
+        n_eval = max(n_calls // 2, 1)
+        x_stale = x_stale[:n_eval]
+
+    names = [dim.name for dim in dimensions]
+    n_done = 0
+    with Parallel(n_jobs=min(n_workers, n_batch)) as parallel:
+        while n_done < n_eval:
+            n_points = min(n_batch, n_eval - n_done)
+            if len(x_stale) > 0:
+                x_list, x_stale = x_stale[:n_points], x_stale[n_points:]
+            else:
+                x_list = optimizer.ask(n_points=n_points)
+            y_list = parallel(delayed(func)(x, *args) for x in x_list)
+            result = optimizer.tell(x_list, y_list)
+            n_done += len(x_list)
+            save_trials(trial_file, search, [dict(zip(names, x)) for x in x_list], y_list, context=context)
+
+    return result
+
+
+def get_search_data(dataset, damp_surface='sphere'):
+    """Collect the read-only data needed to evaluate fire and lag candidates without the dataset object.
+
+    Args:
+        dataset: dataset object after dataset.feature_no_fire()
+        damp_surface(optional): damping surface of the fire power [default:'sphere']
+
+    Returns: dict
+
+    """
+    fire_dict = getattr(dataset, 'fire_dict', {})
+    hotspot_wind = None
+    if fire_dict.get('wind', 'constant') == 'observed':
+        hotspot_wind = dataset.get_hotspot_wind()
+
+    return {'data_no_fire': dataset.data_no_fire,
+            'fire': dataset.fire[['distance', 'power']],
+            'hotspot_wind': hotspot_wind,
+            'zone_list': dataset.get_zone_list(),
+            'damp_surface': damp_surface,
+            'fire_dict': dict(fire_dict),
+            'monitor': dataset.monitor,
+            'x_cols_org': list(dataset.x_cols_org)}
+
+
+def merge_search_fire(search_data, wind_speed, shift, roll):
+    """Return the data with the fire feature of the candidate fire parameters. Same as dataset.merge_fire.
+
+    """
+    # keep the other keys such as the wind mode
+    fire_dict = dict(search_data['fire_dict'], w_speed=wind_speed, shift=shift, roll=roll)
+    data, _ = merge_fire_feature(search_data['data_no_fire'], search_data['fire'], fire_dict,
+                                 zone_list=search_data['zone_list'], damp_surface=search_data['damp_surface'],
+                                 hotspot_wind=search_data['hotspot_wind'])
+    return data
+
+
+def _score_fire(x, search_data, model, trn_index, val_index, x_cols, lag_dict=None):
+    # validation error of the fire parameters x = [wind_speed, shift, roll]
+    data = merge_search_fire(search_data, *x)
+    if lag_dict is not None:
+        data_org = data[[search_data['monitor']] + search_data['x_cols_org']]
+        data = build_lag_data(data_org, search_data['x_cols_org'],
+                              np.arange(1, lag_dict['n_max'], lag_dict['step']), roll=lag_dict['roll'])
+
+    model.fit(data.loc[trn_index, x_cols].values, data.loc[trn_index, search_data['monitor']].values)
+    y_pred = model.predict(data.loc[val_index, x_cols].values)
+    return mean_squared_error(data.loc[val_index, search_data['monitor']].values, y_pred)
+
+
+def sk_op_fire(dataset, model, trn_index, val_index, wind_range:list=[2,20],shift_range:list=[-72,72],roll_range:list=[24, 240],vis:bool=False, with_lag=False, n_batch=None, n_jobs=-2, trial_file=None)-> dict:
     """Search for the best fire parameter using skopt optimization 
     
     Args: 
@@ -156,6 +597,12 @@ def sk_op_fire(dataset, model, trn_index, val_index, wind_range:list=[2,20],shif
         roll_range(optional): min and max value of roll parameter
         vis(optional): if True, also plot the search space
         with_lag(optional): if True optimized the data with lag columns 
+        n_batch(optional): number of candidates evaluated at the same time. See batch_minimize [default:None]
+        n_jobs(optional): number of worker processes [default:-2]
+        trial_file(optional): trial filename to warm start and record the search. See batch_minimize [default:None]
+
+    The other keys of dataset.fire_dict are kept. If dataset.fire_dict['wind'] is 'observed', wind_range is the
+    range of the minimum wind speed.
         
     Return: fire_dict fire dictionary 
     
@@ -187,35 +634,22 @@ def sk_op_fire(dataset, model, trn_index, val_index, wind_range:list=[2,20],shif
     roll = Integer(low=roll_range[0],high=roll_range[1], name='roll')
     
     dimensions = [wind_speed, shift, roll]
-    # setup the function for skopt
-    @use_named_args(dimensions)
-    def fit_with( wind_speed, shift, roll):
-        # function to return the score (smaller better)
-        fire_dict = { 'w_speed': wind_speed, 
-                      'shift': shift,
-                      'roll': roll}
-        _, *args = dataset.merge_fire(fire_dict)
-        
-        if with_lag: 
-            dataset.data_org = dataset.data[ [dataset.monitor] + dataset.x_cols_org]
-            dataset.build_lag(lag_range=np.arange(1, dataset.lag_dict['n_max'], dataset.lag_dict['step']), roll=dataset.lag_dict['roll'])
-      
-        xtrn, ytrn, x_cols = dataset.get_data_matrix(use_index= trn_index, x_cols=dataset.x_cols)
-        xval, yval, _ = dataset.get_data_matrix(use_index=val_index, x_cols=dataset.x_cols)
-    
-        model.fit(xtrn,ytrn)
-        y_pred = model.predict(xval)
-    
-        return mean_squared_error(yval,y_pred)
-
-
-    gp_result = gp_minimize(func=fit_with,dimensions=dimensions,n_jobs=-2,random_state=30)
+    # the candidates are evaluated in worker processes from the read-only search data
+    lag_dict = dataset.lag_dict if with_lag else None
+    search_data = get_search_data(dataset)
+    context = trial_context(search_data['data_no_fire'], search_data['fire'], search_data['hotspot_wind'],
+                            search_data['damp_surface'], search_data['fire_dict'].get('wind', 'constant'),
+                            trn_index, val_index, list(x_cols), lag_dict, model.get_params())
+    gp_result = batch_minimize(_score_fire, dimensions,
+                               args=(search_data, model, trn_index, val_index, x_cols, lag_dict),
+                               n_batch=n_batch, n_jobs=n_jobs, random_state=30,
+                               trial_file=trial_file, search='fire_lag' if with_lag else 'fire', context=context)
     
     wind_speed, shift, roll = gp_result.x
     score = gp_result.fun
     if score < best_score:
         print('mean_squared_error for the best fire parameters', gp_result.fun)
-        best_fire_dict = {'w_speed': int(wind_speed), 'shift': int(shift), 'roll': int(roll)}
+        best_fire_dict = dict(dataset.fire_dict, w_speed=int(wind_speed), shift=int(shift), roll=int(roll))
         print('new fire dict', best_fire_dict)
         if vis:
             plot_objective(gp_result)
@@ -225,7 +659,16 @@ def sk_op_fire(dataset, model, trn_index, val_index, wind_range:list=[2,20],shif
     return best_fire_dict, gp_result
 
 
-def op_lag(dataset, model, split_ratio, lag_range=[2, 120], step_range=[1,25]):
+def _score_lag(x, lag_builder, y, valid, split_ratio, model):
+    # validation error of the lag parameters x = [n_max, step]
+    n_max, step = x
+    xy_list = lag_builder.split_data_matrix(y, np.arange(1, n_max, step), split_ratio, roll=True, valid=valid)
+    (xtrn, ytrn), (xval, yval) = xy_list[:2]
+    model.fit(xtrn, ytrn)
+    return mean_squared_error(yval, model.predict(xval))
+
+
+def op_lag(dataset, model, split_ratio, lag_range=[2, 120], step_range=[1,25], n_batch=None, n_jobs=-2, trial_file=None):
     """Search for the best lag parameters using skopt optimization 
     
     Args: 
@@ -234,33 +677,30 @@ def op_lag(dataset, model, split_ratio, lag_range=[2, 120], step_range=[1,25]):
         split_ratio: list of split ratio
         lag_range(optional): min and max value of wind speed 
         step_range(optional): min and max value of shift parameter
+        n_batch(optional): number of candidates evaluated at the same time. See batch_minimize [default:None]
+        n_jobs(optional): number of worker processes [default:-2]
+        trial_file(optional): trial filename to warm start and record the search. See batch_minimize [default:None]
         
     Return: fire_dict fire dictionary 
     
     """
+    if np.sum(split_ratio) > 1:
+        raise AssertionError(
+            'The sum of the splitting ratios must not exceed 1')
+
     # build search space 
     n_max = Integer(low=lag_range[0], high=lag_range[1], name='n_max')
     step = Integer(low=step_range[0], high=step_range[1], name='step')
     #roll = Categorical([True, False], name='roll')
     dimensions = [n_max, step]
     
-    
-    # setup the function for skopt
-    @use_named_args(dimensions)
-    def fit_with(n_max, step):
-        # function to return the score (smaller better)
-        dataset.build_lag(lag_range=np.arange(1, n_max, step), roll=True)
-        dataset.x_cols = dataset.data.columns.drop(dataset.monitor)
-        dataset.split_data(split_ratio=split_ratio)
-        xtrn, ytrn, x_cols = dataset.get_data_matrix(use_index=dataset.split_list[0], x_cols=dataset.x_cols)
-        xval, yval, _ = dataset.get_data_matrix(use_index=dataset.split_list[1], x_cols=dataset.x_cols)
-        model.fit(xtrn,ytrn)
-        y_pred = model.predict(xval)
-        
-        
-        return mean_squared_error(yval,y_pred)
-    
-    gp_result = gp_minimize(func=fit_with,dimensions=dimensions,n_jobs=-2,random_state=30)
+    # each candidate gathers only its lag columns and rows from the shared prefix sums
+    args = (dataset.get_lag_builder(), dataset.data_org[dataset.monitor].values, dataset.get_lag_valid(),
+            split_ratio, model)
+    context = trial_context(dataset.data_org, dataset.monitor, list(dataset.x_cols_org), list(split_ratio),
+                            model.get_params())
+    gp_result = batch_minimize(_score_lag, dimensions, args=args, n_batch=n_batch, n_jobs=n_jobs, random_state=30,
+                               trial_file=trial_file, search='lag', context=context)
     n_max, step = gp_result.x
     lag_dict = {'n_max':int(n_max),
                 'step':int(step),
@@ -271,35 +711,96 @@ def op_lag(dataset, model, split_ratio, lag_range=[2, 120], step_range=[1,25]):
     return lag_dict, gp_result
 
 
-def feat_importance(model, x, y, x_cols, score=r2_score, n_iter=20):
+def get_feature_groups(x_cols:list, group_lag=False):
+    """Return the names and the column positions of the permutation groups.
+
+    Args:
+        x_cols: name of the x columns
+        group_lag(optional): if True, group the _lag_ columns with their base feature [default:False]
+
+    Returns: (list, list)
+        group names and a list of column position arrays
+
+    """
+    if group_lag:
+        names = [col.split('_lag_')[0] for col in x_cols]
+    else:
+        names = list(x_cols)
+    groups = list(dict.fromkeys(names))
+    return groups, [np.flatnonzero(np.array(names) == group) for group in groups]
+
+
+def _permute_scores(col_groups, seeds, x, y, model, score, n_iter, n_batch):
+    # shuffled scores of each column group. Permute the columns of a private copy in place and restore them.
+    # n_batch permutations are stacked and predicted together
+    n_rows = len(x)
+    n_batch = min(n_batch, n_iter)
+    stack = np.tile(np.asarray(x), (n_batch, 1))
+    result = []
+    for col_idx, seed in zip(col_groups, seeds):
+        rng = np.random.default_rng(seed)
+        original = stack[:n_rows, col_idx]
+        shuffle = []
+        for start in range(0, n_iter, n_batch):
+            size = min(n_batch, n_iter - start)
+            for b in range(size):
+                stack[b * n_rows:(b + 1) * n_rows, col_idx] = original[rng.permutation(n_rows)]
+            y_pred = model.predict(stack[:size * n_rows])
+            shuffle += [score(y, y_pred[b * n_rows:(b + 1) * n_rows]) for b in range(size)]
+        for b in range(n_batch):
+            stack[b * n_rows:(b + 1) * n_rows, col_idx] = original
+        result.append(shuffle)
+    return result
+
+
+def feat_importance(model, x, y, x_cols, score=r2_score, n_iter=20, group_lag=False, max_samples=None, n_batch=None,
+                    n_jobs=-2, random_state=None):
     """Computes the feature importance by shuffle the data
+
+    The columns are split among the workers of a process pool, which share the read-only x. Each worker
+    permutes the columns of one copy of x in place and restores them, and predicts n_batch permutations at once.
+    The random streams are spawned per column group, so the result does not depend on n_jobs.
+
     Args:
         model : the model
         x: the training data
         y: target variable
         x_cols: name of the x columns
-        metric: either r2_score of mean_squared_error
+        score(optional): either r2_score of mean_squared_error [default:r2_score]
+        n_iter(optional): number of permutations per column [default:20]
+        group_lag(optional): if True, permute the _lag_ columns of a feature together. See get_feature_groups [default:False]
+        max_samples(optional): number (int) or fraction (float) of rows to use. If None, use all rows [default:None]
+        n_batch(optional): number of permutations per prediction. If None, use about 100,000 rows per prediction [default:None]
+        n_jobs(optional): number of worker processes [default:-2]
+        random_state(optional): random seed [default:None]
     
     Returns: feature of importance pd.DataFrame 
     
     """
- 
+    rng = np.random.default_rng(random_state)
+    if max_samples is not None:
+        if isinstance(max_samples, float):
+            max_samples = int(len(x) * max_samples)
+        if max_samples < len(x):
+            rows = np.sort(rng.choice(len(x), size=max_samples, replace=False))
+            x, y = x[rows], y[rows]
+
+    if n_batch is None:
+        n_batch = max(1, 100000 // len(x))
+
     baseline = score(y, model.predict(x))
-     
-    imp = []
-    imp_std = []
-    for i, col in tqdm_notebook(enumerate(x_cols)):
-        shuffle = []
-        for _ in range(n_iter):
-            shuffle_x = x.copy()
-            shuffle_x[:,i] = np.random.permutation(shuffle_x[:,i])
-            shuffle_score = score(y, model.predict(shuffle_x))
-            shuffle.append(shuffle_score)
-        imp.append(np.mean(shuffle))
-        imp_std.append(np.std(shuffle))
+
+    groups, col_groups = get_feature_groups(x_cols, group_lag=group_lag)
+    seeds = np.random.SeedSequence(rng.integers(2**32)).spawn(len(groups))
+    n_workers = min(joblib.effective_n_jobs(n_jobs), len(groups))
+    chunks = np.array_split(np.arange(len(groups)), n_workers)
+    results = Parallel(n_jobs=n_workers)(
+        delayed(_permute_scores)([col_groups[i] for i in chunk], [seeds[i] for i in chunk], x, y, model, score, n_iter, n_batch)
+        for chunk in chunks)
+    shuffle = np.vstack([scores for result in results for scores in result])
     
     # crate a feature of importance DataFrame
-    fea_imp = pd.DataFrame({'index': x_cols, 'importance':imp,'imp_std':imp_std})
+    fea_imp = pd.DataFrame({'index': groups, 'importance':shuffle.mean(axis=1),'imp_std':shuffle.std(axis=1)})
     # normalized 
     if score.__name__ == 'r2_score':
         fea_imp['importance'] = (baseline - fea_imp['importance'])/baseline
@@ -322,6 +823,9 @@ def train_city_s1(city:str='Chiang Mai', pollutant:str='PM2.5', build=False, mod
         #. Optimization 6: optimize for the best RF again  
         #. Build pollution meta and save
 
+    Every evaluated parameter is appended to model_folder/<pollutant>_trials.jsonl, which warm starts 
+    the searches of the next training. 
+
     Args:
         city: city name
         pollutant(optional): pollutant name
@@ -342,6 +846,8 @@ def train_city_s1(city:str='Chiang Mai', pollutant:str='PM2.5', build=False, mod
     data = Dataset(city)
     # remove . from pollutant name for saving file
     poll_name = pollutant.replace('.','')
+    # record the trials of all searches to warm start the next training
+    trial_file = data.model_folder + f'{poll_name}_trials.jsonl'
     if build:
         # build data from scratch 
         data.build_all_data(build_fire=True,build_holiday=False)
@@ -374,7 +880,7 @@ def train_city_s1(city:str='Chiang Mai', pollutant:str='PM2.5', build=False, mod
         xval, yval, _ = data.get_data_matrix(use_index=data.split_list[1])
         data.x_cols = x_cols
 
-        model = do_rf_search(xtrn,ytrn, cv_split='other')
+        model = do_rf_search(xtrn,ytrn, cv_split='other', trial_file=trial_file)
         score_dict = cal_scores(yval, model.predict(xval), header_str ='val_')
         print('optimize 1 score', score_dict)    
 
@@ -395,7 +901,7 @@ def train_city_s1(city:str='Chiang Mai', pollutant:str='PM2.5', build=False, mod
     
     if fire_dict==None:
         print('================= optimization 3: find the best fire feature ===================')
-        data.fire_dict, gp_result  = sk_op_fire(data, model, trn_index=data.split_list[0], val_index=data.split_list[1])
+        data.fire_dict, gp_result  = sk_op_fire(data, model, trn_index=data.split_list[0], val_index=data.split_list[1], trial_file=trial_file)
         fire_cols, *args = data.merge_fire(data.fire_dict)
 
     if lag_dict==None:
@@ -406,7 +912,7 @@ def train_city_s1(city:str='Chiang Mai', pollutant:str='PM2.5', build=False, mod
         print('model parameters', model.get_params())
         # look for the best lag 
         #data.lag_dict, gp_result = op_lag(data, model, split_ratio=[0.45, 0.25, 0.3])
-        data.lag_dict, gp_result = op_lag(data, model, split_ratio=[0.45, 0.25, 0.3])
+        data.lag_dict, gp_result = op_lag(data, model, split_ratio=[0.45, 0.25, 0.3], trial_file=trial_file)
         #data.lag_dict = {'n_max': 2, 'step': 5}
         data.build_lag(lag_range=np.arange(1, data.lag_dict['n_max'], data.lag_dict['step']), roll=data.lag_dict['roll'])
         #print('data.column with lag', data.data.columns)
@@ -481,7 +987,8 @@ def train_city_s1(city:str='Chiang Mai', pollutant:str='PM2.5', build=False, mod
     print('final score for test set', score_dict)
     
 
-    pickle.dump(model, open(data.model_folder +f'{poll_name}_rf_model.pkl', 'wb'))
+    # save the tree arrays, which load_model1 memory maps
+    save_forest(model, data.model_folder + f'{poll_name}_rf_model')
 
     # build feature of importance using build in rf
     try: 
@@ -491,7 +998,7 @@ def train_city_s1(city:str='Chiang Mai', pollutant:str='PM2.5', build=False, mod
         #show_fea_imp(feat_imp,filename=data.report_folder + f'{poll_name}_rf_fea_op2.png', title='rf feature of importance(default)')
     except:
         # custom feature of importance
-        feat_imp = feat_importance(model,xtrn,ytrn,data.x_cols,n_iter=50)
+        feat_imp = feat_importance(model,xtrn,ytrn,data.x_cols,n_iter=50,group_lag=True)
         #show_fea_imp(feat_imp,filename=data.report_folder + f'{poll_name}_rf_fea_op2.png', title='rf feature of importance(shuffle)')
 
     # obtain feature of importance without lag 
@@ -530,7 +1037,7 @@ def load_model1(city:str='Chiang Mai', pollutant:str='PM2.5', build=False, split
         split_list: datasplit for training and testset  
     
     Returns: 
-        model: model 
+        model: model. A CompactForest if update is False. See load_forest
         dataset: dataset object
         fire_cols:
     
@@ -545,7 +1052,15 @@ def load_model1(city:str='Chiang Mai', pollutant:str='PM2.5', build=False, split
     poll_meta = model_meta[pollutant] 
 
     # load model 
-    model = pickle.load(open(data.model_folder +f'{poll_name}_rf_model.pkl','rb'))
+    model_file = data.model_folder + f'{poll_name}_rf_model'
+    if update:
+        # the model is fitted again, so only the parameters are needed
+        model = RandomForestRegressor(**poll_meta['rf_params'])
+    elif os.path.exists(model_file + '/manifest.json'):
+        model = load_forest(model_file)
+    else:
+        # model saved before the compact format
+        model = pickle.load(open(model_file + '.pkl','rb'))
 
     if build:
             # build data from scratch 
@@ -3,6 +3,7 @@ from ..imports import *
 from ..gen_functions import *
 from ..features.dataset import Dataset
 from ..visualization.vis_model import *
+from .forest import *
 
 def do_knn_search(x_trn:np.array, y_trn:np.array, cv_split:str='time', n_splits:int=5,param_dict:dict=None, x_tree=True):
     """Perform randomize parameter search for KNN regressor return the best estimator 
@@ -79,7 +80,20 @@ def do_ln_search(x_trn:np.array, y_trn:np.array, cv_split:str='time', n_splits:i
     
     return search.best_estimator_   
 
-def op_lag_fire(dataset, model, split_ratio, lag_range=[2, 168], step_range=[1,25],wind_range:list=[2,20],shift_range:list=[-72,72],roll_range:list=[24, 240]):
+def _score_lag_fire(x, search_data, split_ratio, model):
+    # validation error of x = [n_max, step, wind_speed, shift, roll]
+    n_max, step, wind_speed, shift, roll = x
+    data = merge_search_fire(search_data, wind_speed, shift, roll)
+    x_cols_org = search_data['x_cols_org']
+    lag_builder = LagBuilder(data[x_cols_org].values, cols=x_cols_org)
+    xy_list = lag_builder.split_data_matrix(data[search_data['monitor']].values, np.arange(1, n_max, step),
+                                            split_ratio, roll=True)
+    (xtrn, ytrn), (xval, yval) = xy_list[:2]
+    model.fit(xtrn, ytrn)
+    return mean_squared_error(yval, model.predict(xval))
+
+
+def op_lag_fire(dataset, model, split_ratio, lag_range=[2, 168], step_range=[1,25],wind_range:list=[2,20],shift_range:list=[-72,72],roll_range:list=[24, 240], n_batch=None, n_jobs=-2, trial_file=None):
     """Search for the best lag and fire parameters using skopt optimization 
     
     Args: 
@@ -88,10 +102,17 @@ def op_lag_fire(dataset, model, split_ratio, lag_range=[2, 168], step_range=[1,2
         split_ratio: list of split ratio
         lag_range(optional): min and max value of wind speed 
         step_range(optional): min and max value of shift parameter
+        n_batch(optional): number of candidates evaluated at the same time. See batch_minimize [default:None]
+        n_jobs(optional): number of worker processes [default:-2]
+        trial_file(optional): trial filename to warm start and record the search. See batch_minimize [default:None]
         
     Return: fire_dict fire dictionary 
     
     """
+    if np.sum(split_ratio) > 1:
+        raise AssertionError(
+            'The sum of the splitting ratios must not exceed 1')
+
     # build search space 
     n_max = Integer(low=lag_range[0], high=lag_range[1], name='n_max')
     step = Integer(low=step_range[0], high=step_range[1], name='step')
@@ -104,35 +125,19 @@ def op_lag_fire(dataset, model, split_ratio, lag_range=[2, 168], step_range=[1,2
     #roll = Categorical([True, False], name='roll')
     dimensions = [n_max, step, wind_speed, shift, roll]
     
-    
-    # setup the function for skopt
-    @use_named_args(dimensions)
-    def fit_with( n_max, step, wind_speed, shift, roll):
-        # function to return the score (smaller better)
-        fire_dict = { 'w_speed': wind_speed, 
-                      'shift': shift,
-                      'roll': roll}
-        _, *args = dataset.merge_fire(fire_dict)
-        dataset.data_org = dataset.data[ [dataset.monitor] + dataset.x_cols_org]
-        
-        # function to return the score (smaller better)
-        dataset.build_lag(lag_range=np.arange(1, n_max, step), roll=True)
-        dataset.x_cols = dataset.data.columns.drop(dataset.monitor)
-        
-        dataset.split_data(split_ratio=split_ratio)
-        xtrn, ytrn, x_cols = dataset.get_data_matrix(use_index=dataset.split_list[0], x_cols=dataset.x_cols)
-        xval, yval, _ = dataset.get_data_matrix(use_index=dataset.split_list[1], x_cols=dataset.x_cols)
-        model.fit(xtrn,ytrn)
-        y_pred = model.predict(xval)
-        
-        return mean_squared_error(yval,y_pred)
-    
-    gp_result = gp_minimize(func=fit_with,dimensions=dimensions,n_jobs=-2,random_state=30)
+    # the candidates are evaluated in worker processes from the read-only search data
+    search_data = get_search_data(dataset)
+    context = trial_context(search_data['data_no_fire'], search_data['fire'], search_data['hotspot_wind'],
+                            search_data['damp_surface'], search_data['fire_dict'].get('wind', 'constant'),
+                            list(search_data['x_cols_org']), list(split_ratio), model.get_params())
+    gp_result = batch_minimize(_score_lag_fire, dimensions, args=(search_data, split_ratio, model),
+                               n_batch=n_batch, n_jobs=n_jobs, random_state=30,
+                               trial_file=trial_file, search='lag_fire', context=context)
     n_max, step, wind_speed, shift, roll = gp_result.x
     lag_dict = {'n_max':int(n_max),
                 'step':int(step),
                 'roll': True}
-    fire_dict = {'w_speed': int(wind_speed), 'shift': int(shift), 'roll': int(roll)}
+    fire_dict = dict(getattr(dataset, 'fire_dict', {}), w_speed=int(wind_speed), shift=int(shift), roll=int(roll))
     score = gp_result.fun
     print('new mean squared error', score, 'using', lag_dict and fire_dict )
     
@@ -447,7 +452,7 @@ def train_city_s1_v2(city:str='Chiang Mai', pollutant:str='PM2.5', build=False,
     print('final score for test set', score_dict)
     
 
-    pickle.dump(model, open(data.model_folder +f'{poll_name}_rf_model.pkl', 'wb'))
+    save_forest(model, data.model_folder + f'{poll_name}_rf_model')
 
     # build feature of importance using build in rf
     try: 
@@ -457,7 +462,7 @@ def train_city_s1_v2(city:str='Chiang Mai', pollutant:str='PM2.5', build=False,
         #show_fea_imp(feat_imp,filename=data.report_folder + f'{poll_name}_rf_fea_op2.png', title='rf feature of importance(default)')
     except:
         # custom feature of importance
-        feat_imp = feat_importance(model,xtrn,ytrn,data.x_cols,n_iter=50)
+        feat_imp = feat_importance(model,xtrn,ytrn,data.x_cols,n_iter=50,group_lag=True)
         #show_fea_imp(feat_imp,filename=data.report_folder + f'{poll_name}_rf_fea_op2.png', title='rf feature of importance(shuffle)')
 
     # obtain feature of importance without lag 